@@ -0,0 +1,77 @@
+"""
+Benchmark for search_suggestions: linear scan over the city list versus the
+per-process CityIndex.
+
+Uses a synthetic list the size of the OpenWeatherMap city list by default.
+Pass the path of a downloaded city.list.json.gz to run on the real data.
+
+Run from the backend directory:
+    python Benchmarks/city_search_bench.py [city.list.json.gz]
+"""
+import gzip
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'climate.settings')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+import django
+django.setup()
+
+from weather.city_index import CityIndex
+
+CITY_COUNT = 200000
+SYLLABLES = ['ba', 'ber', 'ca', 'dor', 'el', 'fa', 'gan', 'ha', 'is', 'jo', 'ka', 'lon', 'ma', 'ne',
+             'or', 'pa', 'qu', 'ris', 'sa', 'to', 'ur', 'va', 'wa', 'xi', 'yo', 'zen', 'ville', 'burg']
+QUERIES = ['p', 'pa', 'par', 'lon', 'lond', 'burg', 'ville', 'zenqu', 'xyz', 'tor', 'toron', 'sa', 'ma', 'qux']
+
+
+def synthetic_cities(count):
+    rng = random.Random(42)
+    cities = []
+    for i in range(count):
+        name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+        cities.append({'id': i, 'name': name, 'country': 'XX', 'coord': {'lat': 0.0, 'lon': 0.0}})
+    return cities
+
+
+def load_cities(path):
+    with open(path, 'rb') as f:
+        return json.loads(gzip.decompress(f.read()).decode('utf-8'))
+
+
+def linear_search(cities, query):
+    """The previous search_suggestions implementation."""
+    return [city['name'] for city in cities if query in city['name'].lower()][:10]
+
+
+def measure(func, rounds):
+    timings = []
+    for _ in range(rounds):
+        for query in QUERIES:
+            start = time.perf_counter()
+            func(query)
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.99)]
+
+
+if __name__ == '__main__':
+    cities = load_cities(sys.argv[1]) if len(sys.argv) > 1 else synthetic_cities(CITY_COUNT)
+    print(f'{len(cities)} cities, {len(QUERIES)} queries')
+
+    start = time.perf_counter()
+    index = CityIndex.from_city_list(cities)
+    print(f'index build  {time.perf_counter() - start:8.2f} s (once per process)')
+
+    for query in QUERIES:
+        assert index.search(query) == linear_search(cities, query), query
+
+    linear_p50, linear_p99 = measure(lambda q: linear_search(cities, q), rounds=3)
+    index_p50, index_p99 = measure(index.search, rounds=200)
+    print(f'linear scan  p50 {linear_p50 * 1e6:10.1f} us   p99 {linear_p99 * 1e6:10.1f} us')
+    print(f'city index   p50 {index_p50 * 1e6:10.1f} us   p99 {index_p99 * 1e6:10.1f} us')
@@ -0,0 +1,79 @@
+"""
+Benchmark for the coordinate grid of the observation cache: hit rate versus
+how far the weather served may be from the requested point, per cell size.
+
+Simulates an hour of browser-located users spread over a metro area, each
+polling every few minutes with the position jitter geolocation shows between
+calls. A request hits if its cell was fetched within the observation cache
+timeout. No upstream or cache is involved, only the keying.
+
+Run from the backend directory:
+    python Benchmarks/coordinate_cache_bench.py
+"""
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'climate.settings')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+import django
+django.setup()
+
+from weather.locations import coordinate_location, snap_coordinates
+from weather.observations import CURRENT_TIMEOUT
+
+CENTRE = (43.70, -79.42) # Toronto
+SPREAD = 0.15 # Degrees around the centre users are spread over, about 30 km
+USERS = 2000
+DURATION = 3600 # Seconds simulated
+POLL_INTERVAL = 300 # Seconds between a user's requests
+JITTER = 0.0005 # Degrees of position noise per request, about 50 m
+GRIDS = [0, 0.001, 0.005, 0.01, 0.02, 0.05, 0.1]
+
+
+def requests(rng):
+    """(time, lat, lon) of every request, in time order."""
+    events = []
+    for _ in range(USERS):
+        lat = CENTRE[0] + rng.uniform(-SPREAD, SPREAD)
+        lon = CENTRE[1] + rng.uniform(-SPREAD, SPREAD)
+        t = rng.uniform(0, POLL_INTERVAL)
+        while t < DURATION:
+            events.append((t, lat + rng.gauss(0, JITTER), lon + rng.gauss(0, JITTER)))
+            t += POLL_INTERVAL
+    events.sort()
+    return events
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * 6371 * math.asin(math.sqrt(a))
+
+
+def run(grid, events):
+    fetched = {}
+    hits = 0
+    worst = 0
+    for t, lat, lon in events:
+        key = coordinate_location(lat, lon, grid).key
+        if key in fetched and t - fetched[key] < CURRENT_TIMEOUT:
+            hits += 1
+        else:
+            fetched[key] = t
+        worst = max(worst, distance_km(lat, lon, *snap_coordinates(lat, lon, grid)))
+    return hits / len(events), len(events) - hits, worst
+
+
+if __name__ == '__main__':
+    events = requests(random.Random(42))
+    print(f'{len(events)} requests from {USERS} users over {DURATION // 60} minutes, '
+          f'cache timeout {CURRENT_TIMEOUT} s')
+    print(f'{"grid (deg)":>10} {"hit rate":>9} {"upstream":>9} {"max offset":>11}')
+    for grid in GRIDS:
+        hit_rate, misses, worst = run(grid, events)
+        print(f'{grid:>10} {hit_rate:>8.1%} {misses:>9} {worst * 1000:>9.0f} m')
@@ -0,0 +1,74 @@
+"""
+Benchmark for the cold-miss path of get_weather_data.
+
+Both upstream APIs are mocked with a fixed latency, so the numbers show how
+long a user waits on a cache miss when the two calls run one after the other
+versus in parallel.
+
+Run from the backend directory:
+    python Benchmarks/weather_fetch_bench.py
+"""
+import os
+import sys
+import time
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'climate.settings')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+os.environ.setdefault('API_KEY', 'benchmark')
+os.environ.setdefault('WEATHER_API_KEY_2', 'benchmark')
+
+import django
+django.setup()
+
+from django.test import RequestFactory
+from weather import views, locations
+from weather.city_snapshot import CitySnapshot
+
+UPSTREAM_LATENCY = 0.2 # Seconds per mocked upstream call
+ROUNDS = 10
+RUN = time.time_ns() # Keeps city names, and so observation cache keys, unique to this run
+
+WEATHER_PAYLOAD = {'cod': 200, 'main': {'temp': 290.0}, 'weather': [{}], 'timezone': 0}
+FORECAST_PAYLOAD = {'forecast': {'forecastday': []}}
+
+
+def mocked_upstream(url, **kwargs):
+    time.sleep(UPSTREAM_LATENCY)
+    payload = WEATHER_PAYLOAD if 'openweathermap' in url else FORECAST_PAYLOAD
+    return MagicMock(status_code=200, json=MagicMock(return_value=payload))
+
+
+def sequential_fetch(city_name):
+    """The previous behaviour: one upstream call after the other."""
+    session = views.get_session()
+    session.get(f'http://api.openweathermap.org/data/2.5/weather?q={city_name}', timeout=10)
+    session.get(f'https://api.weatherapi.com/v1/forecast.json?q={city_name}', timeout=10)
+
+
+def concurrent_fetch(city_name):
+    request = RequestFactory().get('/get_weather_data/', {'city_name': city_name})
+    views.get_weather_data(request)
+
+
+def run(label, func):
+    timings = []
+    for i in range(ROUNDS):
+        start = time.perf_counter()
+        func(f'City{i}-{RUN}')
+        timings.append(time.perf_counter() - start)
+    mean = sum(timings) / len(timings)
+    print(f'{label:<12} mean {mean * 1000:8.1f} ms   max {max(timings) * 1000:8.1f} ms')
+    return mean
+
+
+if __name__ == '__main__':
+    # Skip the payload cache and the city list so every round is a cold miss
+    with patch('requests.Session.get', side_effect=mocked_upstream), \
+            patch.object(views, 'get_payload', return_value=None), \
+            patch.object(locations, 'get_city_snapshot', return_value=CitySnapshot.from_city_list([])):
+        print(f'Upstream latency {UPSTREAM_LATENCY * 1000:.0f} ms per call, {ROUNDS} rounds')
+        sequential = run('sequential', sequential_fetch)
+        concurrent = run('concurrent', concurrent_fetch)
+        print(f'speedup      {sequential / concurrent:.2f}x')
@@ -0,0 +1,292 @@
+import pytest
+import json
+import asyncio
+import time
+import httpx
+from contextlib import contextmanager
+from unittest.mock import patch
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.test import RequestFactory
+
+from weather import async_views, async_utils
+from weather.tile_store import reset_tile_store
+from weather.city_snapshot import CitySnapshot
+from weather.custom_exceptions import BadRequest, NotFound, ServiceUnavailable
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+@pytest.fixture(autouse=True)
+def tile_store(settings, tmp_path):
+    settings.TILE_STORE_PATH = str(tmp_path / 'tiles')
+    reset_tile_store()
+    yield
+    reset_tile_store()
+
+@pytest.fixture(autouse=True)
+def city_snapshot():
+    with patch('weather.locations.get_city_snapshot', return_value=CitySnapshot.from_city_list([])), \
+            patch('weather.timezones.get_city_snapshot', return_value=CitySnapshot.from_city_list([])):
+        yield
+
+@pytest.fixture
+def rf():
+    return RequestFactory()
+
+@contextmanager
+def mock_client(handler):
+    """Patch the pooled async client with one backed by an in-process transport."""
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    with patch('weather.async_utils.get_async_client', return_value=client), \
+            patch('weather.observations.get_async_client', return_value=client):
+        yield client
+
+WEATHER_MOCK = {
+    'cod': 200,
+    'main': {'temp': 295.15, 'humidity': 80, 'pressure': 1012},
+    'weather': [{'description': 'Clear sky', 'icon': '01d'}],
+    'wind': {'speed': 5},
+    'sys': {'sunrise': 1661834187, 'sunset': 1661882248},
+    'timezone': 3600
+}
+
+FORECAST_MOCK = {
+    'forecast': {
+        'forecastday': [{
+            'date': '2025-11-21',
+            'day': {'maxtemp_c': 20.0, 'mintemp_c': 10.0, 'condition': {'text': 'Sunny', 'icon': '113.png'}},
+            'hour': [{'time': '2025-11-21 00:00', 'temp_c': 18.0, 'condition': {'text': 'Clear', 'icon': '113.png'}}]
+        }]
+    }
+}
+
+@patch('weather.async_views.API_KEY', 'test_api_key')
+@patch('weather.async_views.WEATHER_API_KEY_2', 'test_api_key')
+def test_async_get_weather_data_valid(rf):
+    def handler(request):
+        if 'openweathermap' in request.url.host:
+            return httpx.Response(200, json=WEATHER_MOCK)
+        return httpx.Response(200, json=FORECAST_MOCK)
+
+    with mock_client(handler):
+        request = rf.get('/get_weather_data/', {'city_name': 'Madrid'})
+        response = async_to_sync(async_views.get_weather_data)(request)
+
+    data = json.loads(response.content)
+    assert response.status_code == 200
+    assert data['city_name'] == 'Madrid'
+    assert data['hourly_forecast'][0]['time'] == '00:00'
+    assert data['daily_forecast'][0]['date'] == '2025-11-21'
+
+@patch('weather.async_views.API_KEY', 'test_api_key')
+@patch('weather.async_views.WEATHER_API_KEY_2', 'test_api_key')
+def test_async_get_weather_data_compact_format(rf):
+    def handler(request):
+        if 'openweathermap' in request.url.host:
+            return httpx.Response(200, json=WEATHER_MOCK)
+        return httpx.Response(200, json=FORECAST_MOCK)
+
+    with mock_client(handler):
+        request = rf.get('/get_weather_data/', {'city_name': 'Madrid', 'format': 'compact'})
+        response = async_to_sync(async_views.get_weather_data)(request)
+
+    data = json.loads(response.content)
+    assert data['format'] == 'compact'
+    assert data['conditions'] == ['Clear', 'Sunny']
+    assert data['hourly_forecast'] == {'time': ['00:00'], 'temperature': [18.0], 'condition': [0], 'icon': [0]}
+
+@patch('weather.async_views.API_KEY', 'test_api_key')
+@patch('weather.async_views.WEATHER_API_KEY_2', 'test_api_key')
+def test_async_get_weather_data_city_not_found(rf):
+    with mock_client(lambda request: httpx.Response(200, json={'cod': '404'})):
+        request = rf.get('/get_weather_data/', {'city_name': 'InvalidCity'})
+        with pytest.raises(NotFound):
+            async_to_sync(async_views.get_weather_data)(request)
+
+def test_async_get_weather_data_missing_city(rf):
+    request = rf.get('/get_weather_data/', {'city_name': ''})
+    with pytest.raises(BadRequest):
+        async_to_sync(async_views.get_weather_data)(request)
+
+@patch('weather.async_views.API_KEY', 'test_api_key')
+@patch('weather.async_views.WEATHER_API_KEY_2', 'test_api_key')
+def test_async_get_user_location_serves_nearest_city(rf):
+    from weather.nearest_city import NearestCityIndex
+
+    index = NearestCityIndex(CitySnapshot.from_city_list([
+        {'id': 3117735, 'name': 'Madrid', 'country': 'ES', 'coord': {'lon': -3.70256, 'lat': 40.4165}},
+    ]))
+    requested = []
+
+    def handler(request):
+        requested.append(str(request.url))
+        if 'openweathermap' in request.url.host:
+            return httpx.Response(200, json=WEATHER_MOCK)
+        return httpx.Response(200, json=FORECAST_MOCK)
+
+    with mock_client(handler), patch('weather.locations.get_nearest_city_index', return_value=index):
+        request = rf.get('/get_user_location/40.42/-3.7/')
+        response = async_to_sync(async_views.get_user_location)(request, 40.42, -3.7)
+
+    assert response.status_code == 200
+    assert json.loads(response.content)['city_name'] == 'Madrid'
+    assert any('id=3117735' in url for url in requested)
+
+@patch('weather.async_utils.NEWS_API_KEY', 'test_news_api_key')
+@patch('weather.async_views.NEWS_API_KEY', 'test_news_api_key')
+def test_async_get_news_view_success(rf):
+    articles = {'articles': [{'title': 'Storm warning', 'description': 'Desc', 'url': 'http://news'}]}
+    with mock_client(lambda request: httpx.Response(200, json=articles)):
+        request = rf.get('/get_news/', {'query': 'storm'})
+        response = async_to_sync(async_views.get_news_view)(request)
+
+    data = json.loads(response.content)
+    assert data['news'][0]['title'] == 'Storm warning'
+
+@patch('weather.async_utils.NEWS_API_KEY', 'test_news_api_key')
+@patch('weather.async_views.NEWS_API_KEY', 'test_news_api_key')
+def test_async_get_news_view_not_modified(rf):
+    articles = {'articles': [{'title': 'Storm warning', 'description': 'Desc', 'url': 'http://news'}]}
+    with mock_client(lambda request: httpx.Response(200, json=articles)):
+        first = async_to_sync(async_views.get_news_view)(rf.get('/get_news/', {'query': 'storm'}))
+        second = async_to_sync(async_views.get_news_view)(
+            rf.get('/get_news/', {'query': 'storm'}, HTTP_IF_NONE_MATCH=first['ETag'])
+        )
+
+    assert first.status_code == 200
+    assert second.status_code == 304
+
+def test_async_get_time_zone_not_found(rf):
+    with mock_client(lambda request: httpx.Response(200, json={})):
+        request = rf.get('/get_time_zone/', {'city_name': 'InvalidCity'})
+        with pytest.raises(NotFound):
+            async_to_sync(async_views.get_time_zone)(request)
+
+@patch('weather.async_views.aget_ip_table', return_value=None)
+def test_async_get_user_location_fallback_to_toronto(mock_get_ip_table, rf):
+    def handler(request):
+        if request.url.host == 'ipapi.co':
+            return httpx.Response(500)
+        return httpx.Response(200, json={
+            'name': 'Toronto',
+            'weather': [{'description': 'snow'}],
+            'main': {'temp': 270, 'feels_like': 265, 'humidity': 90},
+            'wind': {'speed': 3}
+        })
+
+    with mock_client(handler):
+        response = async_to_sync(async_views.get_user_location_view)(
+            rf.get('/get_user_location/', REMOTE_ADDR='123.123.123.123'))
+
+    assert json.loads(response.content)['city_name'] == 'Toronto'
+
+@patch('weather.async_views.aget_ip_table', return_value=None)
+def test_async_get_user_location_weather_failure_serves_warm_fallback(mock_get_ip_table, rf):
+    from weather.locations import FALLBACK_LOCATION
+    from weather.payloads import store_payload
+
+    store_payload('user_location', (FALLBACK_LOCATION.key,), {'city_name': 'Toronto'}, 600, fallback_timeout=3600)
+    hosts = []
+
+    def handler(request):
+        hosts.append(request.url.host)
+        if request.url.host == 'ipapi.co':
+            return httpx.Response(200, json={'city': 'Paris', 'region': 'Ile-de-France', 'country_name': 'France'})
+        return httpx.Response(503)
+
+    with mock_client(handler), patch('weather.retry.DEFAULT_RETRY_POLICY.attempts', 1):
+        response = async_to_sync(async_views.get_user_location_view)(
+            rf.get('/get_user_location/', REMOTE_ADDR='123.123.123.123'))
+
+    assert json.loads(response.content)['city_name'] == 'Toronto'
+    assert response['Cache-Control'] == 'private, max-age=0'
+    # Toronto's weather was not fetched again
+    assert hosts == ['ipapi.co', 'api.openweathermap.org']
+
+async def read_streaming(response):
+    return b''.join([chunk async for chunk in response.streaming_content])
+
+@patch.dict('os.environ', {'API_KEY': 'test_api_key'})
+def test_async_map_tile_proxy_success(rf):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, content=b'tile_content', headers={'Content-Type': 'image/png'})
+
+    async def fetch_twice():
+        request = rf.get('/map_tile/temp_new/2/1/1/')
+        first = await async_views.map_tile_proxy(request, layer='temp_new', z=2, x=1, y=1)
+        body = await read_streaming(first)
+        second = await async_views.map_tile_proxy(request, layer='temp_new', z=2, x=1, y=1)
+        revalidated = await async_views.map_tile_proxy(
+            rf.get('/map_tile/temp_new/2/1/1/', HTTP_IF_NONE_MATCH=second['ETag']),
+            layer='temp_new', z=2, x=1, y=1
+        )
+        return first, body, second, revalidated
+
+    with mock_client(handler):
+        first, body, second, revalidated = async_to_sync(fetch_twice)()
+
+    assert first.status_code == 200
+    assert first.streaming
+    assert body == b'tile_content'
+    assert second.content == b'tile_content'
+    # The streamed response already carried the stored tile's ETag
+    assert first['ETag'] == second['ETag']
+    assert revalidated.status_code == 304
+    assert len(calls) == 1
+
+@patch.dict('os.environ', {'API_KEY': 'test_api_key'})
+def test_async_map_tile_proxy_timeout(rf):
+    def handler(request):
+        raise httpx.ReadTimeout('timed out', request=request)
+
+    with mock_client(handler):
+        request = rf.get('/map_tile_optimized/temp_new/3/1/1/')
+        with pytest.raises(ServiceUnavailable):
+            async_to_sync(async_views.map_tile_proxy_optimized)(request, layer='temp_new', z=3, x=1, y=1)
+
+def test_async_redis_cache_shares_keys_with_sync_version():
+    @async_utils.async_redis_cache(timeout=60)
+    async def get_news(query, count=5):
+        return ['fresh']
+
+    from weather.utils import make_cache_key
+    cache.set(make_cache_key('get_news', ('storm',), {}), ['cached'], 60)
+    assert async_to_sync(get_news)('storm') == ['cached']
+
+@patch('weather.async_utils.NEWS_API_KEY', 'test_news_api_key')
+def test_async_get_news_failed_refresh_keeps_stale_news():
+    from weather.utils import make_cache_key, CacheEntry
+    key = make_cache_key('get_news', ('storm',), {})
+    cache.set(key, CacheEntry([{'title': 'Stale'}], time.time() - 1), 86400)
+
+    async def get_and_wait():
+        news = await async_utils.get_news('storm')
+        await asyncio.gather(*async_utils._background_tasks)
+        return news
+
+    with mock_client(lambda request: httpx.Response(500)), patch('weather.retry.DEFAULT_RETRY_POLICY.attempts', 1):
+        assert async_to_sync(get_and_wait)() == [{'title': 'Stale'}]
+
+    assert cache.get(key).value == [{'title': 'Stale'}]
+
+def test_get_async_client_reused_within_loop():
+    async def get_twice():
+        return async_utils.get_async_client() is async_utils.get_async_client()
+
+    assert async_to_sync(get_twice)()
+
+def test_async_redis_cache_reads_stale_entries_from_sync_decorator():
+    @async_utils.async_redis_cache(timeout=60, stale_timeout=600)
+    async def forecast(city):
+        return {'city': city, 'fresh': True}
+
+    from weather.utils import make_cache_key, CacheEntry
+    key = make_cache_key('forecast', ('Lima',), {})
+    cache.set(key, CacheEntry({'city': 'Lima', 'fresh': False}, time.time() - 1), 600)
+
+    assert async_to_sync(forecast)('Lima') == {'city': 'Lima', 'fresh': False}
@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import pytest
+import time
+from unittest.mock import patch
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.http import HttpResponse
+from redis.client import Redis
+from weather import metrics
+from weather.cache_backends import LocalLRU, TwoTierRedisCache
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    metrics.reset()
+
+def other_node():
+    """A second backend instance, standing in for a worker on another node."""
+    config = settings.CACHES['default']
+    node = TwoTierRedisCache(config['LOCATION'], {'OPTIONS': config['OPTIONS']})
+    # Instances in one process share their L1, so give this one its own
+    node._tier_key += ('other node',)
+    return node
+
+def listeners():
+    return sum(thread.name == 'cache-invalidation' for thread in threading.enumerate())
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_local_lru_evicts_least_recently_used():
+    lru = LocalLRU(max_entries=2, timeout=60)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    lru.get('a')
+    lru.set('c', 3)
+    assert lru.get('a') == (True, 1)
+    assert lru.get('b') == (False, None)
+    assert len(lru) == 2
+
+def test_local_lru_expires_entries():
+    lru = LocalLRU(max_entries=10, timeout=60)
+    lru.set('a', 1, timeout=0.05)
+    assert lru.get('a') == (True, 1)
+    time.sleep(0.06)
+    assert lru.get('a') == (False, None)
+
+def test_local_lru_copies_non_plain_values():
+    lru = LocalLRU(max_entries=10, timeout=60)
+    lru.set('response', HttpResponse(b'body'))
+    _, first = lru.get('response')
+    _, second = lru.get('response')
+    first['X-Test'] = '1'
+    assert first is not second
+    assert 'X-Test' not in second
+
+def test_two_tier_counts_hits_per_tier():
+    cache.set('toronto', {'temp': 3})
+    assert cache.get('toronto') == {'temp': 3}
+
+    node = other_node()
+    assert node.get('toronto') == {'temp': 3}
+    assert node.get('toronto') == {'temp': 3}
+    assert node.get('unknown') is None
+
+    counters = metrics.snapshot()
+    assert counters['cache_tier.l1_hit'] == 2
+    assert counters['cache_tier.l2_hit'] == 1
+    assert counters['cache_tier.miss'] == 1
+
+def test_two_tier_get_many_mixes_tiers():
+    cache.set('a', 1)
+    cache.set('b', 2)
+    node = other_node()
+    node.get('a')
+    assert node.get_many(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+
+def test_two_tier_invalidates_other_nodes_on_write():
+    node = other_node()
+    cache.set('toronto', {'temp': 3})
+    assert node.get('toronto') == {'temp': 3}
+    time.sleep(0.1) # let the listener subscribe
+
+    cache.set('toronto', {'temp': 5})
+    assert wait_for(lambda: node.get('toronto') == {'temp': 5})
+
+    cache.delete('toronto')
+    assert wait_for(lambda: node.get('toronto') is None)
+
+def test_two_tier_clear_invalidates_other_nodes():
+    node = other_node()
+    cache.set('toronto', {'temp': 3})
+    node.get('toronto')
+    time.sleep(0.1)
+
+    cache.clear()
+    assert wait_for(lambda: len(node.local) == 0)
+
+def test_two_tier_instances_share_one_process_tier():
+    cache.set('toronto', {'temp': 3})
+    cache.get('toronto')
+    started = listeners()
+    instances = []
+
+    def in_thread():
+        instances.append(caches['default'])
+        instances[-1].get('toronto')
+
+    threads = [threading.Thread(target=in_thread) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    async def in_task():
+        instances.append(caches['default'])
+        instances[-1].get('toronto')
+
+    async def in_tasks():
+        await asyncio.gather(*(asyncio.create_task(in_task()) for _ in range(3)))
+
+    async_to_sync(in_tasks)()
+
+    assert len({id(instance) for instance in instances}) > 1
+    assert all(instance.tier is cache.tier for instance in instances)
+    assert listeners() == started
+
+def test_two_tier_publishes_many_keys_in_one_round_trip():
+    node = other_node()
+    cache.set_many({'a': 1, 'b': 2})
+    node.get_many(['a', 'b'])
+    time.sleep(0.1)
+
+    direct = []
+    original = Redis.execute_command
+
+    def execute_command(self, *args, **options):
+        direct.append(args[0])
+        return original(self, *args, **options)
+
+    # Commands queued on a pipeline do not go through Redis.execute_command
+    with patch.object(Redis, 'execute_command', execute_command):
+        cache.set_many({'a': 3, 'b': 4})
+        cache.delete_many(['a', 'b'])
+    assert 'PUBLISH' not in direct
+    assert wait_for(lambda: node.get_many(['a', 'b']) == {})
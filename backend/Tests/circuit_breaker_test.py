@@ -0,0 +1,104 @@
+from unittest.mock import MagicMock, patch
+
+import httpx
+import pytest
+import requests
+from django_redis import get_redis_connection
+
+from weather.circuit_breaker import (
+    CircuitBreaker, CircuitOpen, get_breaker, breaker_states, CLOSED, OPEN, HALF_OPEN
+)
+from weather.retry import RetryPolicy
+
+@pytest.fixture
+def breaker():
+    breaker = CircuitBreaker('breaker-test.example', failure_threshold=3, reset_timeout=30)
+    breaker.reset()
+    yield breaker
+    breaker.reset()
+
+def expire_open_period(breaker):
+    get_redis_connection('default').delete(f'{breaker.key}:open')
+
+def test_opens_after_threshold_failures(breaker):
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state() == CLOSED
+    breaker.record_failure()
+    assert breaker.state() == OPEN
+    assert not breaker.allow()
+
+def test_stays_closed_while_most_calls_succeed(breaker):
+    for _ in range(10):
+        breaker.record_success()
+    for _ in range(4):
+        breaker.record_failure()
+    assert breaker.state() == CLOSED
+
+def test_half_open_lets_one_probe_through(breaker):
+    breaker.trip()
+    expire_open_period(breaker)
+
+    assert breaker.state() == HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+
+def test_successful_probe_closes(breaker):
+    breaker.trip()
+    expire_open_period(breaker)
+    assert breaker.allow()
+    breaker.record_success()
+
+    assert breaker.state() == CLOSED
+    assert breaker.allow()
+
+def test_failed_probe_reopens(breaker):
+    breaker.trip()
+    expire_open_period(breaker)
+    assert breaker.allow()
+    breaker.record_failure()
+
+    assert breaker.state() == OPEN
+
+def test_state_is_shared_between_breaker_objects(breaker):
+    breaker.trip()
+    assert CircuitBreaker(breaker.host).state() == OPEN
+
+def test_allows_calls_when_redis_is_unavailable(breaker):
+    with patch('weather.circuit_breaker.get_redis_connection', side_effect=ConnectionError('down')):
+        assert breaker.allow()
+        breaker.record_failure()
+
+def test_circuit_open_is_a_requests_and_httpx_error():
+    error = CircuitOpen('open')
+    assert isinstance(error, requests.ConnectionError)
+    assert isinstance(error, httpx.TransportError)
+
+@patch('requests.Session.get')
+def test_retry_policy_fails_fast_when_open(mock_get):
+    breaker = get_breaker('http://breaker-open.example/')
+    breaker.trip()
+    try:
+        with pytest.raises(CircuitOpen):
+            RetryPolicy(attempts=3).get('http://breaker-open.example/weather')
+        mock_get.assert_not_called()
+    finally:
+        breaker.reset()
+
+@patch('requests.Session.get')
+def test_retry_policy_records_outcomes(mock_get):
+    mock_get.return_value = MagicMock(status_code=503)
+    breaker = get_breaker('http://breaker-records.example/')
+    breaker.reset()
+    try:
+        policy = RetryPolicy(attempts=1)
+        for _ in range(5):
+            policy.get('http://breaker-records.example/weather')
+        assert breaker.state() == OPEN
+    finally:
+        breaker.reset()
+
+def test_breaker_states_lists_known_hosts():
+    states = breaker_states()
+    assert states['api.openweathermap.org'] in (CLOSED, OPEN, HALF_OPEN)
+    assert 'newsapi.org' in states
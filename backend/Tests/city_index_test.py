@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+from unittest.mock import patch
+from weather import city_index
+from weather.city_index import CityIndex, build_city_index, get_city_index, reset_city_index
+from weather.city_snapshot import CitySnapshot
+
+CITIES = ['Paris', 'Parma', 'Paradise', 'London', 'Londonderry', 'New London', 'Oslo', 'Paris']
+
+@pytest.fixture(autouse=True)
+def fresh_index():
+    reset_city_index()
+    yield
+    reset_city_index()
+
+def linear_search(names, query, limit=10):
+    return [name for name in names if query.lower() in name.lower()][:limit]
+
+@pytest.mark.parametrize('query', ['p', 'Pa', 'par', 'paris', 'london', 'don', 'ondo', 'o', 'xyz', 'new lon'])
+def test_city_index_matches_linear_scan(query):
+    index = CityIndex(CITIES)
+    assert index.search(query) == linear_search(CITIES, query)
+
+def test_city_index_respects_limit_and_order():
+    names = [f'Springfield {i}' for i in range(50)]
+    index = CityIndex(names)
+    assert index.search('spring', limit=10) == names[:10]
+
+def test_city_index_keeps_duplicate_names():
+    index = CityIndex(CITIES)
+    assert index.search('paris') == ['Paris', 'Paris']
+
+def test_city_index_empty_query():
+    assert CityIndex(CITIES).search('') == []
+
+def test_city_index_from_city_list():
+    index = CityIndex.from_city_list([{'name': 'Oslo', 'id': 1}, {'name': 'Osaka', 'id': 2}])
+    assert len(index) == 2
+    assert index.search('os') == ['Oslo', 'Osaka']
+
+def test_city_index_from_snapshot():
+    snapshot = CitySnapshot.from_city_list([{'name': 'Oslo', 'id': 1}, {'name': 'Osaka', 'id': 2}])
+    index = CityIndex.from_snapshot(snapshot)
+    assert index.search('osa') == ['Osaka']
+    assert index.snapshot is snapshot
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+@patch('weather.city_index.get_city_snapshot', return_value=CitySnapshot.from_city_list([{'name': 'Oslo'}]))
+def test_get_city_index_is_built_in_the_background(mock_get_city_snapshot):
+    release = threading.Event()
+    mock_get_city_snapshot.side_effect = lambda: release.wait(2) and mock_get_city_snapshot.return_value
+
+    # The caller is not kept waiting for the build
+    assert get_city_index() is None
+    assert get_city_index() is None
+    release.set()
+    assert wait_for(lambda: get_city_index() is not None)
+    assert get_city_index().search('os') == ['Oslo']
+    mock_get_city_snapshot.assert_called_once()
+
+@patch('weather.city_index.get_city_snapshot', return_value=CitySnapshot.from_city_list([]))
+def test_empty_city_list_is_retried_later(mock_get_city_snapshot):
+    assert len(build_city_index()) == 0
+    assert city_index._city_index is None
+    # A request right after does not start another build
+    assert get_city_index() is None
+    assert mock_get_city_snapshot.call_count == 1
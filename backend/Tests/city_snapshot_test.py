@@ -0,0 +1,103 @@
+import pytest
+from unittest.mock import patch
+from django.core.cache import cache
+from weather.city_snapshot import (
+    CitySnapshot, pack_city_list, write_city_snapshot, get_city_snapshot, reset_city_snapshot
+)
+
+CITIES = [
+    {'id': 6167865, 'name': 'Toronto', 'state': '', 'country': 'CA', 'coord': {'lon': -79.416298, 'lat': 43.700111}},
+    {'id': 3117735, 'name': 'Málaga', 'state': '', 'country': 'ES', 'coord': {'lon': -4.42034, 'lat': 36.72016}},
+    {'id': 1, 'name': 'Nowhere', 'country': '', 'coord': {'lon': 0, 'lat': 0}},
+]
+
+@pytest.fixture(autouse=True)
+def fresh_snapshot():
+    reset_city_snapshot()
+    yield
+    reset_city_snapshot()
+
+def test_snapshot_round_trip():
+    snapshot = CitySnapshot.from_city_list(CITIES)
+    assert len(snapshot) == 3
+    assert snapshot.names() == ['Toronto', 'Málaga', 'Nowhere']
+    assert snapshot.ids[0] == 6167865
+    assert snapshot.country(1) == 'ES'
+    assert snapshot.country(2) == ''
+    assert snapshot.lats[1] == pytest.approx(36.72016, abs=1e-5)
+    assert snapshot.lons[0] == pytest.approx(-79.416298, abs=1e-5)
+
+def test_snapshot_city_entry():
+    city = CitySnapshot.from_city_list(CITIES).city(0)
+    assert city['name'] == 'Toronto'
+    assert city['coord']['lat'] == pytest.approx(43.700111, abs=1e-5)
+
+def test_snapshot_find():
+    snapshot = CitySnapshot.from_city_list(CITIES)
+    assert snapshot.find(6167865) == 0
+    assert snapshot.find(1) == 2
+    assert snapshot.find(2) is None
+    assert snapshot.find(-1) is None
+    # A match straddling two ids is not an id
+    assert snapshot.find(int.from_bytes(snapshot.buffer[snapshot.ids_start + 2:snapshot.ids_start + 6], 'little')) is None
+
+def names(*names):
+    return CitySnapshot.from_city_list([{'name': name} for name in names])
+
+def test_snapshot_resolves_unique_name_ignoring_case():
+    snapshot = names('Toronto', 'Paris', 'Paris', 'Torontoville', 'Málaga')
+    assert snapshot.resolve('toronto') == 0
+    assert snapshot.resolve('TORONTOVILLE') == 3
+    assert snapshot.resolve('MÁLAGA') == 4
+
+def test_snapshot_resolve_ambiguous_or_unknown_name():
+    snapshot = names('Toronto', 'Paris', 'Paris')
+    assert snapshot.resolve('paris') is None
+    assert snapshot.resolve('Lima') is None
+    assert snapshot.resolve('to') is None
+    assert snapshot.resolve('zzz') is None
+    assert names().resolve('paris') is None
+
+def test_snapshot_rejects_other_data():
+    with pytest.raises(ValueError):
+        CitySnapshot(b'NOTASNAP' + bytes(8))
+
+def test_write_and_mmap_snapshot(tmp_path):
+    path = str(tmp_path / 'Data' / 'city_list.bin')
+    size = write_city_snapshot(CITIES, path)
+    assert size == len(pack_city_list(CITIES))
+
+    snapshot = CitySnapshot.open(path)
+    assert snapshot.names() == ['Toronto', 'Málaga', 'Nowhere']
+    assert list(tmp_path.joinpath('Data').iterdir()) == [tmp_path / 'Data' / 'city_list.bin']
+
+def test_get_city_snapshot_prefers_file(settings, tmp_path):
+    settings.CITY_SNAPSHOT_PATH = str(tmp_path / 'city_list.bin')
+    write_city_snapshot(CITIES, settings.CITY_SNAPSHOT_PATH)
+
+    with patch('weather.city_snapshot.get_cached_city_list') as mock_get_cached_city_list:
+        snapshot = get_city_snapshot()
+        assert get_city_snapshot() is snapshot
+        mock_get_cached_city_list.assert_not_called()
+    assert len(snapshot) == 3
+
+@patch('weather.city_snapshot.get_cached_city_list', return_value=CITIES[:1])
+def test_get_city_snapshot_falls_back_to_city_list(mock_get_cached_city_list, settings, tmp_path):
+    settings.CITY_SNAPSHOT_PATH = str(tmp_path / 'missing.bin')
+    snapshot = get_city_snapshot()
+    assert snapshot.names() == ['Toronto']
+    mock_get_cached_city_list.assert_called_once()
+
+@patch('requests.Session.get')
+def test_get_city_snapshot_never_downloads(mock_get, settings, tmp_path):
+    settings.CITY_SNAPSHOT_PATH = str(tmp_path / 'missing.bin')
+    cache.delete('city_list')
+
+    assert len(get_city_snapshot()) == 0
+    mock_get.assert_not_called()
+
+    # A missing snapshot is not looked for again on every request
+    write_city_snapshot(CITIES, settings.CITY_SNAPSHOT_PATH)
+    assert len(get_city_snapshot()) == 0
+    reset_city_snapshot()
+    assert len(get_city_snapshot()) == 3
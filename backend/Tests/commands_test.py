@@ -6,13 +6,19 @@ import json
 import gzip
 import requests
 import logging
+from weather.city_snapshot import CitySnapshot
+
+@pytest.fixture(autouse=True)
+def snapshot_path(settings, tmp_path):
+    settings.CITY_SNAPSHOT_PATH = str(tmp_path / 'city_list.bin')
+    return settings.CITY_SNAPSHOT_PATH
 
 @pytest.mark.django_db
 def test_update_city_list_command_success():
     mock_city_data = [{'name': 'CityA'}, {'name': 'CityB'}]
     gzipped_mock_data = gzip.compress(json.dumps(mock_city_data).encode('utf-8'))
 
-    with patch('requests.get') as mock_requests_get:
+    with patch('requests.Session.get') as mock_requests_get:
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.content = gzipped_mock_data
@@ -25,7 +31,8 @@ def test_update_city_list_command_success():
         call_command('update_city_list')
 
         # Assert that requests.get was called
-        mock_requests_get.assert_called_once_with("https://bulk.openweathermap.org/sample/city.list.json.gz")
+        mock_requests_get.assert_called_once()
+        assert mock_requests_get.call_args.args[0] == "https://bulk.openweathermap.org/sample/city.list.json.gz"
 
         # Assert that the city list is now in cache
         cached_cities = cache.get('city_list')
@@ -33,7 +40,7 @@ def test_update_city_list_command_success():
 
 @pytest.mark.django_db
 def test_update_city_list_command_failure_requests_exception():
-    with patch('requests.get') as mock_requests_get, \
+    with patch('requests.Session.get') as mock_requests_get, \
          patch('weather.management.commands.update_city_list.logger') as mock_logger:
         mock_requests_get.side_effect = requests.RequestException("Network error")
 
@@ -52,3 +59,134 @@ def test_update_city_list_command_failure_requests_exception():
         mock_logger.error.assert_called_once_with(
             "Failed to fetch or process new city list: Network error"
         )
+
+@pytest.mark.django_db
+def test_update_city_list_command_writes_snapshot(snapshot_path):
+    mock_city_data = [
+        {'id': 6167865, 'name': 'Toronto', 'country': 'CA', 'coord': {'lon': -79.416298, 'lat': 43.700111}},
+        {'id': 2988507, 'name': 'Paris', 'country': 'FR', 'coord': {'lon': 2.3488, 'lat': 48.853409}},
+    ]
+
+    with patch('requests.Session.get') as mock_requests_get:
+        mock_response = MagicMock()
+        mock_response.content = gzip.compress(json.dumps(mock_city_data).encode('utf-8'))
+        mock_requests_get.return_value = mock_response
+
+        call_command('update_city_list')
+
+    snapshot = CitySnapshot.open(snapshot_path)
+    assert len(snapshot) == 2
+    assert snapshot.names() == ['Toronto', 'Paris']
+    assert snapshot.city(0)['id'] == 6167865
+    assert snapshot.city(0)['country'] == 'CA'
+
+WARM_WEATHER = {'cod': 200, 'name': 'Toronto', 'main': {'temp': 270, 'feels_like': 265, 'humidity': 80},
+                'weather': [{'description': 'snow'}], 'wind': {'speed': 3}, 'timezone': 0, 'sys': {}}
+
+def warm_upstream(url, **kwargs):
+    if '/group?' in url:
+        ids = url.split('id=')[1].split('&')[0].split(',')
+        return MagicMock(status_code=200, json=MagicMock(return_value={'list': [
+            dict(WARM_WEATHER, id=int(city_id), name=f'City {city_id}') for city_id in ids
+        ]}))
+    if 'openweathermap' in url:
+        return MagicMock(status_code=200, json=MagicMock(return_value=WARM_WEATHER))
+    return MagicMock(status_code=200, json=MagicMock(return_value={}))
+
+@pytest.fixture
+def popular_cities():
+    from weather import popularity
+    from weather.locations import WeatherLocation
+    cache.clear()
+    popularity.reset()
+    locations = [
+        WeatherLocation('city:1', 'City 1', 'id=1', '1.0000,1.0000'),
+        WeatherLocation('city:2', 'City 2', 'id=2', '2.0000,2.0000'),
+        WeatherLocation('name:paris', 'Paris', 'q=Paris', 'Paris'),
+    ]
+    for count, location in enumerate(locations):
+        for _ in range(3 - count):
+            popularity.record(location)
+    yield locations
+    popularity.reset()
+
+@pytest.mark.django_db
+def test_warm_weather_cache_refreshes_top_cities(popular_cities):
+    from weather.payloads import get_fallback_payload, get_payload
+
+    with patch('requests.Session.get', side_effect=warm_upstream) as mock_get:
+        call_command('warm_weather_cache', '--top', '2')
+
+    assert get_payload('weather_data', 'city:1') is not None
+    assert get_payload('weather_data', 'city:2') is not None
+    assert get_payload('weather_data', 'name:paris') is None
+    # The user-location view's fallback is kept warm too
+    assert get_fallback_payload('user_location', 'city:6167865') is not None
+    called = [call.args[0] for call in mock_get.call_args_list]
+    assert sum('/group?id=1,2&' in url for url in called) == 1
+
+    # Fresh payloads are left alone until they are about to expire
+    with patch('requests.Session.get', side_effect=warm_upstream) as mock_get:
+        call_command('warm_weather_cache', '--top', '2')
+        mock_get.assert_not_called()
+        call_command('warm_weather_cache', '--top', '2', '--ahead', '1000')
+        assert mock_get.call_count == 4
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('per_minute, spent', [
+    # The fallback location first, then chunks each costing at most the whole budget
+    ('5', [1, 5]),
+    ('2', [1, 2, 2, 2]),
+    # A location costing more than the budget is still charged what it costs
+    ('1', [1, 2, 2, 2]),
+])
+def test_warm_weather_cache_respects_call_budget(popular_cities, per_minute, spent):
+    with patch('requests.Session.get', side_effect=warm_upstream) as mock_get, \
+         patch('weather.management.commands.warm_weather_cache.CallBudget.spend') as mock_spend:
+        call_command('warm_weather_cache', '--calls-per-minute', per_minute)
+
+    assert [call.args[0] for call in mock_spend.call_args_list] == spent
+    assert mock_get.call_count == sum(spent)
+
+def test_call_budget_waits_for_tokens():
+    from weather.management.commands.warm_weather_cache import CallBudget
+
+    now = [0.0]
+    slept = []
+    def sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+
+    budget = CallBudget(60, clock=lambda: now[0], sleep=sleep)
+    budget.spend(60)
+    assert slept == []
+    budget.spend(30)
+    assert sum(slept) == pytest.approx(30)
+
+    # More than a full bucket waits for a full one, and the overdraft delays the next spend
+    slept.clear()
+    budget.spend(90)
+    assert sum(slept) == pytest.approx(60)
+    budget.spend(30)
+    assert sum(slept) == pytest.approx(60 + 60)
+
+def test_load_ip_ranges_command(settings, tmp_path):
+    from weather.ip_ranges import IPRangeTable
+
+    csv_path = tmp_path / 'dbip-city-lite.csv.gz'
+    csv_path.write_bytes(gzip.compress(
+        b'1.0.4.0,1.0.7.255,OC,AU,Victoria,Melbourne,-37.814,144.963\n'
+        b'2001:200::,2001:200::ffff,AS,JP,Tokyo,Tokyo,35.6895,139.692\n'
+    ))
+    settings.IP_RANGES_PATH = str(tmp_path / 'ip_ranges.bin')
+
+    call_command('load_ip_ranges', str(csv_path))
+
+    table = IPRangeTable.open(settings.IP_RANGES_PATH)
+    assert table.lookup('1.0.5.5').city == 'Melbourne'
+    assert table.lookup('2001:200::1').country == 'JP'
+
+def test_load_ip_ranges_command_missing_file(settings, tmp_path, capsys):
+    settings.IP_RANGES_PATH = str(tmp_path / 'ip_ranges.bin')
+    call_command('load_ip_ranges', str(tmp_path / 'missing.csv'))
+    assert 'Failed to build the IP range table.' in capsys.readouterr().err
@@ -0,0 +1,44 @@
+import json
+
+from weather.compact import compact_weather_payload, expand_weather_payload
+
+ICON = '//cdn.weatherapi.com/weather/64x64/day/113.png'
+NIGHT_ICON = '//cdn.weatherapi.com/weather/64x64/night/113.png'
+
+PAYLOAD = {
+    'city_name': 'Toronto',
+    'temperature': 3.2,
+    'description': 'clear sky',
+    'icon': '01d',
+    'timezone': -14400,
+    'hourly_forecast': [
+        {'time': f'{hour:02d}:00', 'temperature': float(hour), 'description': 'Clear',
+         'icon': NIGHT_ICON if hour < 6 else ICON}
+        for hour in range(24)
+    ],
+    'daily_forecast': [
+        {'date': f'2025-11-2{day}', 'maxtemp': 5.0, 'mintemp': -1.0, 'condition': 'Sunny', 'icon': ICON}
+        for day in range(3)
+    ],
+}
+
+def test_compact_weather_payload_encodes_conditions_once():
+    compact = compact_weather_payload(PAYLOAD)
+
+    assert compact['format'] == 'compact'
+    assert compact['city_name'] == 'Toronto'
+    assert compact['conditions'] == ['Clear', 'Sunny']
+    assert compact['icons'] == [NIGHT_ICON, ICON]
+    assert compact['hourly_forecast']['time'][:2] == ['00:00', '01:00']
+    assert compact['hourly_forecast']['condition'] == [0] * 24
+    assert compact['hourly_forecast']['icon'] == [0] * 6 + [1] * 18
+    assert compact['daily_forecast']['condition'] == [1, 1, 1]
+    assert len(json.dumps(compact)) < len(json.dumps(PAYLOAD)) / 2
+
+def test_expand_weather_payload_round_trip():
+    assert expand_weather_payload(compact_weather_payload(PAYLOAD)) == PAYLOAD
+
+def test_compact_weather_payload_without_forecast():
+    compact = compact_weather_payload({'city_name': 'Nowhere', 'hourly_forecast': [], 'daily_forecast': []})
+    assert compact['hourly_forecast'] == {'time': [], 'temperature': [], 'condition': [], 'icon': []}
+    assert expand_weather_payload(compact)['daily_forecast'] == []
@@ -0,0 +1,91 @@
+from unittest.mock import MagicMock, patch
+
+import httpx
+import pytest
+import requests
+from asgiref.sync import async_to_sync
+
+from weather import http_client
+from weather.http_client import (
+    get_http_session, get_async_client, InstrumentedAdapter, InstrumentedTransport, DEFAULT_TIMEOUT
+)
+
+def ok_response(request, **kwargs):
+    response = requests.Response()
+    response.status_code = 200
+    response.request = request
+    response.url = request.url
+    return response
+
+@pytest.fixture
+def reported():
+    calls = []
+    hook = lambda *args: calls.append(args)
+    http_client.add_hook(hook)
+    yield calls
+    http_client.remove_hook(hook)
+
+def test_session_pools_http_and_https():
+    session = get_http_session()
+    assert session is get_http_session()
+    assert isinstance(session.get_adapter('http://api.openweathermap.org/'), InstrumentedAdapter)
+    assert session.get_adapter('http://api.openweathermap.org/') is session.get_adapter('https://newsapi.org/')
+
+def test_session_sizes_pools_per_host(monkeypatch):
+    monkeypatch.setattr(http_client, '_session', None)
+    monkeypatch.setattr(http_client, 'POOL_MAXSIZE_BY_HOST', {'tile.openweathermap.org': 64})
+    session = get_http_session()
+    tiles = session.get_adapter('https://tile.openweathermap.org/map/clouds_new/1/0/0.png')
+    assert tiles._pool_maxsize == 64
+    assert tiles is session.get_adapter('http://tile.openweathermap.org/map/clouds_new/1/0/0.png')
+    assert session.get_adapter('https://api.openweathermap.org/')._pool_maxsize == http_client.POOL_MAXSIZE
+
+def test_parse_pool_sizes_skips_invalid_entries():
+    assert http_client.parse_pool_sizes('Tile.Example.com=64, ipapi.co=x,broken,=3') == {'tile.example.com': 64}
+
+@patch('requests.adapters.HTTPAdapter.send')
+def test_default_timeout_is_applied(mock_send, reported):
+    mock_send.side_effect = ok_response
+    get_http_session().get('http://api.openweathermap.org/data')
+
+    assert mock_send.call_args.kwargs['timeout'] == DEFAULT_TIMEOUT
+    method, url, status_code, elapsed, error = reported[-1]
+    assert (method, url, status_code, error) == ('GET', 'http://api.openweathermap.org/data', 200, None)
+    assert elapsed >= 0
+
+@patch('requests.adapters.HTTPAdapter.send')
+def test_explicit_timeout_is_kept(mock_send):
+    mock_send.side_effect = ok_response
+    get_http_session().get('http://api.openweathermap.org/data', timeout=2)
+    assert mock_send.call_args.kwargs['timeout'] == 2
+
+@patch('requests.adapters.HTTPAdapter.send', side_effect=requests.ConnectionError('refused'))
+def test_errors_are_reported(mock_send, reported):
+    with pytest.raises(requests.ConnectionError):
+        get_http_session().get('https://newsapi.org/v2/everything')
+    _, _, status_code, _, error = reported[-1]
+    assert status_code is None
+    assert isinstance(error, requests.ConnectionError)
+
+def test_failing_hook_does_not_break_requests(reported):
+    http_client.add_hook(MagicMock(side_effect=RuntimeError('broken hook')))
+    try:
+        http_client.report('GET', 'http://upstream/', 200, 0.1)
+    finally:
+        http_client._hooks.pop()
+    assert reported[-1][2] == 200
+
+def test_async_transport_reports_requests(reported):
+    async def fetch():
+        transport = InstrumentedTransport(httpx.MockTransport(lambda request: httpx.Response(204)))
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await client.get('https://ipapi.co/1.2.3.4/json/')
+
+    assert async_to_sync(fetch)().status_code == 204
+    assert reported[-1][2] == 204
+
+def test_async_client_reused_within_loop():
+    async def get_twice():
+        return get_async_client() is get_async_client()
+
+    assert async_to_sync(get_twice)()
@@ -0,0 +1,79 @@
+import pytest
+from ipaddress import ip_address
+from django.test import RequestFactory
+
+from weather.ip_ranges import (
+    IPRangeTable, aget_ip_table, client_ip, get_ip_table, read_dbip_csv, reset_ip_table, write_ip_ranges
+)
+
+CSV = '''1.0.0.0,1.0.0.255,OC,AU,Queensland,South Brisbane,-27.4748,153.017
+1.0.4.0,1.0.7.255,OC,AU,Victoria,Melbourne,-37.814,144.963
+2.16.0.0,2.16.0.255,EU,FR,Ile-de-France,Paris,48.8534,2.3488
+2001:200::,2001:200:ffff:ffff:ffff:ffff:ffff:ffff,AS,JP,Tokyo,Tokyo,35.6895,139.692
+not,an,address,row
+'''
+
+@pytest.fixture
+def table():
+    return IPRangeTable.from_rows(read_dbip_csv(CSV.splitlines()))
+
+@pytest.fixture(autouse=True)
+def fresh_table():
+    reset_ip_table()
+    yield
+    reset_ip_table()
+
+def test_lookup(table):
+    assert len(table) == 4
+    assert table.lookup('1.0.0.1').city == 'South Brisbane'
+    assert table.lookup('1.0.5.9') == table.lookup('1.0.7.255')
+    assert table.lookup('2.16.0.200').country == 'FR'
+    assert table.lookup('2.16.0.200').lat == pytest.approx(48.8534, abs=1e-4)
+    assert table.lookup('2001:200::1').city == 'Tokyo'
+    assert table.lookup('::ffff:1.0.4.1').city == 'Melbourne'
+
+def test_lookup_outside_ranges(table):
+    # Before the first range, in a gap, after the last and not an address
+    assert table.lookup('0.255.255.255') is None
+    assert table.lookup('1.0.1.0') is None
+    assert table.lookup('203.0.113.9') is None
+    assert table.lookup('2002::1') is None
+    assert table.lookup('unknown') is None
+
+def test_table_file(settings, tmp_path):
+    settings.IP_RANGES_PATH = str(tmp_path / 'ip_ranges.bin')
+    assert get_ip_table() is None
+
+    write_ip_ranges(read_dbip_csv(CSV.splitlines()), settings.IP_RANGES_PATH)
+    # A missing table is not looked for again on every request
+    assert get_ip_table() is None
+    reset_ip_table()
+    assert get_ip_table().lookup('2.16.0.1').city == 'Paris'
+
+def test_aget_ip_table(settings, tmp_path):
+    from asgiref.sync import async_to_sync
+
+    settings.IP_RANGES_PATH = str(tmp_path / 'ip_ranges.bin')
+    write_ip_ranges(read_dbip_csv(CSV.splitlines()), settings.IP_RANGES_PATH)
+    table = async_to_sync(aget_ip_table)()
+    assert table.lookup('1.0.0.1').city == 'South Brisbane'
+    assert async_to_sync(aget_ip_table)() is table
+
+def test_client_ip(settings):
+    rf = RequestFactory()
+    settings.TRUSTED_PROXY_HOPS = 0
+    assert client_ip(rf.get('/', REMOTE_ADDR='8.8.8.8')) == '8.8.8.8'
+    # Without trusted proxies the header is the client's own claim
+    assert client_ip(rf.get('/', REMOTE_ADDR='8.8.8.8', HTTP_X_FORWARDED_FOR='1.0.4.1')) == '8.8.8.8'
+
+    settings.TRUSTED_PROXY_HOPS = 1
+    assert client_ip(rf.get('/', REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='192.168.1.4, 1.0.4.1')) == '1.0.4.1'
+    # Entries left of the ones the proxies appended are forgeable
+    assert client_ip(rf.get('/', REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='9.9.9.9, 1.0.4.1')) == '1.0.4.1'
+    assert client_ip(rf.get('/', REMOTE_ADDR='127.0.0.1', HTTP_X_FORWARDED_FOR='garbage')) is None
+    assert client_ip(rf.get('/', REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='192.168.1.4')) is None
+
+    settings.TRUSTED_PROXY_HOPS = 2
+    assert client_ip(rf.get('/', REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='9.9.9.9, 1.0.4.1, 10.0.0.1')) == '1.0.4.1'
+    # A request that skipped the outer proxy has too few entries
+    assert client_ip(rf.get('/', REMOTE_ADDR='8.8.8.8', HTTP_X_FORWARDED_FOR='1.0.4.1')) == '8.8.8.8'
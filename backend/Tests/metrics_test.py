@@ -0,0 +1,35 @@
+import pytest
+from unittest.mock import patch
+from weather import metrics
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+def test_incr_buffers_locally_until_flush():
+    metrics.incr('cache.get_news.hit')
+    metrics.incr('cache.get_news.hit', 2)
+    assert metrics.snapshot() == {'cache.get_news.hit': 3}
+
+@patch('weather.metrics.FLUSH_INTERVAL', 0)
+def test_incr_flushes_after_interval():
+    metrics.incr('cache.get_news.miss')
+    assert not metrics._counts
+    assert metrics.snapshot() == {'cache.get_news.miss': 1}
+
+def test_failed_flush_keeps_counts():
+    metrics.incr('cache.get_news.hit')
+    with patch('weather.metrics.get_redis_connection', side_effect=ConnectionError('down')):
+        metrics.flush()
+    assert metrics._counts['cache.get_news.hit'] == 1
+
+@patch('weather.metrics.FLUSH_INTERVAL', 0)
+def test_incr_flushes_off_the_calling_thread():
+    import threading
+    flushed_on = []
+    with patch('weather.metrics._flush', side_effect=lambda pending: flushed_on.append(threading.current_thread())):
+        metrics.incr('cache.get_news.miss')
+        metrics.flush()
+    assert flushed_on and flushed_on[0] is not threading.current_thread()
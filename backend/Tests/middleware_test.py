@@ -41,3 +41,24 @@ def test_exception_handling_middleware_unhandled_exception():
     assert isinstance(response, JsonResponse)
     assert response.status_code == 500
     assert json.loads(response.content)['message'] == "A server error occurred."
+
+def test_exception_handling_middleware_async_call():
+    from asgiref.sync import async_to_sync, iscoroutinefunction
+
+    async def get_response(request):
+        return HttpResponse("Success")
+
+    middleware = ExceptionHandlingMiddleware(get_response)
+    assert iscoroutinefunction(middleware)
+    response = async_to_sync(middleware)(MagicMock())
+    assert response.status_code == 200
+    assert response.content == b"Success"
+
+def test_asgi_handler_does_not_adapt_the_middleware(caplog, settings):
+    from django.core.handlers.asgi import ASGIHandler
+
+    settings.DEBUG = True # Django only logs the adaptations in debug mode
+    with caplog.at_level('DEBUG', logger='django.request'):
+        ASGIHandler().load_middleware(is_async=True)
+    # A sync-only middleware would have the async views below it run in a thread
+    assert not [record for record in caplog.records if 'adapted for middleware' in record.getMessage()]
@@ -0,0 +1,52 @@
+import random
+from unittest.mock import patch
+
+from weather.city_snapshot import CitySnapshot
+from weather.nearest_city import NearestCityIndex, distance_km, get_nearest_city_index, reset_nearest_city_index
+
+CITIES = [
+    {'id': 6167865, 'name': 'Toronto', 'country': 'CA', 'coord': {'lon': -79.416298, 'lat': 43.700111}},
+    {'id': 5913490, 'name': 'Calgary', 'country': 'CA', 'coord': {'lon': -114.085289, 'lat': 51.050110}},
+    {'id': 2988507, 'name': 'Paris', 'country': 'FR', 'coord': {'lon': 2.3488, 'lat': 48.853409}},
+    {'id': 4032243, 'name': 'Suva', 'country': 'FJ', 'coord': {'lon': 178.441498, 'lat': -18.141600}},
+    {'id': 1, 'name': 'No coordinates', 'country': '', 'coord': {}},
+]
+
+def nearest_name(index, lat, lon):
+    position, _ = index.nearest(lat, lon)
+    return index.snapshot.name(position)
+
+def test_nearest_city():
+    index = NearestCityIndex(CitySnapshot.from_city_list(CITIES))
+
+    assert len(index) == 4
+    assert nearest_name(index, 43.65, -79.38) == 'Toronto'
+    assert nearest_name(index, 45.5, -73.6) == 'Toronto' # Montreal, several cells away
+    assert nearest_name(index, 50.0, 5.0) == 'Paris'
+    assert nearest_name(index, 0.0, 0.0) == 'Paris'
+    # Across the antimeridian from Suva
+    assert nearest_name(index, -18.0, -179.5) == 'Suva'
+
+def test_nearest_city_matches_brute_force():
+    rng = random.Random(7)
+    cities = [
+        {'id': i, 'name': f'City{i}', 'country': 'XX',
+         'coord': {'lat': rng.uniform(-70, 70), 'lon': rng.uniform(-180, 180)}}
+        for i in range(1, 2001)
+    ]
+    snapshot = CitySnapshot.from_city_list(cities)
+    index = NearestCityIndex(snapshot)
+
+    for _ in range(200):
+        lat, lon = rng.uniform(-89, 89), rng.uniform(-180, 180)
+        expected = min(range(len(snapshot)), key=lambda p: distance_km(lat, lon, snapshot.lats[p], snapshot.lons[p]))
+        position, distance = index.nearest(lat, lon)
+        assert distance == distance_km(lat, lon, snapshot.lats[expected], snapshot.lons[expected])
+
+def test_empty_index_is_rebuilt():
+    reset_nearest_city_index()
+    with patch('weather.nearest_city.get_city_snapshot', return_value=CitySnapshot.from_city_list([])):
+        assert get_nearest_city_index().nearest(43.7, -79.4) is None
+    with patch('weather.nearest_city.get_city_snapshot', return_value=CitySnapshot.from_city_list(CITIES)):
+        assert len(get_nearest_city_index()) == 4
+    reset_nearest_city_index()
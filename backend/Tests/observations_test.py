@@ -0,0 +1,166 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+from asgiref.sync import async_to_sync
+from unittest.mock import patch, MagicMock
+from django.core.cache import cache
+from django.test import RequestFactory
+
+from weather import views
+from weather.city_snapshot import CitySnapshot
+from weather.custom_exceptions import NotFound, ServiceUnavailable
+from weather.locations import WeatherLocation, coordinate_location, resolve_weather_location
+from weather.observations import aget_current, get_current, get_forecast, current_key
+from weather.utils import CacheEntry
+
+TORONTO = WeatherLocation('city:6167865', 'Toronto', 'id=6167865', '43.7001,-79.4163')
+CURRENT = {
+    'cod': 200, 'id': 6167865, 'name': 'Toronto', 'timezone': -14400, 'sys': {},
+    'main': {'temp': 280, 'feels_like': 275, 'humidity': 80},
+    'weather': [{'description': 'clear sky'}], 'wind': {'speed': 4},
+}
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+@pytest.fixture(autouse=True)
+def city_snapshot():
+    snapshot = CitySnapshot.from_city_list([
+        {'id': 6167865, 'name': 'Toronto', 'country': 'CA', 'coord': {'lon': -79.416298, 'lat': 43.700111}},
+    ])
+    with patch('weather.locations.get_city_snapshot', return_value=snapshot):
+        yield
+
+def upstream(url, **kwargs):
+    if 'openweathermap' in url:
+        if 'q=Atlantis' in url:
+            return MagicMock(status_code=404)
+        return MagicMock(status_code=200, json=MagicMock(return_value=CURRENT))
+    return MagicMock(status_code=200, json=MagicMock(return_value={'forecast': {'forecastday': []}}))
+
+def test_one_fetch_serves_every_endpoint():
+    request = RequestFactory().get('/get_weather_data/', {'city_name': 'Toronto'})
+    with patch('requests.Session.get', side_effect=upstream) as mock_get:
+        assert views.get_weather_data(request).status_code == 200
+        calls = mock_get.call_count
+
+        # The user-location summary is built from the same entry
+        payload = views.store_location_payload(resolve_weather_location('toronto'))
+        assert json.loads(payload.body)['city_name'] == 'Toronto'
+        assert mock_get.call_count == calls
+
+def test_coordinate_lookup_fills_city_entry():
+    with patch('requests.Session.get', side_effect=upstream) as mock_get:
+        assert get_current(coordinate_location(43.7, -79.42)) == CURRENT
+        assert get_current(TORONTO) == CURRENT
+        assert get_current(coordinate_location(43.7, -79.42)) == CURRENT
+
+    assert mock_get.call_count == 1
+    assert 'lat=43.7050&lon=-79.4150' in mock_get.call_args.args[0]
+
+def test_nearby_coordinates_share_a_grid_cell():
+    with patch('requests.Session.get', side_effect=upstream) as mock_get:
+        assert get_current(coordinate_location(43.7012, -79.4188)) == CURRENT
+        assert get_current(coordinate_location(43.7049, -79.4101)) == CURRENT
+        # Just across the cell boundary
+        get_current(coordinate_location(43.7101, -79.4188))
+
+    assert mock_get.call_count == 2
+    assert coordinate_location(43.7012, -79.4188, grid=0).key == 'coord:43.7012,-79.4188'
+
+def test_unknown_location_is_remembered():
+    atlantis = WeatherLocation('name:atlantis', 'Atlantis', 'q=Atlantis', 'Atlantis')
+    with patch('requests.Session.get', side_effect=upstream) as mock_get:
+        for _ in range(2):
+            with pytest.raises(NotFound):
+                get_current(atlantis)
+
+    assert mock_get.call_count == 1
+
+def test_refresh_skips_cached_entries():
+    cache.set(current_key(TORONTO.key), {'stale': True})
+    with patch('requests.Session.get', side_effect=upstream) as mock_get:
+        assert get_current(TORONTO) == {'stale': True}
+        assert get_current(TORONTO, refresh=True) == CURRENT
+        get_forecast(TORONTO)
+        get_forecast(TORONTO)
+
+    assert mock_get.call_count == 2
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+def slow_upstream(url, **kwargs):
+    time.sleep(0.3)
+    return upstream(url, **kwargs)
+
+def test_stale_observation_is_served_while_refreshing():
+    cache.set(current_key(TORONTO.key), CacheEntry({'stale': True}, time.time() - 1), 600)
+    with patch('requests.Session.get', side_effect=slow_upstream) as mock_get:
+        start = time.monotonic()
+        assert get_current(TORONTO) == {'stale': True}
+        assert get_current(TORONTO) == {'stale': True}
+        assert time.monotonic() - start < 0.3
+
+        # One background refresh replaces the stale entry
+        assert wait_for(lambda: cache.get(current_key(TORONTO.key)).value == CURRENT)
+    assert mock_get.call_count == 1
+
+def test_missing_observation_is_fetched_once():
+    with patch('requests.Session.get', side_effect=slow_upstream) as mock_get:
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(lambda _: get_current(TORONTO), range(5)))
+
+    assert results == [CURRENT] * 5
+    assert mock_get.call_count == 1
+
+def test_failed_fetch_is_shared_with_waiters():
+    callers = set()
+
+    def failing_upstream(url, **kwargs):
+        callers.add(threading.get_ident())
+        time.sleep(0.3)
+        raise requests.ConnectionError('down')
+
+    def fetch(_):
+        try:
+            return get_current(TORONTO)
+        except ServiceUnavailable as e:
+            return e
+
+    with patch('requests.Session.get', side_effect=failing_upstream):
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(fetch, range(5)))
+
+    assert all(isinstance(result, ServiceUnavailable) for result in results)
+    # Only the lock holder called the upstream
+    assert len(callers) == 1
+
+def test_async_missing_observation_is_fetched_once():
+    calls = []
+
+    async def afetch_upstream(url, deadline=None):
+        calls.append(url)
+        await asyncio.sleep(0.3)
+        return upstream(url)
+
+    async def fetch_together():
+        return await asyncio.gather(*(aget_current(TORONTO) for _ in range(3)))
+
+    with patch('weather.observations.afetch_upstream', afetch_upstream):
+        assert async_to_sync(fetch_together)() == [CURRENT] * 3
+
+        # A stale entry is served while a background task refreshes it
+        cache.set(current_key(TORONTO.key), CacheEntry({'stale': True}, time.time() - 1), 600)
+        assert async_to_sync(aget_current)(TORONTO) == {'stale': True}
+
+    assert len(calls) == 2
@@ -0,0 +1,73 @@
+import gzip
+import pytest
+from unittest.mock import patch, MagicMock
+from django.test import RequestFactory
+
+from weather import payloads
+from weather.payloads import (
+    EncodedPayload, encode_payload, accepted_encodings, payload_response, store_payload, get_payload
+)
+
+DATA = {'news': [{'title': f'Storm warning {i}', 'description': 'Heavy rain expected'} for i in range(20)]}
+
+@pytest.fixture
+def rf():
+    return RequestFactory()
+
+def test_encode_payload_compresses_once():
+    payload = encode_payload(DATA, 60)
+    assert gzip.decompress(payload.gzip) == payload.body
+    assert len(payload.gzip) < len(payload.body)
+
+def test_encode_payload_skips_small_bodies():
+    payload = encode_payload({'news': []}, 60)
+    assert payload.gzip is None
+    assert payload.br is None
+
+def test_encode_payload_with_brotli():
+    fake_brotli = MagicMock()
+    fake_brotli.compress.return_value = b'br'
+    with patch.object(payloads, 'brotli', fake_brotli):
+        assert encode_payload(DATA, 60).br == b'br'
+
+def test_old_cached_payloads_still_load():
+    payload = EncodedPayload(b'{}', '"abc"', 0)
+    assert payload.gzip is None and payload.br is None
+
+def test_accepted_encodings():
+    assert accepted_encodings('gzip, deflate, br') == {'gzip', 'deflate', 'br'}
+    assert accepted_encodings('gzip;q=0, br;q=0.5') == {'br'}
+    assert accepted_encodings('*;q=0.1, gzip;q=0') == {'*', 'br'}
+    assert accepted_encodings('') == set()
+
+def test_payload_response_negotiates_encoding(rf):
+    payload = encode_payload(DATA, 60)._replace(br=b'brotli bytes')
+
+    response = payload_response(rf.get('/', HTTP_ACCEPT_ENCODING='gzip, br'), payload)
+    assert response['Content-Encoding'] == 'br'
+    assert response.content == b'brotli bytes'
+    assert response['ETag'] == payload.etag[:-1] + '-br"'
+
+    response = payload_response(rf.get('/', HTTP_ACCEPT_ENCODING='gzip'), payload)
+    assert response['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.content) == payload.body
+
+    response = payload_response(rf.get('/'), payload)
+    assert not response.has_header('Content-Encoding')
+    assert response.content == payload.body
+    assert response['ETag'] == payload.etag
+    assert 'Accept-Encoding' in response['Vary']
+
+def test_payload_response_revalidates_any_variant(rf):
+    payload = encode_payload(DATA, 60)
+    gzip_etag = payload.etag[:-1] + '-gzip"'
+
+    response = payload_response(rf.get('/', HTTP_IF_NONE_MATCH=gzip_etag), payload)
+    assert response.status_code == 304
+    assert response['ETag'] == payload.etag
+
+@pytest.mark.django_db
+def test_stored_payload_keeps_compressed_variant():
+    stored = store_payload('news', ('storm',), DATA, 60)
+    cached = get_payload('news', 'storm')
+    assert cached.gzip == stored.gzip
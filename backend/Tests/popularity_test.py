@@ -0,0 +1,60 @@
+import pytest
+from unittest.mock import patch
+
+from weather import popularity
+from weather.locations import WeatherLocation
+
+TORONTO = WeatherLocation('city:6167865', 'Toronto', 'id=6167865', '43.7001,-79.4163')
+PARIS = WeatherLocation('name:paris', 'Paris', 'q=Paris', 'Paris')
+
+@pytest.fixture(autouse=True)
+def fresh_popularity():
+    popularity.reset()
+    yield
+    popularity.reset()
+
+def test_top_ranks_by_request_count():
+    for _ in range(3):
+        popularity.record(PARIS)
+    popularity.record(TORONTO)
+
+    assert [WeatherLocation(*fields) for fields in popularity.top(2)] == [PARIS, TORONTO]
+    assert popularity.top(1) == [list(PARIS)]
+
+def test_older_requests_count_less():
+    with patch('weather.popularity.time.time', return_value=1_000_000):
+        popularity.record(PARIS)
+        popularity.record(PARIS)
+        popularity.flush()
+    # Two half-lives later one new request outweighs the two old ones
+    with patch('weather.popularity.time.time', return_value=1_000_000 + 2 * popularity.HALF_LIFE):
+        popularity.record(TORONTO)
+        scores = popularity.scores()
+
+    assert scores['name:paris'] == pytest.approx(0.5)
+    assert scores['city:6167865'] == pytest.approx(1)
+    assert popularity.top(1) == [list(TORONTO)]
+
+def test_scores_are_rescaled():
+    with patch('weather.popularity.time.time', return_value=1_000_000):
+        popularity.record(PARIS)
+        popularity.flush()
+    later = 1_000_000 + (popularity.RESCALE_AFTER + 1) * popularity.HALF_LIFE
+    with patch('weather.popularity.time.time', return_value=later):
+        popularity.record(TORONTO)
+        popularity.flush()
+        scores = popularity.scores()
+
+    assert float(popularity.get_redis_connection('default').get(popularity.EPOCH_KEY)) == later
+    assert scores['city:6167865'] == pytest.approx(1)
+    assert scores['name:paris'] == pytest.approx(2 ** -(popularity.RESCALE_AFTER + 1))
+
+def test_only_tracked_cities_are_kept(monkeypatch):
+    monkeypatch.setattr(popularity, 'MAX_TRACKED', 1)
+    popularity.record(PARIS)
+    popularity.record(PARIS)
+    popularity.record(TORONTO)
+
+    assert popularity.top(10) == [list(PARIS)]
+    connection = popularity.get_redis_connection('default')
+    assert connection.hkeys(popularity.LOCATIONS_KEY) == [b'name:paris']
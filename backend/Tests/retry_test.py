@@ -0,0 +1,115 @@
+import time
+from unittest.mock import MagicMock, patch
+
+import httpx
+import pytest
+import requests
+from asgiref.sync import async_to_sync
+
+from weather.retry import RetryPolicy, DeadlineExceeded
+from weather.circuit_breaker import get_breaker
+
+@pytest.fixture(autouse=True)
+def closed_breaker():
+    get_breaker('http://upstream/').reset()
+    yield
+    get_breaker('http://upstream/').reset()
+
+def policy(**kwargs):
+    options = {'attempts': 3, 'deadline': 2, 'attempt_timeout': 1, 'backoff': 0.01, 'max_backoff': 0.02}
+    options.update(kwargs)
+    return RetryPolicy(**options)
+
+@patch('requests.Session.get')
+def test_retries_gateway_errors_then_succeeds(mock_get):
+    mock_get.side_effect = [MagicMock(status_code=503), MagicMock(status_code=200)]
+    assert policy().get('http://upstream/').status_code == 200
+    assert mock_get.call_count == 2
+
+@patch('requests.Session.get')
+def test_does_not_retry_client_errors(mock_get):
+    mock_get.return_value = MagicMock(status_code=404)
+    assert policy().get('http://upstream/').status_code == 404
+    assert mock_get.call_count == 1
+
+@patch('requests.Session.get')
+def test_returns_last_response_when_attempts_run_out(mock_get):
+    mock_get.return_value = MagicMock(status_code=502)
+    assert policy().get('http://upstream/').status_code == 502
+    assert mock_get.call_count == 3
+
+@patch('requests.Session.get')
+def test_raises_connection_errors_after_last_attempt(mock_get):
+    mock_get.side_effect = requests.ConnectionError('refused')
+    with pytest.raises(requests.ConnectionError):
+        policy().get('http://upstream/')
+    assert mock_get.call_count == 3
+
+@patch('requests.Session.get')
+def test_does_not_retry_other_request_errors(mock_get):
+    mock_get.side_effect = requests.exceptions.InvalidURL('bad url')
+    with pytest.raises(requests.exceptions.InvalidURL):
+        policy().get('http://upstream/')
+    assert mock_get.call_count == 1
+
+@patch('requests.Session.post')
+def test_does_not_retry_non_idempotent_requests(mock_post):
+    mock_post.side_effect = requests.ConnectionError('refused')
+    with pytest.raises(requests.ConnectionError):
+        policy().request('POST', 'http://upstream/')
+    assert mock_post.call_count == 1
+
+@patch('requests.Session.get')
+def test_attempt_timeout_is_capped_by_deadline(mock_get):
+    mock_get.return_value = MagicMock(status_code=200)
+    policy(attempt_timeout=10).get('http://upstream/', deadline=time.monotonic() + 0.5)
+    assert mock_get.call_args.kwargs['timeout'] <= 0.5
+
+@patch('requests.Session.get')
+def test_deadline_bounds_total_time(mock_get):
+    def slow_failure(url, timeout):
+        time.sleep(0.15)
+        raise requests.Timeout('timed out')
+
+    mock_get.side_effect = slow_failure
+    start = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        policy(attempts=10, deadline=0.4).get('http://upstream/')
+    assert time.monotonic() - start < 0.6
+    assert mock_get.call_count < 10
+
+def test_expired_deadline_raises_without_calling():
+    with patch('requests.Session.get') as mock_get:
+        with pytest.raises(DeadlineExceeded):
+            policy().get('http://upstream/', deadline=time.monotonic())
+    mock_get.assert_not_called()
+
+def test_async_retries_gateway_errors():
+    statuses = [503, 200]
+
+    def handler(request):
+        return httpx.Response(statuses.pop(0))
+
+    async def fetch():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await policy().aget(client, 'http://upstream/')
+
+    assert async_to_sync(fetch)().status_code == 200
+    assert statuses == []
+
+def test_async_breaker_calls_do_not_queue_on_the_sync_thread():
+    from asgiref.sync import sync_to_async
+    modes = []
+
+    def recording_sync_to_async(func, thread_sensitive=True):
+        modes.append(thread_sensitive)
+        return sync_to_async(func, thread_sensitive=thread_sensitive)
+
+    async def fetch():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(503))) as client:
+            return await policy().aget(client, 'http://upstream/')
+
+    with patch('weather.retry.sync_to_async', side_effect=recording_sync_to_async):
+        async_to_sync(fetch)()
+    # Breaker checks and records share no state with the requests' ORM work
+    assert modes and not any(modes)
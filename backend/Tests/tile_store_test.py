@@ -0,0 +1,97 @@
+import os
+import time
+
+import pytest
+
+from weather.tile_store import TileStore, RESCAN_INTERVAL, TOUCH_INTERVAL, tile_etag
+
+@pytest.fixture
+def store(tmp_path):
+    return TileStore(str(tmp_path), max_bytes=1000, timeout=3600)
+
+def age(path, seconds, accessed=None):
+    modified = time.time() - seconds
+    os.utime(path, (time.time() - (accessed if accessed is not None else seconds), modified))
+
+def test_put_and_get_round_trip(store, tmp_path):
+    store.put('temp_new', 2, 1, 3, b'png-bytes')
+    tile = store.get('temp_new', 2, 1, 3)
+
+    assert tile.path == str(tmp_path / 'temp_new' / '2' / '1' / '3.png')
+    assert tile.read() == b'png-bytes'
+    assert tile.size == len(b'png-bytes')
+
+def test_get_missing_tile(store):
+    assert store.get('temp_new', 2, 1, 3) is None
+
+def test_expired_tile_is_a_miss(store):
+    store.put('temp_new', 2, 1, 3, b'png-bytes')
+    age(store.path('temp_new', 2, 1, 3), 3601)
+    assert store.get('temp_new', 2, 1, 3) is None
+
+def test_etag_changes_when_tile_is_replaced(store):
+    store.put('temp_new', 2, 1, 3, b'old')
+    age(store.path('temp_new', 2, 1, 3), 10)
+    old_etag = store.get('temp_new', 2, 1, 3).etag
+
+    store.put('temp_new', 2, 1, 3, b'new')
+    assert store.get('temp_new', 2, 1, 3).etag != old_etag
+
+def test_etag_is_known_before_the_tile_is_stored(store):
+    modified_ns = time.time_ns()
+    store.put('temp_new', 2, 1, 3, b'png-bytes', modified_ns)
+    assert store.get('temp_new', 2, 1, 3).etag == tile_etag('temp_new', 2, 1, 3, modified_ns)
+
+def test_etag_survives_access_time_updates(store):
+    store.put('temp_new', 2, 1, 3, b'png-bytes')
+    path = store.path('temp_new', 2, 1, 3)
+    age(path, 10, accessed=TOUCH_INTERVAL + 1)
+    etag = store.get('temp_new', 2, 1, 3).etag
+
+    assert store.get('temp_new', 2, 1, 3).etag == etag
+    assert time.time() - os.stat(path).st_atime < TOUCH_INTERVAL
+
+def test_put_leaves_no_temporary_files(store, tmp_path):
+    store.put('temp_new', 2, 1, 3, b'png-bytes')
+    assert os.listdir(tmp_path / 'temp_new' / '2' / '1') == ['3.png']
+
+def test_least_recently_used_tiles_are_evicted_over_budget(store):
+    for y in range(3):
+        store.put('temp_new', 2, 1, y, b'x' * 300)
+    age(store.path('temp_new', 2, 1, 0), 10, accessed=300)
+    age(store.path('temp_new', 2, 1, 1), 10, accessed=100)
+    age(store.path('temp_new', 2, 1, 2), 10, accessed=200)
+
+    store.put('temp_new', 2, 1, 3, b'x' * 300)
+
+    # 1200 bytes shrink to at most 900: only the oldest access goes
+    assert store.get('temp_new', 2, 1, 0) is None
+    assert all(store.get('temp_new', 2, 1, y) is not None for y in (1, 2, 3))
+
+def test_replacing_a_tile_does_not_count_twice(store):
+    for _ in range(5):
+        store.put('temp_new', 2, 1, 3, b'x' * 300)
+    store.put('temp_new', 2, 1, 4, b'x' * 300)
+
+    assert store.get('temp_new', 2, 1, 3) is not None
+    assert store.get('temp_new', 2, 1, 4) is not None
+
+def test_invalid_layer_is_rejected(store):
+    for layer in ('..', '../etc', 'temp/new', '', 'Temp'):
+        with pytest.raises(ValueError):
+            store.path(layer, 2, 1, 3)
+
+def test_total_is_rescanned_for_other_workers_writes(tmp_path):
+    # Two stores on one tree stand in for two worker processes
+    first = TileStore(str(tmp_path), max_bytes=1000, timeout=3600)
+    second = TileStore(str(tmp_path), max_bytes=1000, timeout=3600)
+    first.put('temp_new', 2, 1, 0, b'x' * 400)
+    second.put('temp_new', 2, 1, 1, b'x' * 400)
+    age(first.path('temp_new', 2, 1, 0), 10, accessed=100)
+    age(first.path('temp_new', 2, 1, 1), 10, accessed=50)
+
+    # Past RESCAN_INTERVAL the first store sees the second one's tile and evicts
+    first._scanned_at -= RESCAN_INTERVAL + 1
+    first.put('temp_new', 2, 1, 2, b'x' * 400)
+    assert first.get('temp_new', 2, 1, 0) is None
+    assert first._bytes <= 900
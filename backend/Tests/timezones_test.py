@@ -0,0 +1,29 @@
+import pytest
+
+from weather.timezones import get_zone_table, parse_iso6709, timezone_at
+
+@pytest.fixture(scope='module')
+def zones():
+    return get_zone_table()
+
+def test_parse_iso6709():
+    assert parse_iso6709('+4843') == pytest.approx(48 + 43 / 60)
+    assert parse_iso6709('-0790403') == pytest.approx(-(79 + 4 / 60 + 3 / 3600))
+
+def test_single_zone_country(zones):
+    assert timezone_at(zones, 48.853409, 2.3488, 'FR') == 'Europe/Paris'
+    # Anywhere in the country, however far from its principal city
+    assert timezone_at(zones, 43.296482, 5.36978, 'FR') == 'Europe/Paris'
+
+def test_nearest_zone_in_country(zones):
+    assert timezone_at(zones, 43.700111, -79.416298, 'CA') == 'America/Toronto'
+    assert timezone_at(zones, 53.550140, -113.468712, 'CA') == 'America/Edmonton'
+    assert timezone_at(zones, -37.813999, 144.963318, 'AU') == 'Australia/Melbourne'
+
+def test_uncertain_zone_is_left_to_upstream(zones):
+    # Calgary: Edmonton observes daylight saving time, nearby Creston does not
+    assert timezone_at(zones, 51.050110, -114.085289, 'CA') is None
+    # Seattle: the nearest principal city, Boise, is in another zone
+    assert timezone_at(zones, 47.606209, -122.332069, 'US') is None
+    # No country
+    assert timezone_at(zones, 0.0, 0.0) is None
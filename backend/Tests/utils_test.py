@@ -6,10 +6,13 @@ import json
 import hashlib
 import gzip
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from weather import metrics
 from weather.utils import (
-    redis_cache, kelvin_to_celsius, get_news, fetch_user_ip, 
-    get_location_from_ip, get_timezone_data, fetch_weather_by_coordinates,
-    format_weather_data, get_weather_data_for_city, get_session, get_city_list
+    redis_cache, make_cache_key, CacheEntry, kelvin_to_celsius, get_news,
+    get_location_from_ip, get_timezone_data,
+    format_weather_data, get_session, get_city_list
 )
 
 # Fixture for clearing cache before each test
@@ -37,8 +40,175 @@ def test_redis_cache_decorator():
     result2 = test_func(1, 2)
     assert result2 == 3
 
+def test_redis_cache_single_flight_computes_once():
+    calls = []
+
+    @redis_cache(timeout=60, single_flight=True)
+    def slow_func(city):
+        calls.append(city)
+        time.sleep(0.3)
+        return {'city': city}
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        results = list(executor.map(lambda _: slow_func('Toronto'), range(5)))
+
+    assert len(calls) == 1
+    assert results == [{'city': 'Toronto'}] * 5
+
+def test_redis_cache_single_flight_serves_previous_value():
+    @redis_cache(timeout=60, single_flight=True)
+    def news(query):
+        return ['fresh']
+
+    key = make_cache_key('news', ('storm',), {})
+    cache.set(f'{key}:previous', ['previous'], 60)
+    lock = cache.lock(f'{key}:lock', timeout=5)
+    assert lock.acquire(blocking=False)
+    try:
+        assert news('storm') == ['previous']
+    finally:
+        lock.release()
+
+def test_redis_cache_single_flight_holder_failure_is_shared():
+    calls = []
+
+    @redis_cache(timeout=60, single_flight=True)
+    def news(query):
+        calls.append(query)
+        time.sleep(0.3)
+        return None
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        results = list(executor.map(lambda _: news('outage'), range(5)))
+
+    # The waiters return as soon as the holder gives up, without calling the upstream themselves
+    assert results == [None] * 5
+    assert calls == ['outage']
+    assert time.monotonic() - start < 2
+
+@patch('weather.utils.LOCK_POLL_INTERVAL', 0.01)
+def test_redis_cache_single_flight_computes_after_wait():
+    @redis_cache(timeout=60, single_flight=True, lock_wait=0.1)
+    def news(query):
+        return ['fresh']
+
+    lock = cache.lock(f"{make_cache_key('news', ('flood',), {})}:lock", timeout=5)
+    assert lock.acquire(blocking=False)
+    try:
+        assert news('flood') == ['fresh']
+    finally:
+        lock.release()
+
+def test_redis_cache_stale_while_revalidate_serves_stale_value():
+    calls = []
+
+    @redis_cache(timeout=60, stale_timeout=600)
+    def forecast(city):
+        calls.append(city)
+        time.sleep(0.1)
+        return {'city': city, 'version': len(calls)}
+
+    key = make_cache_key('forecast', ('Toronto',), {})
+    cache.set(key, CacheEntry({'city': 'Toronto', 'version': 0}, time.time() - 1), 600)
+
+    start = time.monotonic()
+    assert forecast('Toronto') == {'city': 'Toronto', 'version': 0}
+    assert time.monotonic() - start < 0.1
+
+    # The background refresh replaces the stale entry
+    deadline = time.monotonic() + 2
+    while cache.get(key).value['version'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert cache.get(key).value == {'city': 'Toronto', 'version': 1}
+    assert cache.get(key).fresh_until > time.time()
+    assert calls == ['Toronto']
+
+def test_redis_cache_stale_while_revalidate_fresh_hit():
+    @redis_cache(timeout=60, stale_timeout=600)
+    def forecast(city):
+        return {'city': city}
+
+    assert forecast('Oslo') == {'city': 'Oslo'}
+    entry = cache.get(make_cache_key('forecast', ('Oslo',), {}))
+    assert isinstance(entry, CacheEntry)
+    assert forecast('Oslo') == {'city': 'Oslo'}
+
+def test_redis_cache_stale_while_revalidate_reads_plain_entries():
+    @redis_cache(timeout=60, stale_timeout=600)
+    def forecast(city):
+        return {'city': city, 'fresh': True}
+
+    cache.set(make_cache_key('forecast', ('Cairo',), {}), {'city': 'Cairo', 'fresh': False}, 60)
+    assert forecast('Cairo') == {'city': 'Cairo', 'fresh': False}
+
+def test_redis_cache_stale_while_revalidate_refreshes_once():
+    calls = []
+
+    @redis_cache(timeout=60, stale_timeout=600)
+    def forecast(city):
+        calls.append(city)
+        time.sleep(0.2)
+        return {'city': city}
+
+    cache.set(make_cache_key('forecast', ('Rome',), {}), CacheEntry({'city': 'Rome'}, time.time() - 1), 600)
+    for _ in range(5):
+        assert forecast('Rome') == {'city': 'Rome'}
+    time.sleep(0.4)
+    assert calls == ['Rome']
+
+def test_redis_cache_negative_result_cached_separately():
+    calls = []
+
+    @redis_cache(timeout=60, stale_timeout=600, negative_timeout=30)
+    def lookup(city):
+        calls.append(city)
+        return None
+
+    assert lookup('Torontoo') is None
+    assert lookup('Torontoo') is None
+    assert calls == ['Torontoo']
+
+    key = make_cache_key('lookup', ('Torontoo',), {})
+    assert cache.get(key) is None
+    assert cache.get(f'{key}:negative') is True
+    assert 0 < cache.ttl(f'{key}:negative') <= 30
+
+def test_redis_cache_negative_results_counted_in_metrics():
+    metrics.reset()
+
+    @redis_cache(timeout=60, negative_timeout=30)
+    def lookup(city):
+        return None
+
+    lookup('Nowhere')
+    lookup('Nowhere')
+    counters = metrics.snapshot()
+    assert counters['cache.lookup.miss'] == 1
+    assert counters['cache.lookup.negative_store'] == 1
+    assert counters['cache.lookup.negative_hit'] == 1
+
+def test_redis_cache_without_negative_timeout_retries_none():
+    calls = []
+
+    @redis_cache(timeout=60)
+    def lookup(city):
+        calls.append(city)
+        return None
+
+    lookup('Nowhere')
+    lookup('Nowhere')
+    assert len(calls) == 2
+
+@patch('requests.Session.get')
+def test_get_timezone_data_unknown_city_negative_cached(mock_get):
+    mock_get.return_value = MagicMock(status_code=200, json=MagicMock(return_value={}))
+    assert get_timezone_data('Atlantis') is None
+    assert get_timezone_data('Atlantis') is None
+    mock_get.assert_called_once()
+
 # Test for get_news
-@patch('weather.utils.requests.get')
+@patch('requests.Session.get')
 @patch('weather.utils.NEWS_API_KEY', 'test_news_api_key')
 def test_get_news_success(mock_get):
     mock_get.return_value = MagicMock(
@@ -51,37 +221,41 @@ def test_get_news_success(mock_get):
     assert len(news) == 1
     assert news[0]['title'] == 'Article 1'
 
-@patch('weather.utils.requests.get', side_effect=requests.RequestException)
+@patch('requests.Session.get', side_effect=requests.RequestException)
 @patch('weather.utils.NEWS_API_KEY', 'test_news_api_key')
 def test_get_news_request_exception(mock_get):
     news = get_news('test_query')
-    assert news == []
+    assert news is None
+
+@patch('weather.utils.NEWS_API_KEY', 'test_news_api_key')
+def test_get_news_failed_refresh_keeps_stale_news():
+    key = make_cache_key('get_news', ('test_query',), {})
+    cache.set(key, CacheEntry([{'title': 'Stale'}], time.time() - 1), 86400)
+
+    with patch('requests.Session.get', side_effect=requests.RequestException) as mock_get:
+        assert get_news('test_query') == [{'title': 'Stale'}]
+        deadline = time.monotonic() + 2
+        while not mock_get.called and time.monotonic() < deadline:
+            time.sleep(0.02)
+        time.sleep(0.1)
+
+    # The failure is not stored over the stale entry, which is served again
+    entry = cache.get(key)
+    assert entry.value == [{'title': 'Stale'}]
+    assert entry.fresh_until < time.time()
+    assert get_news('test_query') == [{'title': 'Stale'}]
 
 @patch('weather.utils.logger.warning')
-@patch('weather.utils.requests.get')
+@patch('requests.Session.get')
 @patch('weather.utils.NEWS_API_KEY', 'test_news_api_key')
 def test_get_news_api_key_warning(mock_get, mock_warning):
     mock_get.return_value = MagicMock(status_code=401)
     news = get_news('test_query')
-    assert news == []
+    assert news is None
     mock_warning.assert_called_with("Invalid API Key for News API.")
 
-# Tests for fetch_user_ip
-@patch('weather.utils.requests.get')
-def test_fetch_user_ip_success(mock_get):
-    mock_get.return_value = MagicMock(
-        status_code=200, json=MagicMock(return_value={'origin': '192.168.1.1'})
-    )
-    ip = fetch_user_ip()
-    assert ip == '192.168.1.1'
-
-@patch('weather.utils.requests.get', side_effect=requests.RequestException)
-def test_fetch_user_ip_exception(mock_get):
-    ip = fetch_user_ip()
-    assert ip is None
-
 # Tests for get_location_from_ip
-@patch('weather.utils.requests.get')
+@patch('requests.Session.get')
 def test_get_location_from_ip_success(mock_get):
     mock_get.return_value = MagicMock(
         status_code=200, json=MagicMock(return_value={'city': 'Paris', 'region': 'Ile-de-France', 'country_name': 'France'})
@@ -90,20 +264,20 @@ def test_get_location_from_ip_success(mock_get):
     assert location == 'Paris, Ile-de-France, France'
 
 @patch('weather.utils.logger.warning')
-@patch('weather.utils.requests.get')
+@patch('requests.Session.get')
 def test_get_location_from_ip_rate_limit(mock_get, mock_warning):
     mock_get.return_value = MagicMock(status_code=429)
     location = get_location_from_ip('192.168.1.1')
     assert location == 'Toronto, Ontario, Canada'
     mock_warning.assert_called_with("Rate limit exceeded. Falling back to default location.")
 
-@patch('weather.utils.requests.get', side_effect=requests.RequestException)
+@patch('requests.Session.get', side_effect=requests.RequestException)
 def test_get_location_from_ip_exception(mock_get):
     location = get_location_from_ip('192.168.1.1')
     assert location == 'Location Unavailable'
 
 # Tests for get_timezone_data
-@patch('weather.utils.requests.get')
+@patch('requests.Session.get')
 def test_get_timezone_data_success(mock_get):
     mock_get.return_value = MagicMock(
         status_code=200, json=MagicMock(return_value={'timezone': 'Europe/Paris'})
@@ -111,7 +285,7 @@ def test_get_timezone_data_success(mock_get):
     timezone = get_timezone_data('Paris')
     assert timezone == 'Europe/Paris'
 
-@patch('weather.utils.requests.get')
+@patch('requests.Session.get')
 def test_get_timezone_data_no_timezone_key(mock_get):
     mock_get.return_value = MagicMock(
         status_code=200, json=MagicMock(return_value={})
@@ -119,36 +293,11 @@ def test_get_timezone_data_no_timezone_key(mock_get):
     timezone = get_timezone_data('InvalidCity')
     assert timezone is None
 
-@patch('weather.utils.requests.get', side_effect=requests.RequestException)
+@patch('requests.Session.get', side_effect=requests.RequestException)
 def test_get_timezone_data_exception_handling(mock_get):
     timezone = get_timezone_data('Paris')
     assert timezone is None
 
-# Tests for fetch_weather_by_coordinates
-@patch('weather.utils.requests.get')
-@patch('weather.utils.API_KEY', 'test_api_key')
-def test_fetch_weather_by_coordinates_success(mock_get):
-    mock_get.return_value = MagicMock(
-        status_code=200, json=MagicMock(return_value={'temp': 280})
-    )
-    weather_data = fetch_weather_by_coordinates(0, 0)
-    assert weather_data == {'temp': 280}
-
-@patch('weather.utils.requests.get', side_effect=requests.RequestException)
-@patch('weather.utils.API_KEY', 'test_api_key')
-def test_fetch_weather_by_coordinates_exception(mock_get):
-    weather_data = fetch_weather_by_coordinates(0, 0)
-    assert weather_data is None
-
-@patch('weather.utils.logger.warning')
-@patch('weather.utils.API_KEY', 'test_api_key')
-@patch('weather.utils.requests.get')
-def test_fetch_weather_by_coordinates_api_key_warning(mock_get, mock_warning):
-    mock_get.return_value = MagicMock(status_code=401)
-    weather_data = fetch_weather_by_coordinates(0, 0)
-    assert weather_data is None
-    mock_warning.assert_called_with("Invalid API Key for OpenWeather API.")
-
 # Tests for format_weather_data
 def test_format_weather_data_success():
     raw_data = {
@@ -166,35 +315,6 @@ def test_format_weather_data_key_error():
     formatted_data = format_weather_data(raw_data)
     assert 'error' in formatted_data
 
-# Tests for get_weather_data_for_city
-@patch('weather.utils.requests.get')
-@patch('weather.utils.API_KEY', 'test_api_key')
-def test_get_weather_data_for_city_success(mock_get):
-    mock_get.return_value = MagicMock(
-        status_code=200, json=MagicMock(return_value={
-            'name': 'London',
-            'weather': [{'description': 'clear sky'}],
-            'main': {'temp': 280, 'feels_like': 275, 'humidity': 80},
-            'wind': {'speed': 10}
-        })
-    )
-    data = get_weather_data_for_city('London')
-    assert data['city_name'] == 'London'
-
-@patch('weather.utils.requests.get', side_effect=requests.RequestException)
-@patch('weather.utils.API_KEY', 'test_api_key')
-def test_get_weather_data_for_city_exception(mock_get):
-    data = get_weather_data_for_city('London')
-    assert data is None
-
-@patch('weather.utils.API_KEY', None) # Test missing API key scenario
-@patch('weather.utils.logger.error')
-@patch('weather.utils.requests.get')
-def test_get_weather_data_for_city_no_api_key(mock_get, mock_error):
-    data = get_weather_data_for_city('London')
-    assert data is None
-    mock_error.assert_called_with("API_KEY for OpenWeather is not set.")
-
 # Tests for get_session
 def test_get_session_returns_session():
     session1 = get_session()
@@ -202,7 +322,7 @@ def test_get_session_returns_session():
     assert session1 is session2 # Should return the same session object
 
 # Tests for get_city_list
-@patch('weather.utils.requests.get')
+@patch('requests.Session.get')
 def test_get_city_list_from_cache(mock_get):
     cache.set('city_list', [{'name': 'CachedCity'}])
     cities = get_city_list()
@@ -210,7 +330,7 @@ def test_get_city_list_from_cache(mock_get):
     assert cities[0]['name'] == 'CachedCity'
     mock_get.assert_not_called()
 
-@patch('weather.utils.requests.get')
+@patch('requests.Session.get')
 def test_get_city_list_fetch_and_cache(mock_get):
     mock_response = MagicMock()
     mock_response.raise_for_status.return_value = None
@@ -223,7 +343,7 @@ def test_get_city_list_fetch_and_cache(mock_get):
     mock_get.assert_called_once()
     assert cache.get('city_list') is not None
 
-@patch('weather.utils.requests.get', side_effect=requests.RequestException)
+@patch('requests.Session.get', side_effect=requests.RequestException)
 def test_get_city_list_fetch_exception(mock_get):
     cities = get_city_list()
     assert cities == []
@@ -6,22 +6,52 @@ from rest_framework.test import APIClient
 import json
 import os
 import requests
+import time
 
 from weather.views import get_timezone_data
+from weather.city_index import CityIndex
+from weather.city_snapshot import CitySnapshot
+from weather import metrics, views
+from weather.tile_store import reset_tile_store
+from django.core.cache import cache
 
 @pytest.fixture
 def api_client():
     return APIClient()
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+@pytest.fixture(autouse=True)
+def tile_store(settings, tmp_path):
+    settings.TILE_STORE_PATH = str(tmp_path / 'tiles')
+    reset_tile_store()
+    yield
+    reset_tile_store()
+
+CITIES = [
+    {'id': 6167865, 'name': 'Toronto', 'country': 'CA', 'coord': {'lon': -79.416298, 'lat': 43.700111}},
+    {'id': 2988507, 'name': 'Paris', 'country': 'FR', 'coord': {'lon': 2.3488, 'lat': 48.853409}},
+    {'id': 4717560, 'name': 'Paris', 'country': 'US', 'coord': {'lon': -95.555130, 'lat': 33.660938}},
+]
+
+@pytest.fixture(autouse=True)
+def city_snapshot():
+    snapshot = CitySnapshot.from_city_list(CITIES)
+    with patch('weather.locations.get_city_snapshot', return_value=snapshot), \
+            patch('weather.timezones.get_city_snapshot', return_value=snapshot):
+        yield snapshot
+
 
 @pytest.mark.django_db
 def test_search_suggestions_valid(api_client):
     url = reverse('search_suggestions')  
-    with patch('weather.views.get_city_list', return_value=[
+    with patch('weather.views.get_city_index', return_value=CityIndex.from_city_list([
         {'name': 'Paris'},
         {'name': 'Parma'},
         {'name': 'Paradise'}
-    ]):
+    ])):
         response = api_client.get(url, {'city_name': 'par'})
         data = response.json()
 
@@ -31,11 +61,11 @@ def test_search_suggestions_valid(api_client):
 @pytest.mark.django_db
 def test_search_suggestions_no_match(api_client):
     url = reverse('search_suggestions')
-    with patch('weather.views.get_city_list', return_value=[
+    with patch('weather.views.get_city_index', return_value=CityIndex.from_city_list([
         {'name': 'Paris'},
         {'name': 'Parma'},
         {'name': 'Paradise'}
-    ]):
+    ])):
         response = api_client.get(url, {'city_name': 'xyz'})
         data = response.json()
 
@@ -74,11 +104,14 @@ def test_get_weather_data_valid(api_client):
         }
     }
 
-    with patch('requests.get') as mock_get:
-        mock_get.side_effect = [
-            MagicMock(status_code=200, json=MagicMock(return_value=weather_data_mock)),
-            MagicMock(status_code=200, json=MagicMock(return_value=weatherapi_data_mock))
-        ]
+    # Both upstream calls run concurrently, so answer by URL rather than call order
+    def upstream_side_effect(url, **kwargs):
+        if 'openweathermap' in url:
+            return MagicMock(status_code=200, json=MagicMock(return_value=weather_data_mock))
+        return MagicMock(status_code=200, json=MagicMock(return_value=weatherapi_data_mock))
+
+    with patch('requests.Session.get') as mock_get:
+        mock_get.side_effect = upstream_side_effect
 
         response = api_client.get(url, {'city_name': 'Paris'})
         data = response.json()
@@ -93,13 +126,133 @@ def test_get_weather_data_valid(api_client):
         assert len(data['daily_forecast']) == 1
         assert data['daily_forecast'][0]['date'] == '2025-11-21'
 
+        # The cached payload is revalidated without going upstream again
+        calls = mock_get.call_count
+        revalidated = api_client.get(url, {'city_name': 'Paris'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        assert revalidated.status_code == 304
+        assert mock_get.call_count == calls
+
+@pytest.mark.django_db
+def test_get_weather_data_compact_format(api_client):
+    from weather.compact import expand_weather_payload
+
+    forecast = {'forecast': {'forecastday': [{
+        'date': '2025-11-21',
+        'day': {'maxtemp_c': 20.0, 'mintemp_c': 10.0, 'condition': {'text': 'Sunny', 'icon': '113.png'}},
+        'hour': [
+            {'time': f'2025-11-21 {hour:02d}:00', 'temp_c': 18.0, 'condition': {'text': 'Clear', 'icon': '113.png'}}
+            for hour in range(24)
+        ],
+    }]}}
+
+    def upstream_side_effect(url, **kwargs):
+        if 'openweathermap' in url:
+            return MagicMock(status_code=200, json=MagicMock(return_value={
+                'cod': 200, 'main': {'temp': 270}, 'weather': [{}], 'timezone': 0, 'sys': {}
+            }))
+        return MagicMock(status_code=200, json=MagicMock(return_value=forecast))
+
+    url = reverse('get_weather_data')
+    with patch('requests.Session.get', side_effect=upstream_side_effect) as mock_get:
+        full = api_client.get(url, {'city_name': 'Toronto'})
+        compact = api_client.get(url, {'city_name': 'Toronto', 'format': 'compact'})
+        assert mock_get.call_count == 2
+
+    assert compact.status_code == 200
+    data = compact.json()
+    assert data['format'] == 'compact'
+    assert data['conditions'] == ['Clear', 'Sunny']
+    assert data['hourly_forecast']['condition'] == [0] * 24
+    assert len(compact.content) < len(full.content)
+    assert expand_weather_payload(data) == full.json()
+
+    assert compact['ETag'] != full['ETag']
+    revalidated = api_client.get(url, {'city_name': 'Toronto', 'format': 'compact'}, HTTP_IF_NONE_MATCH=compact['ETag'])
+    assert revalidated.status_code == 304
+
+@pytest.mark.django_db
+def test_get_weather_data_equivalent_queries_share_cache(api_client):
+    def upstream_side_effect(url, **kwargs):
+        if 'openweathermap' in url:
+            return MagicMock(status_code=200, json=MagicMock(return_value={
+                'cod': 200, 'main': {'temp': 270}, 'weather': [{}], 'timezone': 0, 'sys': {}
+            }))
+        return MagicMock(status_code=200, json=MagicMock(return_value={}))
+
+    url = reverse('get_weather_data')
+    with patch('requests.Session.get', side_effect=upstream_side_effect) as mock_get:
+        for params in ({'city_name': 'Toronto'}, {'city_name': 'toronto'},
+                       {'city_name': '  TORONTO '}, {'city_name': 'Toronto', 'foo': '1'}):
+            response = api_client.get(url, params)
+            assert response.status_code == 200
+            assert response.json()['city_name'] == 'Toronto'
+
+    assert mock_get.call_count == 2
+    called = [call.args[0] for call in mock_get.call_args_list]
+    assert any('weather?id=6167865&' in called_url for called_url in called)
+    assert any('q=43.7001,-79.4163' in called_url for called_url in called)
+
+@pytest.mark.django_db
+def test_get_weather_data_counts_city_requests(api_client):
+    from weather import popularity
+
+    popularity.reset()
+    url = reverse('get_weather_data')
+    with patch('requests.Session.get', side_effect=batch_upstream):
+        api_client.get(url, {'city_name': 'toronto'})
+        api_client.get(url, {'city_name': 'Toronto'})
+        api_client.get(url, {'city_name': 'Nowhere'})
+
+    assert popularity.scores().keys() == {'city:6167865'}
+    popularity.reset()
+
+def test_resolve_weather_location():
+    from weather.views import resolve_weather_location
+
+    assert resolve_weather_location(' toronto ').key == 'city:6167865'
+    # Several cities are called Paris, so the name is passed upstream as given
+    paris = resolve_weather_location('PARIS')
+    assert paris.key == 'name:paris'
+    assert paris.owm_query == 'q=PARIS'
+    assert resolve_weather_location('New   York').key == 'name:new york'
+
+@pytest.mark.django_db
+def test_get_weather_data_serves_last_good_payload_when_breaker_open(api_client):
+    from weather.circuit_breaker import get_breaker
+
+    def upstream_side_effect(url, **kwargs):
+        if 'openweathermap' in url:
+            return MagicMock(status_code=200, json=MagicMock(return_value={
+                'cod': 200, 'main': {'temp': 270}, 'weather': [{}], 'timezone': 0, 'sys': {}
+            }))
+        return MagicMock(status_code=200, json=MagicMock(return_value={}))
+
+    url = reverse('get_weather_data')
+    with patch('requests.Session.get', side_effect=upstream_side_effect):
+        assert api_client.get(url, {'city_name': 'Toronto'}).status_code == 200
+
+    # The fresh payload and observations expire, then the upstream's breaker opens
+    from weather.payloads import payload_cache_key
+    from weather.observations import current_key, forecast_key
+    cache.delete_many([payload_cache_key('weather_data', 'city:6167865'),
+                       current_key('city:6167865'), forecast_key('city:6167865')])
+    get_breaker('http://api.openweathermap.org/').trip()
+
+    with patch('requests.Session.get') as mock_get:
+        response = api_client.get(url, {'city_name': 'Toronto'})
+
+    assert not any('openweathermap' in call.args[0] for call in mock_get.call_args_list)
+    assert response.status_code == 200
+    assert response.json()['city_name'] == 'Toronto'
+    assert response['Cache-Control'] == 'public, max-age=0'
+
 @pytest.mark.django_db
 def test_get_weather_data_city_not_found(api_client):
     url = reverse('get_weather_data')
 
     weather_data_mock = {'cod': '404'}
 
-    with patch('requests.get') as mock_get:
+    with patch('requests.Session.get') as mock_get:
         mock_get.return_value = MagicMock(status_code=404, json=MagicMock(return_value=weather_data_mock))
 
         response = api_client.get(url, {'city_name': 'InvalidCity'})
@@ -108,6 +261,99 @@ def test_get_weather_data_city_not_found(api_client):
         assert response.status_code == 404
         assert data['message'] == 'City Not Found'
 
+def batch_upstream(url, **kwargs):
+    """Upstream stub for batch requests: a group query knows Toronto, Paris FR and id 1234."""
+    item = {'main': {'temp': 270}, 'weather': [{}], 'sys': {'timezone': 3600}}
+    if '/group?' in url:
+        ids = url.split('id=')[1].split('&')[0].split(',')
+        names = {'6167865': 'Toronto', '2988507': 'Paris', '1234': 'Elsewhere'}
+        return MagicMock(status_code=200, json=MagicMock(return_value={'list': [
+            dict(item, id=int(city_id), name=names[city_id], coord={'lat': 1.5, 'lon': 2.5})
+            for city_id in ids if city_id in names
+        ]}))
+    if 'openweathermap' in url:
+        if 'q=Nowhere' in url:
+            return MagicMock(status_code=200, json=MagicMock(return_value={'cod': '404'}))
+        return MagicMock(status_code=200, json=MagicMock(return_value=dict(item, cod=200, timezone=0)))
+    return MagicMock(status_code=200, json=MagicMock(return_value={}))
+
+@pytest.mark.django_db
+def test_get_user_location_serves_nearest_city(api_client):
+    from weather.nearest_city import NearestCityIndex
+
+    index = NearestCityIndex(CitySnapshot.from_city_list(CITIES))
+    with patch('weather.locations.get_nearest_city_index', return_value=index), \
+            patch('requests.Session.get', side_effect=batch_upstream) as mock_get:
+        response = api_client.get(reverse('get_weather_at_location', args=[43.6532, -79.3832]))
+        # The payload is the one get_weather_data caches for the city
+        by_name = api_client.get(reverse('get_weather_data'), {'city_name': 'Toronto'})
+
+    assert response.status_code == 200
+    assert response.json()['city_name'] == 'Toronto'
+    assert any('id=6167865' in call.args[0] for call in mock_get.call_args_list)
+    assert by_name['ETag'] == response['ETag']
+    assert mock_get.call_count == 2
+
+    assert api_client.get('/get_user_location/95.0/0.0/').status_code == 400
+    assert api_client.get('/get_user_location/north/0.0/').status_code == 404
+
+@pytest.mark.django_db
+def test_get_weather_batch(api_client):
+    url = reverse('get_weather_batch')
+    with patch('requests.Session.get', side_effect=batch_upstream) as mock_get:
+        response = api_client.get(url, {
+            'cities': 'Toronto, toronto,Paris,Nowhere',
+            'ids': '6167865,2988507,1234,99',
+        })
+
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert [(result['query'], result['status']) for result in results] == [
+        ('Toronto', 'ok'), ('Paris', 'ok'), ('Nowhere', 'not_found'),
+        ('2988507', 'ok'), ('1234', 'ok'), ('99', 'not_found'),
+    ]
+    assert results[0]['data']['city_name'] == 'Toronto'
+    assert results[3]['data']['timezone'] == 3600
+    assert results[4]['data']['city_name'] == 'Elsewhere'
+    assert 'data' not in results[2]
+
+    called = [call.args[0] for call in mock_get.call_args_list]
+    # Every id goes into a single group query; the ambiguous and unknown names are asked for by name
+    assert sum('/group?' in called_url for called_url in called) == 1
+    assert sum('/weather?' in called_url for called_url in called) == 2
+    assert any('q=1.5000,2.5000' in called_url for called_url in called)
+
+@pytest.mark.django_db
+def test_get_weather_batch_serves_hits_from_cache(api_client):
+    url = reverse('get_weather_batch')
+    with patch('requests.Session.get', side_effect=batch_upstream):
+        api_client.get(url, {'cities': 'Toronto', 'ids': '2988507'})
+
+    with patch('requests.Session.get', side_effect=batch_upstream) as mock_get, \
+            patch('weather.payloads.cache.get_many', wraps=cache.get_many) as mock_get_many:
+        response = api_client.get(url, {'ids': '6167865,2988507'})
+
+    assert [result['status'] for result in response.json()['results']] == ['ok', 'ok']
+    assert mock_get_many.call_count == 1
+    mock_get.assert_not_called()
+
+@pytest.mark.django_db
+def test_get_weather_batch_unavailable(api_client):
+    with patch('requests.Session.get', side_effect=requests.ConnectionError('down')):
+        response = api_client.get(reverse('get_weather_batch'), {'cities': 'Toronto'})
+
+    assert response.status_code == 200
+    assert response.json()['results'] == [{'query': 'Toronto', 'status': 'unavailable'}]
+
+@pytest.mark.django_db
+def test_get_weather_batch_limits(api_client, monkeypatch):
+    url = reverse('get_weather_batch')
+    monkeypatch.setattr('weather.views.WEATHER_BATCH_MAX', 2)
+
+    assert api_client.get(url).status_code == 400
+    assert api_client.get(url, {'cities': 'a,b,c'}).status_code == 400
+    assert api_client.get(url, {'ids': 'abc'}).status_code == 400
+
 @pytest.mark.django_db
 def test_get_weather_data_missing_city(api_client):
     url = reverse('get_weather_data')
@@ -122,7 +368,7 @@ def test_get_weather_data_missing_city(api_client):
 def test_get_timezone_data_valid():
     timezone_data_mock = {'timezone': 'Europe/Paris'}
 
-    with patch('requests.get') as mock_get:
+    with patch('requests.Session.get') as mock_get:
         mock_get.return_value = MagicMock(status_code=200, json=MagicMock(return_value=timezone_data_mock))
 
         result = get_timezone_data('Paris')
@@ -133,7 +379,7 @@ def test_get_timezone_data_valid():
 def test_get_timezone_data_invalid():
     timezone_data_mock = {}
 
-    with patch('requests.get') as mock_get:
+    with patch('requests.Session.get') as mock_get:
         mock_get.return_value = MagicMock(status_code=200, json=MagicMock(return_value=timezone_data_mock))
 
         result = get_timezone_data('InvalidCity')
@@ -145,7 +391,7 @@ from django.core.cache import cache
 @pytest.mark.django_db
 def test_get_timezone_data_exception():
     cache.clear()
-    with patch('requests.get') as mock_get:
+    with patch('requests.Session.get') as mock_get:
         mock_get.side_effect = Exception("API Error")
 
         result = get_timezone_data('Paris')
@@ -158,7 +404,7 @@ def test_get_time_zone_valid(api_client):
 
     timezone_data_mock = {'timezone': 'Europe/Paris'}
 
-    with patch('requests.get') as mock_get:
+    with patch('requests.Session.get') as mock_get:
         mock_get.return_value = MagicMock(status_code=200, json=MagicMock(return_value=timezone_data_mock))
 
         response = api_client.get(url, {'city_name': 'Paris'})
@@ -168,11 +414,20 @@ def test_get_time_zone_valid(api_client):
         assert data['city_name'] == 'Paris'
         assert data['timezone'] == 'Europe/Paris'
 
+@pytest.mark.django_db
+def test_get_time_zone_resolved_locally(api_client):
+    with patch('requests.Session.get') as mock_get:
+        response = api_client.get(reverse('get_time_zone'), {'city_name': 'toronto'})
+
+    assert response.status_code == 200
+    assert response.json()['timezone'] == 'America/Toronto'
+    mock_get.assert_not_called()
+
 @pytest.mark.django_db
 def test_get_time_zone_city_not_found(api_client):
     url = reverse('get_time_zone')
 
-    with patch('requests.get') as mock_get:
+    with patch('requests.Session.get') as mock_get:
         mock_get.return_value = MagicMock(status_code=404, json=MagicMock(return_value={}))
 
         response = api_client.get(url, {'city_name': 'InvalidCity'})
@@ -191,60 +446,126 @@ def test_get_time_zone_missing_city(api_client):
     assert response.status_code == 400
     assert data['message'] == 'City name is required'
 
+CLIENT_IP = '123.123.123.123'
+
+def owm_current(name, temp=288.15):
+    return {'name': name, 'weather': [{'description': 'clear sky'}],
+            'main': {'temp': temp, 'feels_like': temp, 'humidity': 50}, 'wind': {'speed': 2}}
+
 @pytest.mark.django_db
-@patch('weather.views.get_weather_data_for_city')
+@patch('weather.services.get_current')
 @patch('weather.views.get_location_from_ip')
-@patch('weather.views.fetch_user_ip')
-def test_get_user_location_success(mock_fetch_user_ip, mock_get_location_from_ip, mock_get_weather_data_for_city, api_client):
-    mock_fetch_user_ip.return_value = '123.123.123.123'
+def test_get_user_location_from_ip_table(mock_get_location_from_ip, mock_get_current, api_client, settings):
+    from ipaddress import ip_address
+    from weather.ip_ranges import IPRangeTable
+
+    table = IPRangeTable.from_rows([
+        (ip_address('123.123.0.0'), ip_address('123.123.255.255'), 'Lyon', 'FR', 45.75, 4.85),
+    ])
+    mock_get_current.return_value = owm_current('Lyon', 285.15)
+
+    settings.TRUSTED_PROXY_HOPS = 2
+    with patch('weather.views.get_ip_table', return_value=table):
+        # The client's address is the one the outer of the two proxies appended
+        response = api_client.get(reverse('get_user_location'), REMOTE_ADDR='10.0.0.2',
+                                  HTTP_X_FORWARDED_FOR=f'9.9.9.9, {CLIENT_IP}, 10.0.0.1')
+
+    assert response.json()['city_name'] == 'Lyon'
+    assert mock_get_current.call_args.args[0].key == 'name:lyon'
+    mock_get_location_from_ip.assert_not_called()
+
+@pytest.mark.django_db
+@patch('weather.services.get_current')
+@patch('weather.views.get_location_from_ip')
+@patch('weather.views.get_ip_table', return_value=None)
+def test_get_user_location_success(mock_get_ip_table, mock_get_location_from_ip, mock_get_current, api_client):
     mock_get_location_from_ip.return_value = 'Paris, Ile-de-France, France'
-    mock_get_weather_data_for_city.return_value = {'city_name': 'Paris', 'temperature': '15.00°C'}
+    mock_get_current.return_value = owm_current('Paris')
     
     url = reverse('get_user_location')
-    response = api_client.get(url)
+    response = api_client.get(url, REMOTE_ADDR=CLIENT_IP)
     data = response.json()
 
     assert response.status_code == 200
     assert data['city_name'] == 'Paris'
-    assert data['temperature'] == '15.00°C'
+    assert data['temperature'] == 15.0
+
+    # The payload of the city is served from the cache until it expires
+    api_client.get(url, REMOTE_ADDR=CLIENT_IP)
+    mock_get_current.assert_called_once()
 
 @pytest.mark.django_db
-@patch('weather.views.get_weather_data_for_city')
+@patch('weather.services.get_current')
 @patch('weather.views.get_location_from_ip')
-@patch('weather.views.fetch_user_ip')
-def test_get_user_location_fallback_to_toronto(mock_fetch_user_ip, mock_get_location_from_ip, mock_get_weather_data_for_city, api_client):
-    mock_fetch_user_ip.return_value = '123.123.123.123'
-    
-    def weather_side_effect(city):
-        if city == 'Toronto':
-            return {'city_name': 'Toronto', 'temperature': '10.00°C'}
-        return None
-        
-    mock_get_weather_data_for_city.side_effect = weather_side_effect
+@patch('weather.views.get_ip_table', return_value=None)
+def test_get_user_location_fallback_to_toronto(mock_get_ip_table, mock_get_location_from_ip, mock_get_current, api_client):
+    mock_get_current.return_value = owm_current('Toronto', 283.15)
 
     # Case 1: Location unavailable
     mock_get_location_from_ip.return_value = 'Location Unavailable'
     url = reverse('get_user_location')
-    response = api_client.get(url)
+    response = api_client.get(url, REMOTE_ADDR=CLIENT_IP)
     data = response.json()
     assert response.status_code == 200
     assert data['city_name'] == 'Toronto'
+    assert response['Cache-Control'] == 'private, max-age=0'
 
     # Case 2: Unknown city
     mock_get_location_from_ip.return_value = 'Unknown City, Unknown Region, Unknown Country'
-    response = api_client.get(url)
+    response = api_client.get(url, REMOTE_ADDR=CLIENT_IP)
     data = response.json()
     assert response.status_code == 200
     assert data['city_name'] == 'Toronto'
 
     # Case 3: Rate limited (returns Toronto directly)
     mock_get_location_from_ip.return_value = 'Toronto, Ontario, Canada'
-    response = api_client.get(url)
+    response = api_client.get(url, REMOTE_ADDR=CLIENT_IP)
     data = response.json()
     assert response.status_code == 200
     assert data['city_name'] == 'Toronto'
 
-    assert data['city_name'] == 'Toronto'
+    # The fallback payload was fetched once and served from then on
+    mock_get_current.assert_called_once()
+    assert mock_get_current.call_args.args[0].key == 'city:6167865'
+
+@pytest.mark.django_db
+@patch('weather.services.get_current')
+@patch('weather.views.get_location_from_ip', return_value='Paris, Ile-de-France, France')
+@patch('weather.views.get_ip_table', return_value=None)
+def test_get_user_location_weather_failure_serves_warm_fallback(mock_get_ip_table, mock_get_location_from_ip,
+                                                                mock_get_current, api_client):
+    from weather.custom_exceptions import ServiceUnavailable
+    from weather.locations import FALLBACK_LOCATION
+
+    metrics.reset()
+    mock_get_current.return_value = owm_current('Toronto', 283.15)
+    views.store_location_payload(FALLBACK_LOCATION)
+    mock_get_current.reset_mock()
+    mock_get_current.side_effect = ServiceUnavailable('Timed out')
+
+    response = api_client.get(reverse('get_user_location'), REMOTE_ADDR=CLIENT_IP)
+
+    assert response.status_code == 200
+    assert response.json()['city_name'] == 'Toronto'
+    # Only the client's city was tried; the fallback cost no upstream call
+    mock_get_current.assert_called_once()
+    assert mock_get_current.call_args.args[0].key == 'name:paris'
+    assert mock_get_current.call_args.args[1] - time.monotonic() <= views.LOCATION_WEATHER_BUDGET
+    assert metrics.snapshot()['user_location.fallback.weather'] == 1
+
+@pytest.mark.django_db
+@patch('weather.services.get_current')
+@patch('weather.views.get_location_from_ip', return_value='Location Unavailable')
+@patch('weather.views.get_ip_table', return_value=None)
+def test_get_user_location_unavailable_without_fallback(mock_get_ip_table, mock_get_location_from_ip,
+                                                        mock_get_current, api_client):
+    from weather.custom_exceptions import ServiceUnavailable
+
+    mock_get_current.side_effect = ServiceUnavailable('Upstream down')
+
+    response = api_client.get(reverse('get_user_location'), REMOTE_ADDR=CLIENT_IP)
+
+    assert response.status_code == 503
 
 @pytest.mark.django_db
 @patch('weather.views.get_news')
@@ -257,6 +578,35 @@ def test_get_news_view_success(mock_get_news, api_client):
     assert len(data['news']) == 1
     assert data['news'][0]['title'] == 'Test News'
 
+@pytest.mark.django_db
+@patch('weather.views.get_news', return_value=None)
+def test_get_news_view_failure_is_not_cached(mock_get_news, api_client):
+    from weather.payloads import get_payload
+
+    response = api_client.get(reverse('get_news'), {'query': 'test'})
+
+    assert response.status_code == 200
+    assert response.json() == {'news': []}
+    assert response['Cache-Control'] == 'public, max-age=0'
+    assert get_payload('news', 'test') is None
+
+@pytest.mark.django_db
+@patch('weather.views.get_news')
+def test_get_news_view_serves_cached_gzip(mock_get_news, api_client):
+    import gzip
+
+    mock_get_news.return_value = [{'title': f'Test News {i}', 'description': 'Storm ahead'} for i in range(10)]
+    url = reverse('get_news')
+    api_client.get(url, {'query': 'storm'})
+
+    with patch('weather.payloads.gzip.compress') as mock_compress:
+        response = api_client.get(url, {'query': 'storm'}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        mock_compress.assert_not_called()
+
+    assert response['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(response.content))['news'][0]['title'] == 'Test News 0'
+    assert mock_get_news.call_count == 1
+
 @pytest.mark.django_db
 def test_get_news_view_missing_query(api_client):
     url = reverse('get_news')
@@ -271,37 +621,164 @@ def test_get_news_view_no_api_key(api_client):
     assert response.status_code == 503
 
 @pytest.mark.django_db
-@patch('weather.views.requests.get')
-def test_map_tile_proxy_success(mock_get, api_client):
-    mock_get.return_value = MagicMock(
-        status_code=200, 
-        content=b'tile_content', 
-        headers={'Content-Type': 'image/png'}
+@patch('weather.views.get_news')
+def test_get_news_view_not_modified(mock_get_news, api_client):
+    mock_get_news.return_value = [{'title': 'Test News'}]
+    url = reverse('get_news')
+    first = api_client.get(url, {'query': 'storm'})
+    assert first['Cache-Control'].startswith('public, max-age=')
+    assert 'Accept-Encoding' in first['Vary']
+
+    second = api_client.get(url, {'query': 'storm'}, HTTP_IF_NONE_MATCH=first['ETag'])
+    assert second.status_code == 304
+    assert second.content == b''
+    assert second['ETag'] == first['ETag']
+    assert mock_get_news.call_count == 1
+
+    stale = api_client.get(url, {'query': 'storm'}, HTTP_IF_NONE_MATCH='"outdated"')
+    assert stale.status_code == 200
+    assert stale.json()['news'][0]['title'] == 'Test News'
+
+@pytest.mark.django_db
+@patch('weather.views.LOCATE_BUDGET', 0.05)
+@patch('weather.services.get_current')
+@patch('weather.views.get_location_from_ip')
+@patch('weather.views.get_ip_table', return_value=None)
+def test_get_user_location_slow_lookup_serves_fallback(mock_get_ip_table, mock_get_location_from_ip,
+                                                       mock_get_current, api_client):
+    metrics.reset()
+    mock_get_location_from_ip.side_effect = lambda ip: time.sleep(0.5) or 'Paris, Ile-de-France, France'
+    mock_get_current.return_value = owm_current('Toronto', 283.15)
+
+    started = time.monotonic()
+    response = api_client.get(reverse('get_user_location'), REMOTE_ADDR=CLIENT_IP)
+
+    assert time.monotonic() - started < 0.5
+    assert response.json()['city_name'] == 'Toronto'
+    assert metrics.snapshot()['user_location.fallback.locate'] == 1
+
+@pytest.mark.django_db
+@patch('weather.services.get_current')
+@patch('weather.views.get_location_from_ip')
+@patch('weather.views.get_ip_table', return_value=None)
+def test_get_user_location_is_privately_cacheable(mock_get_ip_table, mock_get_location_from_ip, mock_get_current, api_client):
+    mock_get_location_from_ip.return_value = 'Paris, Ile-de-France, France'
+    mock_get_current.return_value = owm_current('Paris')
+
+    url = reverse('get_user_location')
+    first = api_client.get(url, REMOTE_ADDR=CLIENT_IP)
+    assert first['Cache-Control'].startswith('private, max-age=')
+
+    second = api_client.get(url, REMOTE_ADDR=CLIENT_IP, HTTP_IF_NONE_MATCH=first['ETag'])
+    assert second.status_code == 304
+
+def mock_tile_response(*chunks):
+    return MagicMock(
+        status_code=200,
+        iter_content=MagicMock(return_value=iter(chunks)),
+        headers={'Content-Type': 'image/png', 'Content-Length': str(sum(map(len, chunks)))}
     )
+
+@pytest.mark.django_db
+@patch('requests.Session.get')
+def test_map_tile_proxy_success(mock_get, api_client):
+    mock_get.return_value = mock_tile_response(b'tile_', b'content')
     url = reverse('map_tile_proxy', args=['temp_new', 1, 1, 1])
     response = api_client.get(url)
     assert response.status_code == 200
-    assert response.content == b'tile_content'
+    assert response.streaming
+    assert b''.join(response.streaming_content) == b'tile_content'
+    assert response['Content-Length'] == '12'
+    assert mock_get.call_args.kwargs['stream'] is True
+
+@pytest.mark.django_db
+@patch('requests.Session.get')
+def test_map_tile_proxy_rejects_invalid_layer(mock_get, api_client):
+    for layer in ('..', 'Temp_New', 'temp%2Fnew'):
+        assert api_client.get(f'/map_tile/{layer}/1/1/1/').status_code == 404
+    mock_get.assert_not_called()
+
+@pytest.mark.django_db
+@patch('requests.Session.get')
+def test_map_tile_proxy_drops_length_of_encoded_body(mock_get, api_client):
+    upstream = mock_tile_response(b'tile_content')
+    # The upstream sent 8 gzipped bytes, which iter_content decodes into the 12 streamed
+    upstream.headers.update({'Content-Encoding': 'gzip', 'Content-Length': '8'})
+    mock_get.return_value = upstream
+    response = api_client.get(reverse('map_tile_proxy', args=['temp_new', 1, 1, 1]))
+    assert b''.join(response.streaming_content) == b'tile_content'
+    assert not response.has_header('Content-Length')
+    assert not response.has_header('Content-Encoding')
 
 @pytest.mark.django_db
 @patch('weather.views.get_session')
 def test_map_tile_proxy_optimized_success(mock_get_session, api_client):
     mock_session = MagicMock()
-    mock_session.get.return_value = MagicMock(
-        status_code=200, 
-        content=b'tile_content_optimized', 
-        headers={'Content-Type': 'image/png'}
-    )
+    mock_session.get.return_value = mock_tile_response(b'tile_content_optimized')
     mock_get_session.return_value = mock_session
     url = reverse('map_tile_proxy_optimized', args=['temp_new', 1, 1, 1])
     response = api_client.get(url)
     assert response.status_code == 200
-    assert response.content == b'tile_content_optimized'
+    assert b''.join(response.streaming_content) == b'tile_content_optimized'
+
+@pytest.mark.django_db
+@patch('requests.Session.get')
+def test_map_tile_proxy_stores_streamed_tile(mock_get, api_client):
+    mock_get.return_value = mock_tile_response(b'tile_', b'content')
+    url = reverse('map_tile_proxy', args=['temp_new', 2, 1, 1])
+    first = api_client.get(url)
+    b''.join(first.streaming_content)
+
+    second = api_client.get(url)
+    assert b''.join(second.streaming_content) == b'tile_content'
+    assert second['Content-Type'] == 'image/png'
+    assert second['ETag']
+    assert second['Expires']
+    assert mock_get.call_count == 1
+
+@pytest.mark.django_db
+@patch('weather.tiles.FileResponse')
+@patch('weather.views.get_session')
+def test_map_tile_proxy_optimized_not_modified(mock_get_session, mock_file_response, api_client):
+    mock_session = MagicMock()
+    mock_session.get.return_value = mock_tile_response(b'tile_content')
+    mock_get_session.return_value = mock_session
+    url = reverse('map_tile_proxy_optimized', args=['temp_new', 2, 1, 1])
+    streamed = api_client.get(url)
+    b''.join(streamed.streaming_content)
+
+    # The streamed response is sent with the ETag the tile is stored under
+    from weather.tile_store import get_tile_store
+    etag = get_tile_store().get('temp_new', 2, 1, 1).etag
+    assert streamed['ETag'] == etag
+    response = api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    assert response.status_code == 304
+    assert response['ETag'] == etag
+    assert response['Cache-Control'] == 'public, max-age=3600'
+    mock_file_response.assert_not_called()
+    assert mock_session.get.call_count == 1
 
 @pytest.mark.django_db
-@patch('weather.views.get_city_list')
-def test_search_suggestions_success(mock_get_city_list, api_client):
-    mock_get_city_list.return_value = [{'name': 'London'}, {'name': 'Liverpool'}]
+@patch('requests.Session.get')
+def test_map_tile_proxy_does_not_cache_truncated_tile(mock_get, api_client):
+    def chunks(size):
+        yield b'tile_'
+        raise requests.exceptions.ChunkedEncodingError('connection reset')
+
+    mock_get.return_value = mock_tile_response()
+    mock_get.return_value.iter_content = chunks
+    url = reverse('map_tile_proxy', args=['temp_new', 3, 1, 1])
+    assert b''.join(api_client.get(url).streaming_content) == b'tile_'
+
+    mock_get.return_value = mock_tile_response(b'tile_content')
+    assert b''.join(api_client.get(url).streaming_content) == b'tile_content'
+    assert mock_get.call_count == 2
+
+@pytest.mark.django_db
+@patch('weather.views.get_city_index')
+def test_search_suggestions_success(mock_get_city_index, api_client):
+    mock_get_city_index.return_value = CityIndex.from_city_list([{'name': 'London'}, {'name': 'Liverpool'}])
     url = reverse('search_suggestions')
     response = api_client.get(url, {'city_name': 'lon'})
     data = response.json()
@@ -309,6 +786,13 @@ def test_search_suggestions_success(mock_get_city_list, api_client):
     assert data['success'] is True
     assert data['suggestions'] == ['London']
 
+@pytest.mark.django_db
+@patch('weather.views.get_city_index', return_value=None)
+def test_search_suggestions_while_index_is_built(mock_get_city_index, api_client):
+    response = api_client.get(reverse('search_suggestions'), {'city_name': 'lon'})
+    assert response.status_code == 200
+    assert response.json()['suggestions'] == []
+
 @pytest.mark.django_db
 def test_search_suggestions_no_city_name(api_client):
     url = reverse('search_suggestions')
@@ -319,10 +803,60 @@ def test_search_suggestions_no_city_name(api_client):
     assert data['suggestions'] == []
 
 @pytest.mark.django_db
-@patch('weather.views.get_city_list', side_effect=Exception('Test Error'))
-def test_search_suggestions_exception(mock_get_city_list, api_client):
+@patch('weather.views.get_city_index', side_effect=Exception('Test Error'))
+def test_search_suggestions_exception(mock_get_city_index, api_client):
     url = reverse('search_suggestions')
     response = api_client.get(url, {'city_name': 'test'})
     assert response.status_code == 503
 
 
+
+@pytest.mark.django_db
+def test_get_weather_data_fetches_upstreams_concurrently(api_client):
+    cache.clear()
+    url = reverse('get_weather_data')
+
+    weather_data_mock = {'cod': 200, 'main': {'temp': 295.15}, 'weather': [{}], 'timezone': 0}
+
+    def slow_upstream(url, **kwargs):
+        time.sleep(0.3)
+        if 'openweathermap' in url:
+            return MagicMock(status_code=200, json=MagicMock(return_value=weather_data_mock))
+        return MagicMock(status_code=200, json=MagicMock(return_value={}))
+
+    with patch('requests.Session.get', side_effect=slow_upstream):
+        start = time.monotonic()
+        response = api_client.get(url, {'city_name': 'Lisbon'})
+        elapsed = time.monotonic() - start
+
+    assert response.status_code == 200
+    # Sequential calls would take at least 0.6s
+    assert elapsed < 0.55
+
+@pytest.mark.django_db
+@patch('weather.services.FETCH_DEADLINE', 0.1)
+def test_get_weather_data_upstream_deadline(api_client):
+    cache.clear()
+    url = reverse('get_weather_data')
+
+    def hanging_upstream(url, **kwargs):
+        time.sleep(0.5)
+        return MagicMock(status_code=200, json=MagicMock(return_value={'cod': 200}))
+
+    with patch('requests.Session.get', side_effect=hanging_upstream):
+        response = api_client.get(url, {'city_name': 'Oslo'})
+
+    assert response.status_code == 503
+
+@pytest.mark.django_db
+def test_metrics_view_groups_counters(api_client):
+    metrics.reset()
+    metrics.incr('cache.get_news.hit', 3)
+    metrics.incr('cache.get_news.miss')
+
+    response = api_client.get(reverse('metrics'))
+    data = response.json()
+    assert data['breaker_states']['api.openweathermap.org'] == 'closed'
+
+    assert response.status_code == 200
+    assert data['cache'] == {'get_news.hit': 3, 'get_news.miss': 1}
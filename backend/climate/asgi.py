@@ -12,5 +12,12 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'climate.settings')
+# Route the upstream-bound endpoints to weather.async_views
+os.environ.setdefault('DJANGO_ASYNC_VIEWS', 'True')
 
 application = get_asgi_application()
+
+# Build the city search index off the request path, once per worker process
+from weather.city_index import preload_city_index  # noqa: E402
+
+preload_city_index()
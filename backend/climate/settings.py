@@ -100,6 +100,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'climate.wsgi.application'
 
+# Serve the async weather views (set by climate/asgi.py)
+ASYNC_VIEWS = os.getenv('DJANGO_ASYNC_VIEWS', 'False') == 'True'
+
 
 # Database
 
@@ -153,17 +156,41 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # CACHES CONFIGS
 CACHES = {
+    # Per-process LRU (L1) in front of Redis, kept coherent over Redis pub/sub
     'default': {
+        'BACKEND': 'weather.cache_backends.TwoTierRedisCache',
+        'LOCATION': os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/1'),
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'L1_MAX_ENTRIES': int(os.getenv('CACHE_L1_MAX_ENTRIES', '1024')),
+            'L1_TIMEOUT': int(os.getenv('CACHE_L1_TIMEOUT', '5')),
+        }
+    },
+    # Sessions must never be read stale, so they skip the L1
+    'sessions': {
         'BACKEND': 'django_redis.cache.RedisCache',
         'LOCATION': os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/1'),
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
         }
-    }
+    },
 }
 
 SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
-SESSION_CACHE_ALIAS = 'default'
+SESSION_CACHE_ALIAS = 'sessions'
+
+# Columnar city list snapshot written by `manage.py update_city_list` and mmapped by workers
+CITY_SNAPSHOT_PATH = os.getenv('CITY_SNAPSHOT_PATH', os.path.join(BASE_DIR, 'climate', 'Data', 'city_list.bin'))
+
+# IP range table written by `manage.py load_ip_ranges` and mmapped by workers to locate clients
+IP_RANGES_PATH = os.getenv('IP_RANGES_PATH', os.path.join(BASE_DIR, 'climate', 'Data', 'ip_ranges.bin'))
+# Reverse proxies in front of the app that append the address they were reached from to X-Forwarded-For
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+
+# Map tiles are kept on local disk rather than in Redis, bounded by a byte budget
+TILE_STORE_PATH = os.getenv('TILE_STORE_PATH', os.path.join(BASE_DIR, 'climate', 'Data', 'tiles'))
+TILE_STORE_MAX_BYTES = int(os.getenv('TILE_STORE_MAX_BYTES', str(512 * 1024 * 1024)))
+TILE_STORE_TIMEOUT = int(os.getenv('TILE_STORE_TIMEOUT', '3600'))
 
 # Test config
 TEST_RUNNER = 'test_runner.PytestTestRunner'
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'climate.settings')
 
 application = get_wsgi_application()
+
+# Build the city search index off the request path, once per worker process
+from weather.city_index import preload_city_index  # noqa: E402
+
+preload_city_index()
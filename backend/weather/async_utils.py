@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+import time
+from functools import wraps
+
+from django.core.cache import cache
+
+from . import metrics
+from .retry import DEFAULT_RETRY_POLICY
+from .http_client import get_async_client
+from .utils import (
+    make_cache_key,
+    CacheEntry,
+    LOCK_TIMEOUT,
+    NEGATIVE_CACHE_TIMEOUT,
+    parse_news,
+    format_location,
+    TIMEZONE_API_URL,
+)
+
+logger = logging.getLogger(__name__)
+
+NEWS_API_KEY = os.getenv('NEWS_API_KEY')
+
+# Keeps background refresh tasks referenced until they finish
+_background_tasks = set()
+
+def async_redis_cache(timeout, stale_timeout=None, negative_timeout=None):
+    """
+    Async counterpart of utils.redis_cache. Keys and stored entries match the
+    sync decorator, so the sync and async versions of a function share their
+    cached results (positive and negative) as long as they use the same
+    timeouts. Stale entries are returned immediately while a background task
+    refreshes them.
+    """
+    def decorator(func):
+        metric = f'cache.{func.__name__}'
+
+        async def compute(key, args, kwargs):
+            result = await func(*args, **kwargs)
+            if result is None and negative_timeout is not None:
+                await cache.aset(f'{key}:negative', True, negative_timeout)
+                metrics.incr(f'{metric}.negative_store')
+            elif stale_timeout is None:
+                await cache.aset(key, result, timeout)
+            elif result is not None:
+                await cache.aset(key, CacheEntry(result, time.time() + timeout), stale_timeout)
+            return result
+
+        async def refresh(key, args, kwargs):
+            try:
+                if await compute(key, args, kwargs) is None:
+                    # Leave the lock to expire so callers do not retry the failed upstream
+                    return
+            except Exception as e:
+                logger.error(f"Background refresh of {func.__name__} failed: {e}")
+                return
+            await cache.adelete(f'{key}:lock')
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = make_cache_key(func.__name__, args, kwargs)
+
+            if negative_timeout is None:
+                entry, negative = await cache.aget(key), False
+            else:
+                entries = await cache.aget_many([key, f'{key}:negative'])
+                entry, negative = entries.get(key), f'{key}:negative' in entries
+
+            if entry is not None and not isinstance(entry, CacheEntry):
+                metrics.incr(f'{metric}.hit')
+                return entry
+            elif entry is not None:
+                if time.time() < entry.fresh_until:
+                    metrics.incr(f'{metric}.hit')
+                else:
+                    metrics.incr(f'{metric}.stale_hit')
+                    # Same lock key as the sync decorator, so only one refresh runs anywhere
+                    if await cache.aadd(f'{key}:lock', 1, LOCK_TIMEOUT):
+                        task = asyncio.create_task(refresh(key, args, kwargs))
+                        _background_tasks.add(task)
+                        task.add_done_callback(_background_tasks.discard)
+                return entry.value
+
+            if negative:
+                metrics.incr(f'{metric}.negative_hit')
+                return None
+
+            metrics.incr(f'{metric}.miss')
+            return await compute(key, args, kwargs)
+        return wrapper
+    return decorator
+
+@async_redis_cache(timeout=14400, stale_timeout=86400)
+async def get_news(query, count=5):
+    news_url = f"https://newsapi.org/v2/everything?q={query}&apiKey={NEWS_API_KEY}&pageSize={count}"
+    try:
+        response = await DEFAULT_RETRY_POLICY.aget(get_async_client(), news_url)
+
+        if response.status_code == 200:
+            return parse_news(response.json())
+        elif response.status_code == 401:
+            logger.warning("Invalid API Key for News API.")
+        else:
+            logger.error(f"Error fetching news: {response.status_code} - {response.text}")
+    except Exception as e:
+        logger.error(f"Error fetching news: {e}")
+
+    # None, as in utils.get_news, so a failed refresh does not replace the stale news
+    return None
+
+@async_redis_cache(timeout=86400)
+async def get_location_from_ip(user_ip):
+    try:
+        response = await DEFAULT_RETRY_POLICY.aget(get_async_client(), f"https://ipapi.co/{user_ip}/json/")
+
+        if response.status_code == 200:
+            return format_location(response.json())
+        elif response.status_code == 429:
+            logger.warning("Rate limit exceeded. Falling back to default location.")
+            return "Toronto, Ontario, Canada"
+        else:
+            logger.error(f"Failed IP location fetch. Status Code: {response.status_code}")
+    except Exception as e:
+        logger.error(f"Error during IP geolocation: {e}")
+    return "Location Unavailable"
+
+@async_redis_cache(timeout=604800, stale_timeout=2592000, negative_timeout=NEGATIVE_CACHE_TIMEOUT)
+async def get_timezone_data(city_name):
+    try:
+        response = await DEFAULT_RETRY_POLICY.aget(get_async_client(), TIMEZONE_API_URL.format(city_name=city_name))
+        return response.json().get('timezone') or None
+    except Exception:
+        return None
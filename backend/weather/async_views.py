@@ -0,0 +1,271 @@
+"""
+Async versions of the upstream-bound views, served when the project runs under
+climate/asgi.py. Upstream calls go through the pooled httpx client in
+async_utils, so a single ASGI worker can keep many slow requests in flight.
+"""
+import asyncio
+import json
+import os
+import time
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views.decorators.http import require_http_methods
+
+from . import async_utils, metrics, popularity
+from .observations import aget_current, aget_forecast
+from .utils import format_weather_data
+from .ip_ranges import aget_ip_table, client_ip
+from .timezones import city_timezone
+from .compact import COMPACT_FORMAT, compact_weather_payload
+from .payloads import aget_payload, aget_fallback_payload, astore_payload, encode_payload, payload_response
+from .custom_exceptions import APIException, BadRequest, NotFound, ServiceUnavailable
+from .tiles import (
+    tile_url,
+    get_stored_tile,
+    astored_tile_response,
+    astream_tile,
+    streaming_tile_response,
+)
+from .services import (
+    API_KEY,
+    WEATHER_API_KEY_2,
+    build_weather_payload,
+    FETCH_DEADLINE,
+    WEATHER_PAYLOAD_TIMEOUT,
+    WEATHER_FALLBACK_TIMEOUT,
+    LOCATION_PAYLOAD_TIMEOUT,
+    FALLBACK_LOCATION_TIMEOUT,
+)
+from .views import (
+    resolve_weather_location,
+    nearest_city_location,
+    build_news_query,
+    city_from_location,
+    NEWS_PAYLOAD_TIMEOUT,
+    FALLBACK_LOCATION,
+    LOCATE_BUDGET,
+    LOCATION_WEATHER_BUDGET,
+    TILE_RETRY_POLICY,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+NEWS_API_KEY = os.getenv('NEWS_API_KEY')
+
+async def fetch_weather_data(location):
+    """Async version of services.fetch_weather_data."""
+    deadline = time.monotonic() + FETCH_DEADLINE
+
+    async def within_deadline(fetch, what):
+        try:
+            return await asyncio.wait_for(fetch(location, deadline), timeout=max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError as e:
+            raise ServiceUnavailable(f'Timed out fetching {what}') from e
+
+    current_task = asyncio.ensure_future(within_deadline(aget_current, f'current conditions for {location.key}'))
+    forecast_task = asyncio.ensure_future(within_deadline(aget_forecast, f'forecast for {location.key}'))
+
+    try:
+        weather_data = await current_task
+        weatherapi_data = await forecast_task
+    finally:
+        forecast_task.cancel()
+
+    return build_weather_payload(location.name, weather_data, weatherapi_data)
+
+async def compact_payload(location, payload):
+    """Async version of views.compact_payload."""
+    compact = await aget_payload('weather_data_compact', location.key, payload.etag)
+    if compact is None:
+        data = compact_weather_payload(json.loads(payload.body))
+        timeout = max(1, int(payload.expires_at - time.time()))
+        compact = await astore_payload('weather_data_compact', (location.key, payload.etag), data, timeout)
+    return compact
+
+async def serve_weather_payload(request, location, payload, max_age=None):
+    popularity.record(location)
+    if request.GET.get('format') == COMPACT_FORMAT:
+        payload = await compact_payload(location, payload)
+    return payload_response(request, payload, max_age=max_age)
+
+async def weather_response(request, location):
+    """Async version of views.weather_response."""
+    payload = await aget_payload('weather_data', location.key)
+    if payload is not None:
+        return await serve_weather_payload(request, location, payload)
+
+    if not API_KEY or not WEATHER_API_KEY_2:
+        raise ServiceUnavailable("API keys for weather data not configured.")
+
+    try:
+        response_data = await fetch_weather_data(location)
+    except ServiceUnavailable:
+        payload = await aget_fallback_payload('weather_data', location.key)
+        if payload is None:
+            raise
+        return await serve_weather_payload(request, location, payload, max_age=0)
+
+    payload = await astore_payload('weather_data', (location.key,), response_data, WEATHER_PAYLOAD_TIMEOUT,
+                                   fallback_timeout=WEATHER_FALLBACK_TIMEOUT)
+    return await serve_weather_payload(request, location, payload)
+
+async def get_weather_data(request):
+    city_name = request.GET.get('city_name', '').strip()
+
+    if not city_name:
+        raise BadRequest('City name is required')
+
+    location = await sync_to_async(resolve_weather_location)(city_name)
+    return await weather_response(request, location)
+
+async def get_user_location(request, latitude, longitude):
+    """Async version of views.get_user_location."""
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise BadRequest('Coordinates out of range')
+    # Building the index on first use reads the city snapshot, so it runs off the event loop
+    location = await sync_to_async(nearest_city_location)(latitude, longitude)
+    return await weather_response(request, location)
+
+async def get_time_zone(request):
+    city_name = request.GET.get('city_name', '').strip()
+
+    if not city_name:
+        raise BadRequest('City name is required')
+
+    timezone = await sync_to_async(city_timezone)(city_name)
+    if timezone:
+        metrics.incr('timezone.local')
+    else:
+        metrics.incr('timezone.upstream')
+        timezone = await async_utils.get_timezone_data(city_name)
+
+    if timezone:
+        return JsonResponse({'city_name': city_name, 'timezone': timezone})
+    else:
+        raise NotFound('Could not fetch timezone data')
+
+async def get_news_view(request):
+    query = request.GET.get('query', '')
+    if not query:
+        raise BadRequest('Query is required')
+
+    payload = await aget_payload('news', query)
+    if payload is not None:
+        return payload_response(request, payload)
+
+    if not NEWS_API_KEY:
+        raise ServiceUnavailable("API key for news data not configured.")
+
+    news = await async_utils.get_news(build_news_query(query), count=6)
+    if news is None:
+        return payload_response(request, encode_payload({'news': []}, 0), max_age=0)
+    payload = await astore_payload('news', (query,), {'news': news}, NEWS_PAYLOAD_TIMEOUT)
+    return payload_response(request, payload)
+
+async def store_location_payload(location, deadline=None):
+    """Async version of services.store_location_payload."""
+    weather_data = format_weather_data(await aget_current(location, deadline))
+    if 'error' in weather_data:
+        raise ServiceUnavailable(weather_data['error'])
+    fallback_timeout = FALLBACK_LOCATION_TIMEOUT if location.key == FALLBACK_LOCATION.key else None
+    return await astore_payload('user_location', (location.key,), weather_data, LOCATION_PAYLOAD_TIMEOUT,
+                                fallback_timeout=fallback_timeout)
+
+async def fallback_location_response(request, stage):
+    """Async version of views.fallback_location_response."""
+    metrics.incr(f'user_location.fallback.{stage}')
+    payload = await aget_fallback_payload('user_location', FALLBACK_LOCATION.key)
+    if payload is None:
+        try:
+            payload = await store_location_payload(FALLBACK_LOCATION, time.monotonic() + FETCH_DEADLINE)
+        except APIException as e:
+            raise ServiceUnavailable('Failed to determine your location and fallback location.') from e
+    return payload_response(request, payload, private=True, max_age=0)
+
+async def locate_client(request, deadline=None):
+    """Async version of views.locate_client."""
+    user_ip = client_ip(request)
+    if user_ip is None:
+        return None
+    table = await aget_ip_table()
+    if table is not None:
+        place = table.lookup(user_ip)
+        return place.city if place is not None else None
+    lookup = async_utils.get_location_from_ip(user_ip)
+    if deadline is None:
+        return city_from_location(await lookup)
+    try:
+        # Shielded, so a lookup past the deadline still finishes and caches its answer
+        return city_from_location(await asyncio.wait_for(
+            asyncio.shield(lookup), timeout=max(0, deadline - time.monotonic())))
+    except asyncio.TimeoutError:
+        logger.warning(f"Timed out fetching the location of {user_ip}")
+        return None
+
+async def get_user_location_view(request):
+    """Async version of views.get_user_location_view, with the same stage budgets."""
+    city_name = await locate_client(request, time.monotonic() + LOCATE_BUDGET)
+    if not city_name:
+        return await fallback_location_response(request, 'locate')
+
+    location = await sync_to_async(resolve_weather_location)(city_name)
+    payload = await aget_payload('user_location', location.key)
+    if payload is None:
+        try:
+            payload = await store_location_payload(location, time.monotonic() + LOCATION_WEATHER_BUDGET)
+        except APIException as e:
+            logger.warning(f"No weather for the location of the client, {city_name}: {e}")
+            return await fallback_location_response(request, 'weather')
+    return payload_response(request, payload, private=True)
+
+async def open_tile_stream(layer, z, x, y):
+    """Open a streamed request for a single OpenWeatherMap tile through the pooled async client."""
+    api_key = os.getenv('API_KEY')
+
+    if not api_key:
+        raise ServiceUnavailable("API key not configured")
+
+    client = async_utils.get_async_client()
+    try:
+        response = await TILE_RETRY_POLICY.aget(client, tile_url(layer, z, x, y, api_key), stream=True)
+    except httpx.TimeoutException:
+        raise ServiceUnavailable("Request timeout")
+    except httpx.HTTPError:
+        raise ServiceUnavailable("Error fetching tile")
+
+    if response.is_error:
+        await response.aclose()
+        raise ServiceUnavailable("Error fetching tile")
+    return response
+
+async def tile_response(request, layer, z, x, y):
+    """Serve a stored tile (or a 304), or stream it from upstream while teeing it into the store."""
+    stored_tile = await sync_to_async(get_stored_tile)(layer, z, x, y)
+    if stored_tile is not None:
+        return await astored_tile_response(request, stored_tile)
+
+    response = await open_tile_stream(layer, z, x, y)
+    django_response = streaming_tile_response(astream_tile, response, layer, z, x, y)
+    django_response['Expires'] = response.headers.get('Expires', '')
+    return django_response
+
+@require_http_methods(["GET"])
+async def map_tile_proxy(request, layer, z, x, y):
+    """
+    Async proxy for OpenWeatherMap tiles with caching and error handling.
+    """
+    django_response = await tile_response(request, layer, z, x, y)
+    django_response['Cache-Control'] = 'public, max-age=3600'
+    return django_response
+
+@require_http_methods(["GET"])
+async def map_tile_proxy_optimized(request, layer, z, x, y):
+    """
+    Async proxy for OpenWeatherMap tiles; the async client always pools connections.
+    """
+    django_response = await tile_response(request, layer, z, x, y)
+    django_response['Cache-Control'] = 'public, max-age=3600'
+    return django_response
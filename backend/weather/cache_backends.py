@@ -0,0 +1,322 @@
+import logging
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django_redis.cache import RedisCache
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Values of these types are shared between callers as-is; anything else
+# (e.g. the HttpResponse objects stored by cache_page) is kept pickled so
+# every hit gets its own copy.
+SHARED_TYPES = (str, bytes, int, float, bool, type(None), tuple, list, dict)
+
+LocalEntry = namedtuple('LocalEntry', ['value', 'pickled', 'expires_at'])
+
+class LocalLRU:
+    """Thread-safe in-process LRU with a bound on entries and a TTL per entry."""
+
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return ``(True, value)`` on a hit and ``(False, None)`` otherwise."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry.expires_at <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+        if entry.pickled:
+            return True, pickle.loads(entry.value)
+        return True, entry.value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        if timeout <= 0:
+            self.delete(key)
+            return
+        pickled = not isinstance(value, SHARED_TYPES)
+        entry = LocalEntry(
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL) if pickled else value,
+            pickled,
+            time.monotonic() + timeout,
+        )
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ProcessTier:
+    """
+    The L1 of one process: its LRU, the node id its invalidations are sent
+    with, and the single listener thread applying other nodes' invalidations.
+    """
+
+    def __init__(self, max_entries, timeout, channel):
+        self.local = LocalLRU(max_entries=max_entries, timeout=timeout)
+        self.channel = channel
+        self.node_id = uuid.uuid4().hex
+        self._listening = False
+        self._lock = threading.Lock()
+
+    def ensure_listener(self, get_client):
+        """Start the listener, subscribing with ``get_client()``, unless it runs already."""
+        if self._listening:
+            return
+        with self._lock:
+            if self._listening:
+                return
+            self._listening = True
+            threading.Thread(target=self._listen, args=(get_client,), name='cache-invalidation', daemon=True).start()
+
+    def _listen(self, get_client):
+        while True:
+            try:
+                pubsub = get_client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Anything written while we were not subscribed may be stale
+                self.local.clear()
+                for message in pubsub.listen():
+                    self.handle_invalidation(message['data'])
+            except Exception as e:
+                logger.warning(f"Cache invalidation listener failed: {e}")
+                self.local.clear()
+                time.sleep(1)
+
+    def handle_invalidation(self, data):
+        sender, _, key = data.decode('utf-8').partition(' ')
+        if sender == self.node_id:
+            return
+        if key == '*':
+            self.local.clear()
+        else:
+            self.local.delete(key)
+
+
+# Django creates a backend instance per thread and per async context, so the
+# L1 lives here, one per process and Redis location/channel.
+_tiers = {}
+_tiers_lock = threading.Lock()
+
+def get_process_tier(key, max_entries, timeout, channel):
+    """
+    Get this process's ProcessTier for ``key``. Threads do not survive a
+    fork, so a forked worker gets a fresh tier (and listener) of its own.
+    """
+    pid = os.getpid()
+    tier = _tiers.get((pid, key))
+    if tier is None:
+        with _tiers_lock:
+            tier = _tiers.get((pid, key))
+            if tier is None:
+                # Tiers inherited from the parent process are never used again
+                for stale in [k for k in _tiers if k[0] != pid]:
+                    del _tiers[stale]
+                tier = _tiers[(pid, key)] = ProcessTier(max_entries, timeout, channel)
+    return tier
+
+
+class TwoTierRedisCache(RedisCache):
+    """
+    django-redis backend with a per-process LRU (L1) in front of Redis (L2).
+
+    Reads are served from L1 when possible, saving the Redis round-trip and
+    unpickle for hot keys. Every write, delete or clear is published on a
+    Redis pub/sub channel, and each process drops the affected keys from its
+    L1, so workers on all nodes stay coherent; the L1 TTL bounds staleness if
+    a message is missed. Plain data (dicts, lists, strings, ...) is shared
+    between callers in a process and must be treated as read-only.
+
+    Extra OPTIONS:
+        L1_MAX_ENTRIES         entries kept per process (default 1024)
+        L1_TIMEOUT             seconds an entry may live in L1 (default 5)
+        INVALIDATION_CHANNEL   pub/sub channel name
+
+    Hits are counted per tier in weather.metrics under ``cache_tier``.
+    The L1 and the listener are shared by all instances in a process that
+    use the same Redis location and channel (see get_process_tier).
+    """
+
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        options = params.get('OPTIONS', {})
+        self.l1_max_entries = options.get('L1_MAX_ENTRIES', 1024)
+        self.l1_timeout = options.get('L1_TIMEOUT', 5)
+        self.channel = options.get('INVALIDATION_CHANNEL', 'weather:cache:invalidate')
+        self._tier_key = (str(server), self.channel)
+
+    @property
+    def tier(self):
+        return get_process_tier(self._tier_key, self.l1_max_entries, self.l1_timeout, self.channel)
+
+    @property
+    def local(self):
+        return self.tier.local
+
+    @property
+    def node_id(self):
+        return self.tier.node_id
+
+    # -- Invalidation -------------------------------------------------------
+
+    def _ensure_listener(self):
+        self.tier.ensure_listener(lambda: self.client.get_client(write=False))
+
+    def _publish(self, *keys):
+        try:
+            pipeline = self.client.get_client(write=True).pipeline(transaction=False)
+            for key in keys:
+                pipeline.publish(self.channel, f'{self.node_id} {key}')
+            pipeline.execute()
+        except Exception as e:
+            logger.warning(f"Failed to publish cache invalidation: {e}")
+
+    # -- Reads --------------------------------------------------------------
+
+    def get(self, key, default=None, version=None, client=None):
+        self._ensure_listener()
+        local_key = self.make_key(key, version=version)
+        hit, value = self.local.get(local_key)
+        if hit:
+            metrics.incr('cache_tier.l1_hit')
+            return value
+
+        sentinel = object()
+        value = super().get(key, default=sentinel, version=version, client=client)
+        if value is sentinel:
+            metrics.incr('cache_tier.miss')
+            return default
+        metrics.incr('cache_tier.l2_hit')
+        self.local.set(local_key, value)
+        return value
+
+    def get_many(self, keys, version=None, client=None):
+        self._ensure_listener()
+        found = {}
+        missing = []
+        for key in keys:
+            hit, value = self.local.get(self.make_key(key, version=version))
+            if hit:
+                found[key] = value
+            else:
+                missing.append(key)
+        if found:
+            metrics.incr('cache_tier.l1_hit', len(found))
+
+        if missing:
+            fetched = super().get_many(missing, version=version, client=client)
+            for key, value in fetched.items():
+                self.local.set(self.make_key(key, version=version), value)
+            found.update(fetched)
+            if fetched:
+                metrics.incr('cache_tier.l2_hit', len(fetched))
+            if len(fetched) < len(missing):
+                metrics.incr('cache_tier.miss', len(missing) - len(fetched))
+        return found
+
+    # -- Writes -------------------------------------------------------------
+
+    def _l1_timeout(self, timeout):
+        timeout = self.get_backend_timeout(timeout)
+        return None if timeout is None else max(timeout, 0)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, client=None, nx=False, xx=False):
+        self._ensure_listener()
+        result = super().set(key, value, timeout=timeout, version=version, client=client, nx=nx, xx=xx)
+        local_key = self.make_key(key, version=version)
+        if result and not nx and not xx:
+            self.local.set(local_key, value, self._l1_timeout(timeout))
+        else:
+            self.local.delete(local_key)
+        if result:
+            self._publish(local_key)
+        return result
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, client=None):
+        result = super().add(key, value, timeout=timeout, version=version, client=client)
+        if result:
+            local_key = self.make_key(key, version=version)
+            self.local.delete(local_key)
+            self._publish(local_key)
+        return result
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, client=None):
+        self._ensure_listener()
+        result = super().set_many(data, timeout=timeout, version=version, client=client)
+        local_keys = []
+        for key, value in data.items():
+            local_key = self.make_key(key, version=version)
+            self.local.set(local_key, value, self._l1_timeout(timeout))
+            local_keys.append(local_key)
+        self._publish(*local_keys)
+        return result
+
+    def delete(self, key, version=None, client=None):
+        result = super().delete(key, version=version, client=client)
+        local_key = self.make_key(key, version=version)
+        self.local.delete(local_key)
+        self._publish(local_key)
+        return result
+
+    def delete_many(self, keys, version=None, client=None):
+        result = super().delete_many(keys, version=version, client=client)
+        local_keys = [self.make_key(key, version=version) for key in keys]
+        for local_key in local_keys:
+            self.local.delete(local_key)
+        self._publish(*local_keys)
+        return result
+
+    def _invalidate_all(self):
+        self.local.clear()
+        self._publish('*')
+
+    def clear(self):
+        result = super().clear()
+        self._invalidate_all()
+        return result
+
+    def delete_pattern(self, *args, **kwargs):
+        result = super().delete_pattern(*args, **kwargs)
+        self._invalidate_all()
+        return result
+
+    def incr(self, key, delta=1, version=None, client=None, ignore_key_check=False):
+        result = super().incr(key, delta=delta, version=version, client=client, ignore_key_check=ignore_key_check)
+        local_key = self.make_key(key, version=version)
+        self.local.delete(local_key)
+        self._publish(local_key)
+        return result
+
+    def decr(self, key, delta=1, version=None, client=None):
+        return self.incr(key, delta=-delta, version=version, client=client)
+
+    def incr_version(self, *args, **kwargs):
+        result = super().incr_version(*args, **kwargs)
+        self._invalidate_all()
+        return result
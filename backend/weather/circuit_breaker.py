@@ -0,0 +1,178 @@
+"""
+Circuit breakers for upstream hosts.
+
+Breaker state lives in Redis, so every worker on every node sees the same
+view of a host: once one process has seen it fail, the others stop waiting
+on it too.
+
+- closed: calls go through. Outcomes are counted in fixed windows, and the
+  breaker opens when a window has at least ``failure_threshold`` failures
+  making up at least ``failure_ratio`` of its calls.
+- open: calls fail fast with CircuitOpen for ``reset_timeout`` seconds.
+- half-open: after that, one probe call at a time is let through. A success
+  closes the breaker, a failure opens it again.
+
+Redis being unavailable never blocks calls: the breaker then lets them through.
+"""
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django_redis import get_redis_connection
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+BREAKER_PREFIX = 'weather:breaker'
+FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+FAILURE_RATIO = 0.5
+WINDOW = 30 # Seconds per window of counted outcomes
+RESET_TIMEOUT = int(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+PROBE_TIMEOUT = 15 # Seconds before a probe that never reported back is given up
+TRIPPED_TIMEOUT = 86400 # Seconds a breaker stays half-open if nothing probes it
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Hosts reported by the metrics view even before this process has called them
+UPSTREAM_HOSTS = (
+    'api.openweathermap.org',
+    'tile.openweathermap.org',
+    'api.weatherapi.com',
+    'newsapi.org',
+    'ipapi.co',
+    'geocode.xyz',
+)
+
+
+class CircuitOpen(requests.ConnectionError, httpx.TransportError):
+    """
+    Raised instead of calling a host whose breaker is open. It is both a
+    requests and an httpx error, so sync and async callers handle it like
+    any other connection failure.
+    """
+
+
+class CircuitBreaker:
+    """Breaker for one upstream host; see the module docstring."""
+
+    def __init__(self, host, failure_threshold=FAILURE_THRESHOLD, failure_ratio=FAILURE_RATIO,
+                 window=WINDOW, reset_timeout=RESET_TIMEOUT, probe_timeout=PROBE_TIMEOUT):
+        self.host = host
+        self.key = f'{BREAKER_PREFIX}:{host}'
+        self.failure_threshold = failure_threshold
+        self.failure_ratio = failure_ratio
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+
+    def _window_keys(self):
+        window = int(time.time() // self.window)
+        return f'{self.key}:{window}:calls', f'{self.key}:{window}:failures'
+
+    def state(self):
+        is_open, tripped = get_redis_connection('default').mget(f'{self.key}:open', f'{self.key}:tripped')
+        if is_open:
+            return OPEN
+        if tripped:
+            return HALF_OPEN
+        return CLOSED
+
+    def allow(self):
+        """Whether a call may go out now."""
+        try:
+            state = self.state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and get_redis_connection('default').set(
+                    f'{self.key}:probe', 1, nx=True, ex=self.probe_timeout):
+                metrics.incr(f'breaker.{self.host}.probe')
+                return True
+        except Exception as e:
+            logger.warning(f"Circuit breaker for {self.host} unavailable: {e}")
+            return True
+        metrics.incr(f'breaker.{self.host}.rejected')
+        return False
+
+    def record_success(self):
+        calls_key, _ = self._window_keys()
+        try:
+            pipeline = get_redis_connection('default').pipeline(transaction=False)
+            pipeline.incr(calls_key)
+            pipeline.expire(calls_key, self.window * 2)
+            pipeline.get(f'{self.key}:tripped')
+            _, _, tripped = pipeline.execute()
+            if tripped:
+                self.reset()
+                logger.info(f"Circuit breaker for {self.host} closed.")
+                metrics.incr(f'breaker.{self.host}.closed')
+        except Exception as e:
+            logger.warning(f"Failed to record success for {self.host}: {e}")
+
+    def record_failure(self):
+        calls_key, failures_key = self._window_keys()
+        try:
+            pipeline = get_redis_connection('default').pipeline(transaction=False)
+            pipeline.incr(calls_key)
+            pipeline.expire(calls_key, self.window * 2)
+            pipeline.incr(failures_key)
+            pipeline.expire(failures_key, self.window * 2)
+            pipeline.get(f'{self.key}:tripped')
+            calls, _, failures, _, tripped = pipeline.execute()
+        except Exception as e:
+            logger.warning(f"Failed to record failure for {self.host}: {e}")
+            return
+        metrics.incr(f'breaker.{self.host}.failure')
+        # A failed probe reopens the breaker straight away
+        if tripped or (failures >= self.failure_threshold and failures >= self.failure_ratio * calls):
+            self.trip()
+
+    def trip(self):
+        try:
+            pipeline = get_redis_connection('default').pipeline(transaction=False)
+            pipeline.set(f'{self.key}:open', 1, ex=self.reset_timeout)
+            pipeline.set(f'{self.key}:tripped', 1, ex=TRIPPED_TIMEOUT)
+            pipeline.delete(f'{self.key}:probe')
+            pipeline.execute()
+        except Exception as e:
+            logger.warning(f"Failed to open circuit breaker for {self.host}: {e}")
+            return
+        logger.warning(f"Circuit breaker for {self.host} opened for {self.reset_timeout}s.")
+        metrics.incr(f'breaker.{self.host}.opened')
+
+    def reset(self):
+        """Close the breaker and forget the current window."""
+        get_redis_connection('default').delete(
+            f'{self.key}:open', f'{self.key}:tripped', f'{self.key}:probe', *self._window_keys()
+        )
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(url):
+    """Get the per-process breaker object for the host of ``url``."""
+    host = urlsplit(url).hostname or ''
+    breaker = _breakers.get(host)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(host, CircuitBreaker(host))
+    return breaker
+
+def breaker_states():
+    """State of the breaker of every known upstream host."""
+    hosts = sorted(set(UPSTREAM_HOSTS) | set(_breakers))
+    states = {}
+    for host in hosts:
+        try:
+            states[host] = get_breaker(f'//{host}').state()
+        except Exception as e:
+            logger.warning(f"Circuit breaker for {host} unavailable: {e}")
+            states[host] = 'unknown'
+    return states
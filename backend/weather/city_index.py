@@ -0,0 +1,148 @@
+import logging
+import os
+import threading
+import time
+from array import array
+
+from .city_snapshot import MISSING_RETRY, get_city_snapshot
+
+logger = logging.getLogger(__name__)
+
+MAX_GRAM = 3
+
+def grams(text, size):
+    """Return the distinct substrings of ``text`` with the given length."""
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+class CityIndex:
+    """
+    Substring index over city names for the search suggestions endpoint.
+
+    Every name is broken into its distinct 1-, 2- and 3-character grams, and
+    each gram maps to the ascending positions of the names that contain it.
+    A query is answered from the postings of its rarest gram (shorter queries
+    use their own gram directly), checking each candidate with a plain
+    substring test. Positions are visited in list order, so the results match
+    a linear ``query in name.lower()`` scan over the original list.
+    """
+
+    def __init__(self, names, snapshot=None):
+        self.names = list(names)
+        self.snapshot = snapshot
+        self.lowered = [name.lower() for name in self.names]
+
+        postings = {}
+        for position, name in enumerate(self.lowered):
+            for size in range(1, MAX_GRAM + 1):
+                for gram in grams(name, size):
+                    postings.setdefault(gram, []).append(position)
+        # Compact the postings into unsigned int arrays (4 bytes per entry)
+        self.postings = {gram: array('I', positions) for gram, positions in postings.items()}
+
+    @classmethod
+    def from_city_list(cls, cities):
+        return cls(city['name'] for city in cities)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Index the names of a CitySnapshot; positions line up with its columns."""
+        return cls(snapshot.names(), snapshot=snapshot)
+
+    def __len__(self):
+        return len(self.names)
+
+    def candidates(self, query):
+        """Positions that may contain ``query``, from the shortest postings list."""
+        if len(query) <= MAX_GRAM:
+            return self.postings.get(query, ())
+
+        shortest = None
+        for gram in grams(query, MAX_GRAM):
+            positions = self.postings.get(gram)
+            if positions is None:
+                return ()
+            if shortest is None or len(positions) < len(shortest):
+                shortest = positions
+        return shortest
+
+    def search(self, query, limit=10):
+        """Return up to ``limit`` names containing ``query``, in city list order."""
+        query = query.lower()
+        if not query:
+            return []
+
+        results = []
+        lowered = self.lowered
+        for position in self.candidates(query):
+            if query in lowered[position]:
+                results.append(self.names[position])
+                if len(results) >= limit:
+                    break
+        return results
+
+
+_city_index = None
+_city_index_build_pid = None
+_city_index_failed_at = None
+_city_index_lock = threading.Lock()
+
+def build_city_index():
+    """
+    Build the city index from the city snapshot and keep it for this
+    process. An empty city list (e.g. update_city_list has not run) is not
+    kept, and no build is started again for MISSING_RETRY seconds.
+    """
+    global _city_index, _city_index_failed_at
+    index = CityIndex.from_snapshot(get_city_snapshot())
+    if not len(index):
+        _city_index_failed_at = time.monotonic()
+        return index
+    logger.info(f"City index built with {len(index)} cities.")
+    _city_index = index
+    return index
+
+def _build_in_background():
+    global _city_index_build_pid, _city_index_failed_at
+    try:
+        build_city_index()
+    except Exception as e:
+        logger.warning(f"Building the city index failed: {e}")
+        _city_index_failed_at = time.monotonic()
+    finally:
+        _city_index_build_pid = None
+
+def preload_city_index():
+    """
+    Start building the city index on a background thread, unless this
+    process has it or is building it. Called at worker startup from the
+    WSGI and ASGI entry points, since building takes seconds and hundreds of
+    megabytes for the full city list.
+    """
+    global _city_index_build_pid
+    if _city_index is not None:
+        return
+    with _city_index_lock:
+        # Threads do not survive a fork, so a build started in the parent does not count
+        if _city_index is not None or _city_index_build_pid == os.getpid():
+            return
+        if _city_index_failed_at is not None and time.monotonic() - _city_index_failed_at < MISSING_RETRY:
+            return
+        _city_index_build_pid = os.getpid()
+    threading.Thread(target=_build_in_background, name='city-index', daemon=True).start()
+
+def get_city_index():
+    """
+    Get the per-process city index, or None while it is not built yet. It is
+    never built on the caller's thread: a missing index is built in the
+    background (see preload_city_index).
+    """
+    if _city_index is None:
+        preload_city_index()
+    return _city_index
+
+def reset_city_index():
+    """Drop the per-process index so it is rebuilt from the current city list."""
+    global _city_index, _city_index_build_pid, _city_index_failed_at
+    _city_index = None
+    _city_index_build_pid = None
+    _city_index_failed_at = None
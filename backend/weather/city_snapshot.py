@@ -0,0 +1,216 @@
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+
+from .utils import get_cached_city_list
+
+logger = logging.getLogger(__name__)
+
+# File layout (little-endian):
+#   header        magic, city count, size of the names blob
+#   ids           uint32 x count
+#   lats, lons    float32 x count each
+#   name offsets  uint32 x (count + 1), into the names blob
+#   countries     2 ASCII bytes x count, NUL padded
+#   name order    uint32 x count, positions sorted by lowercased name
+#   names         UTF-8 blob
+MAGIC = b'CITYSNP2'
+HEADER = struct.Struct('<8sII')
+MISSING_RETRY = 60 # Seconds before a missing snapshot and city list are looked for again
+
+def pack_city_list(cities):
+    """Encode an OpenWeatherMap city list into the columnar snapshot format."""
+    ids = array('I')
+    lats = array('f')
+    lons = array('f')
+    offsets = array('I', [0])
+    countries = bytearray()
+    names = bytearray()
+    lowered = []
+
+    for city in cities:
+        coord = city.get('coord') or {}
+        ids.append(int(city.get('id') or 0))
+        lats.append(float(coord.get('lat') or 0.0))
+        lons.append(float(coord.get('lon') or 0.0))
+        countries += (city.get('country') or '').encode('ascii', 'replace')[:2].ljust(2, b'\0')
+        names += city['name'].encode('utf-8')
+        offsets.append(len(names))
+        lowered.append(city['name'].lower())
+    name_order = array('I', sorted(range(len(lowered)), key=lowered.__getitem__))
+
+    if sys.byteorder != 'little':
+        for column in (ids, lats, lons, offsets, name_order):
+            column.byteswap()
+
+    return b''.join([
+        HEADER.pack(MAGIC, len(ids), len(names)),
+        ids.tobytes(),
+        lats.tobytes(),
+        lons.tobytes(),
+        offsets.tobytes(),
+        bytes(countries),
+        name_order.tobytes(),
+        bytes(names),
+    ])
+
+def write_city_snapshot(cities, path):
+    """Atomically write the snapshot for ``cities`` to ``path``."""
+    data = pack_city_list(cities)
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.city_snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(data)
+
+class CitySnapshot:
+    """
+    Read-only view over a packed city list. When opened from a file the data
+    is memory-mapped, so every worker process shares one page-cached copy and
+    nothing is parsed up front.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        magic, count, names_size = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a city snapshot')
+        self.count = count
+
+        view = memoryview(buffer)
+        offset = HEADER.size
+        self.ids_start = offset
+        self.ids, offset = self._column(view, offset, 'I', count)
+        self.lats, offset = self._column(view, offset, 'f', count)
+        self.lons, offset = self._column(view, offset, 'f', count)
+        self.name_offsets, offset = self._column(view, offset, 'I', count + 1)
+        self.countries = view[offset:offset + 2 * count]
+        offset += 2 * count
+        self.name_order, offset = self._column(view, offset, 'I', count)
+        self.names_blob = view[offset:offset + names_size]
+
+    @staticmethod
+    def _column(view, offset, typecode, count):
+        size = array(typecode).itemsize * count
+        column = view[offset:offset + size]
+        if sys.byteorder == 'little':
+            column = column.cast(typecode)
+        else:
+            column = array(typecode, column)
+            column.byteswap()
+        return column, offset + size
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def from_city_list(cls, cities):
+        return cls(pack_city_list(cities))
+
+    def __len__(self):
+        return self.count
+
+    def name(self, position):
+        start, end = self.name_offsets[position], self.name_offsets[position + 1]
+        return str(self.names_blob[start:end], 'utf-8')
+
+    def names(self):
+        return [self.name(position) for position in range(self.count)]
+
+    def country(self, position):
+        return bytes(self.countries[2 * position:2 * position + 2]).rstrip(b'\0').decode('ascii')
+
+    def find(self, city_id):
+        """Position of the city with OpenWeatherMap id ``city_id``, or None."""
+        if not 0 <= city_id < 2 ** 32:
+            return None
+        # Search the raw id column in C rather than walking it in Python
+        needle = struct.pack('<I', city_id)
+        start, end = self.ids_start, self.ids_start + 4 * self.count
+        while True:
+            found = self.buffer.find(needle, start, end)
+            if found < 0:
+                return None
+            if (found - self.ids_start) % 4 == 0:
+                return (found - self.ids_start) // 4
+            start = found + 1
+
+    def resolve(self, name):
+        """
+        Position of the only city called ``name`` (ignoring case), or None if
+        none or several are, by binary search over the name order column.
+        """
+        query = name.lower()
+        order = self.name_order
+        i = bisect_left(order, query, key=lambda position: self.name(position).lower())
+        if i == self.count or self.name(order[i]).lower() != query:
+            return None
+        if i + 1 < self.count and self.name(order[i + 1]).lower() == query:
+            return None
+        return order[i]
+
+    def city(self, position):
+        """Rebuild the city list entry stored at ``position``."""
+        return {
+            'id': self.ids[position],
+            'name': self.name(position),
+            'country': self.country(position),
+            'coord': {'lat': self.lats[position], 'lon': self.lons[position]},
+        }
+
+
+_city_snapshot = None
+_city_snapshot_missing_since = None
+_city_snapshot_lock = threading.Lock()
+
+def get_city_snapshot():
+    """
+    Get the per-process city snapshot, mapping the file written by
+    update_city_list when it exists and falling back to packing the city
+    list already in the cache otherwise. The list is never downloaded here,
+    since this runs on the request path: until update_city_list has run the
+    snapshot is empty, cities are keyed by name, and the file and cache are
+    looked at again after MISSING_RETRY seconds.
+    """
+    global _city_snapshot, _city_snapshot_missing_since
+    if _city_snapshot is None:
+        if (_city_snapshot_missing_since is not None
+                and time.monotonic() - _city_snapshot_missing_since < MISSING_RETRY):
+            return CitySnapshot.from_city_list([])
+        with _city_snapshot_lock:
+            if _city_snapshot is None:
+                path = settings.CITY_SNAPSHOT_PATH
+                try:
+                    snapshot = CitySnapshot.open(path)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"City snapshot unavailable at {path} ({e}), using the cached city list.")
+                    snapshot = CitySnapshot.from_city_list(get_cached_city_list())
+                if not len(snapshot):
+                    _city_snapshot_missing_since = time.monotonic()
+                    return snapshot
+                _city_snapshot = snapshot
+                _city_snapshot_missing_since = None
+    return _city_snapshot
+
+def reset_city_snapshot():
+    """Drop the per-process snapshot so the next call reopens the file."""
+    global _city_snapshot, _city_snapshot_missing_since
+    _city_snapshot = None
+    _city_snapshot_missing_since = None
@@ -0,0 +1,86 @@
+"""
+Compact wire format of the weather payload, served with ``format=compact``.
+
+Forecasts become column arrays instead of lists of dicts, and the condition
+texts and icon URLs, which repeat across hours and days, are stored once in
+the ``conditions`` and ``icons`` lookup tables and referenced by index::
+
+    {
+        "format": "compact",
+        "city_name": "Toronto", "temperature": 3.2, ...,
+        "conditions": ["Sunny", "Clear"],
+        "icons": ["//cdn.weatherapi.com/weather/64x64/day/113.png"],
+        "hourly_forecast": {"time": ["00:00", ...], "temperature": [1.4, ...],
+                            "condition": [1, ...], "icon": [0, ...]},
+        "daily_forecast": {"date": [...], "maxtemp": [...], "mintemp": [...],
+                           "condition": [0, ...], "icon": [0, ...]}
+    }
+
+Scalar fields are the same as in the full payload.
+"""
+COMPACT_FORMAT = 'compact'
+
+HOURLY_COLUMNS = ('time', 'temperature')
+DAILY_COLUMNS = ('date', 'maxtemp', 'mintemp')
+
+
+class LookupTable:
+    """Assigns each distinct value an index, in order of first appearance."""
+
+    def __init__(self):
+        self.indexes = {}
+
+    def index(self, value):
+        return self.indexes.setdefault(value, len(self.indexes))
+
+    def values(self):
+        return list(self.indexes)
+
+
+def _columns(rows, columns, condition_key, conditions, icons):
+    encoded = {column: [row.get(column) for row in rows] for column in columns}
+    encoded['condition'] = [conditions.index(row.get(condition_key, '')) for row in rows]
+    encoded['icon'] = [icons.index(row.get('icon', '')) for row in rows]
+    return encoded
+
+
+def compact_weather_payload(data):
+    """Compact form of a payload built by build_weather_payload."""
+    conditions = LookupTable()
+    icons = LookupTable()
+    compact = {
+        key: value for key, value in data.items()
+        if key not in ('hourly_forecast', 'daily_forecast')
+    }
+    compact['format'] = COMPACT_FORMAT
+    hourly = _columns(data.get('hourly_forecast', []), HOURLY_COLUMNS, 'description', conditions, icons)
+    daily = _columns(data.get('daily_forecast', []), DAILY_COLUMNS, 'condition', conditions, icons)
+    compact['conditions'] = conditions.values()
+    compact['icons'] = icons.values()
+    compact['hourly_forecast'] = hourly
+    compact['daily_forecast'] = daily
+    return compact
+
+
+def expand_weather_payload(compact):
+    """Inverse of compact_weather_payload, for clients and tests."""
+    conditions = compact['conditions']
+    icons = compact['icons']
+
+    def rows(columns, names, condition_key):
+        count = len(columns['condition'])
+        return [
+            dict(
+                {name: columns[name][i] for name in names},
+                **{condition_key: conditions[columns['condition'][i]], 'icon': icons[columns['icon'][i]]},
+            )
+            for i in range(count)
+        ]
+
+    data = {
+        key: value for key, value in compact.items()
+        if key not in ('format', 'conditions', 'icons', 'hourly_forecast', 'daily_forecast')
+    }
+    data['hourly_forecast'] = rows(compact['hourly_forecast'], HOURLY_COLUMNS, 'description')
+    data['daily_forecast'] = rows(compact['daily_forecast'], DAILY_COLUMNS, 'condition')
+    return data
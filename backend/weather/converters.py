@@ -0,0 +1,20 @@
+class FloatConverter:
+    """Path converter for signed decimal numbers such as coordinates."""
+    regex = r'-?\d+(?:\.\d+)?'
+
+    def to_python(self, value):
+        return float(value)
+
+    def to_url(self, value):
+        return repr(float(value))
+
+
+class LayerConverter:
+    """Path converter for map tile layer names such as ``temp_new``; they become directory names in the tile store."""
+    regex = r'[a-z0-9_]+'
+
+    def to_python(self, value):
+        return value
+
+    def to_url(self, value):
+        return value
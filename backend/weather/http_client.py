@@ -0,0 +1,171 @@
+"""
+Pooled HTTP clients used for every upstream call.
+
+The sync side is one requests.Session per process, with keep-alive pools for
+both http:// and https:// hosts; the async side is one httpx.AsyncClient per
+event loop. Both always send a timeout (DEFAULT_TIMEOUT unless the caller
+passes one) and report every request, with its duration and error, to the
+registered hooks. The built-in hook counts requests, errors and latency per
+host in weather.metrics under ``upstream``.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 10
+USER_AGENT = 'WeatherApp/1.0'
+# Sync pools: one per host (pool_connections), each keeping up to pool_maxsize sockets
+POOL_CONNECTIONS = int(os.getenv('UPSTREAM_POOL_CONNECTIONS', '16'))
+POOL_MAXSIZE = int(os.getenv('UPSTREAM_POOL_MAXSIZE', '32'))
+# Per-host pool_maxsize overrides, e.g. "tile.openweathermap.org=64,ipapi.co=8"
+POOL_MAXSIZE_BY_HOST = {
+    'tile.openweathermap.org': 64,  # A map view fans out into dozens of tile requests
+    'bulk.openweathermap.org': 2,  # Only the city list download
+    'ipapi.co': 8,
+    'geocode.xyz': 8,
+}
+
+
+def parse_pool_sizes(value):
+    """Parse ``host=maxsize`` pairs separated by commas into a dict."""
+    sizes = {}
+    for part in value.split(','):
+        host, sep, size = part.partition('=')
+        if not sep or not host.strip():
+            continue
+        try:
+            sizes[host.strip().lower()] = int(size)
+        except ValueError:
+            logger.warning("Ignoring invalid upstream pool size %r", part)
+    return sizes
+
+
+POOL_MAXSIZE_BY_HOST.update(parse_pool_sizes(os.getenv('UPSTREAM_POOL_MAXSIZE_BY_HOST', '')))
+ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', '500'))
+ASYNC_MAX_KEEPALIVE = int(os.getenv('ASYNC_MAX_KEEPALIVE', '100'))
+
+_hooks = []
+
+def add_hook(hook):
+    """
+    Call ``hook(method, url, status_code, elapsed, error)`` after every
+    upstream request. ``status_code`` is None when the request failed, and
+    ``error`` is None when it did not.
+    """
+    _hooks.append(hook)
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+def metrics_hook(method, url, status_code, elapsed, error):
+    host = urlsplit(str(url)).hostname or 'unknown'
+    metrics.incr(f'upstream.{host}.requests')
+    metrics.incr(f'upstream.{host}.latency_ms', int(elapsed * 1000))
+    if error is not None:
+        metrics.incr(f'upstream.{host}.errors')
+
+add_hook(metrics_hook)
+
+def report(method, url, status_code, elapsed, error=None):
+    for hook in list(_hooks):
+        try:
+            hook(method, url, status_code, elapsed, error)
+        except Exception as e:
+            logger.warning(f"Upstream request hook {hook!r} failed: {e}")
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """HTTPAdapter that applies the default timeout and reports every request."""
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+        start = time.monotonic()
+        try:
+            response = super().send(request, timeout=timeout, **kwargs)
+        except Exception as e:
+            report(request.method, request.url, None, time.monotonic() - start, e)
+            raise
+        report(request.method, request.url, response.status_code, time.monotonic() - start)
+        return response
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_http_session():
+    """Get or create the pooled session shared by all sync upstream calls in this process."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.headers['User-Agent'] = USER_AGENT
+                # Retries are left to the deadline-aware weather.retry.RetryPolicy
+                adapter = InstrumentedAdapter(
+                    pool_connections=POOL_CONNECTIONS,
+                    pool_maxsize=POOL_MAXSIZE,
+                    max_retries=0,
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                # requests picks the longest matching prefix, so these win for their host
+                for host, maxsize in POOL_MAXSIZE_BY_HOST.items():
+                    host_adapter = InstrumentedAdapter(pool_connections=1, pool_maxsize=maxsize, max_retries=0)
+                    session.mount(f'http://{host}/', host_adapter)
+                    session.mount(f'https://{host}/', host_adapter)
+                _session = session
+    return _session
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Async transport wrapper that reports every request, like InstrumentedAdapter."""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        start = time.monotonic()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception as e:
+            report(request.method, request.url, None, time.monotonic() - start, e)
+            raise
+        report(request.method, request.url, response.status_code, time.monotonic() - start)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+# httpx clients are bound to the event loop that created them, so keep one per loop
+_clients = weakref.WeakKeyDictionary()
+
+def get_async_client():
+    """Get or create the pooled async HTTP client for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(
+            max_connections=ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=ASYNC_MAX_KEEPALIVE,
+        ))
+        client = httpx.AsyncClient(
+            transport=InstrumentedTransport(transport),
+            timeout=DEFAULT_TIMEOUT,
+            headers={'User-Agent': USER_AGENT},
+        )
+        _clients[loop] = client
+    return client
@@ -0,0 +1,258 @@
+import csv
+import ipaddress
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# File layout (little-endian unless noted), written by `manage.py load_ip_ranges`:
+#   header          magic, IPv4 range count, IPv6 range count, place count, size of the names blob
+#   IPv4 ranges     first address, last address (uint32 x count each), place (uint32 x count)
+#   IPv6 ranges     first address, last address (16 big-endian bytes x count each), place (uint32 x count)
+#   places          lats, lons (float32 x count each), name offsets (uint32 x (count + 1)),
+#                   countries (2 ASCII bytes x count, NUL padded)
+#   names           UTF-8 blob of city names
+# Ranges are sorted by first address and do not overlap; places are shared between ranges.
+MAGIC = b'IPRANGE1'
+HEADER = struct.Struct('<8sIIII')
+MISSING_RETRY = 60 # Seconds before a missing table file is looked for again
+
+IPPlace = namedtuple('IPPlace', ['city', 'country', 'lat', 'lon'])
+
+def read_dbip_csv(lines):
+    """
+    Yield (first, last, city, country, lat, lon) from the rows of a DB-IP
+    "IP to City Lite" CSV: first address, last address, continent, country,
+    region, city, latitude, longitude.
+    """
+    for row in csv.reader(lines):
+        if len(row) < 8 or not row[5]:
+            continue
+        try:
+            first, last = ipaddress.ip_address(row[0]), ipaddress.ip_address(row[1])
+            lat, lon = float(row[6]), float(row[7])
+        except ValueError:
+            continue
+        yield first, last, row[5], row[3], lat, lon
+
+def _sorted_columns(firsts, lasts, places):
+    """The columns in order of first address; DB-IP files already are, so this rarely sorts."""
+    if all(firsts[i] < firsts[i + 1] for i in range(len(firsts) - 1)):
+        return firsts, lasts, places
+    order = sorted(range(len(firsts)), key=firsts.__getitem__)
+    return ([column[i] for i in order] for column in (firsts, lasts, places))
+
+def pack_ip_ranges(rows):
+    """Encode (first, last, city, country, lat, lon) rows into the IP range table format."""
+    # Built column by column rather than as a tuple per range: a full file has millions of ranges
+    columns = {4: (array('I'), array('I'), array('I')), 6: ([], [], array('I'))}
+    places = {}
+    for first, last, city, country, lat, lon in rows:
+        if first.version != last.version or int(last) < int(first):
+            continue
+        place = places.setdefault((city, country, lat, lon), len(places))
+        firsts, lasts, range_places = columns[first.version]
+        firsts.append(int(first))
+        lasts.append(int(last))
+        range_places.append(place)
+
+    v4_first, v4_last, v4_places = _sorted_columns(*columns[4])
+    v4_first, v4_last, v4_places = array('I', v4_first), array('I', v4_last), array('I', v4_places)
+
+    v6_first, v6_last, v6_places = _sorted_columns(*columns[6])
+    v6_first = b''.join(address.to_bytes(16, 'big') for address in v6_first)
+    v6_last = b''.join(address.to_bytes(16, 'big') for address in v6_last)
+    v6_places = array('I', v6_places)
+
+    lats, lons, offsets = array('f'), array('f'), array('I', [0])
+    countries, names = bytearray(), bytearray()
+    for city, country, lat, lon in places:
+        lats.append(lat)
+        lons.append(lon)
+        countries += country.encode('ascii', 'replace')[:2].ljust(2, b'\0')
+        names += city.encode('utf-8')
+        offsets.append(len(names))
+
+    if sys.byteorder != 'little':
+        for column in (v4_first, v4_last, v4_places, v6_places, lats, lons, offsets):
+            column.byteswap()
+
+    return b''.join([
+        HEADER.pack(MAGIC, len(v4_first), len(v6_places), len(places), len(names)),
+        v4_first.tobytes(), v4_last.tobytes(), v4_places.tobytes(),
+        v6_first, v6_last, v6_places.tobytes(),
+        lats.tobytes(), lons.tobytes(), offsets.tobytes(),
+        bytes(countries), bytes(names),
+    ])
+
+def write_ip_ranges(rows, path):
+    """Atomically write the IP range table for ``rows`` to ``path``."""
+    data = pack_ip_ranges(rows)
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.ip_ranges-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(data)
+
+class _Addresses:
+    """Sequence view over a column of 16-byte big-endian addresses, which compare like the numbers."""
+
+    def __init__(self, view):
+        self.view = view
+
+    def __len__(self):
+        return len(self.view) // 16
+
+    def __getitem__(self, i):
+        return bytes(self.view[16 * i:16 * i + 16])
+
+class IPRangeTable:
+    """
+    Read-only view over a packed IP range table. When opened from a file the
+    data is memory-mapped, as the city snapshot is, and an address is found
+    by binary search over the sorted first addresses of its family.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        magic, v4_count, v6_count, place_count, names_size = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError('Not an IP range table')
+
+        view = memoryview(buffer)
+        offset = HEADER.size
+        self.v4_first, offset = self._column(view, offset, 'I', v4_count)
+        self.v4_last, offset = self._column(view, offset, 'I', v4_count)
+        self.v4_places, offset = self._column(view, offset, 'I', v4_count)
+        self.v6_first = _Addresses(view[offset:offset + 16 * v6_count])
+        offset += 16 * v6_count
+        self.v6_last = _Addresses(view[offset:offset + 16 * v6_count])
+        offset += 16 * v6_count
+        self.v6_places, offset = self._column(view, offset, 'I', v6_count)
+        self.lats, offset = self._column(view, offset, 'f', place_count)
+        self.lons, offset = self._column(view, offset, 'f', place_count)
+        self.name_offsets, offset = self._column(view, offset, 'I', place_count + 1)
+        self.countries = view[offset:offset + 2 * place_count]
+        offset += 2 * place_count
+        self.names_blob = view[offset:offset + names_size]
+
+    @staticmethod
+    def _column(view, offset, typecode, count):
+        size = array(typecode).itemsize * count
+        column = view[offset:offset + size]
+        if sys.byteorder == 'little':
+            column = column.cast(typecode)
+        else:
+            column = array(typecode, column)
+            column.byteswap()
+        return column, offset + size
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls(pack_ip_ranges(rows))
+
+    def __len__(self):
+        return len(self.v4_first) + len(self.v6_places)
+
+    def place(self, position):
+        start, end = self.name_offsets[position], self.name_offsets[position + 1]
+        country = bytes(self.countries[2 * position:2 * position + 2]).rstrip(b'\0').decode('ascii')
+        return IPPlace(str(self.names_blob[start:end], 'utf-8'), country,
+                       self.lats[position], self.lons[position])
+
+    def lookup(self, address):
+        """IPPlace of an address (a string or ipaddress object), or None if no range holds it."""
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+
+        if address.version == 4:
+            key, first, last, places = int(address), self.v4_first, self.v4_last, self.v4_places
+        else:
+            key, first, last, places = address.packed, self.v6_first, self.v6_last, self.v6_places
+        i = bisect_right(first, key) - 1
+        if i < 0 or key > last[i]:
+            return None
+        return self.place(places[i])
+
+
+def client_ip(request):
+    """
+    Public address of the client, or None. Behind settings.TRUSTED_PROXY_HOPS
+    proxies that each append to X-Forwarded-For, it is the entry that many
+    places from the right, appended by the outermost of them; entries further
+    left come from the client and are ignored. With no trusted proxies, or
+    fewer entries than proxies, it is REMOTE_ADDR.
+    """
+    hops = settings.TRUSTED_PROXY_HOPS
+    forwarded = [part.strip() for part in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if part.strip()]
+    candidate = forwarded[-hops] if 0 < hops <= len(forwarded) else request.META.get('REMOTE_ADDR', '')
+    try:
+        address = ipaddress.ip_address(candidate)
+    except ValueError:
+        return None
+    return str(address) if address.is_global else None
+
+
+_ip_table = None
+_ip_table_missing_since = None
+_ip_table_lock = threading.Lock()
+
+def get_ip_table():
+    """
+    Get the per-process IP range table, mapping the file written by
+    load_ip_ranges, or None when there is none. A missing file is looked for
+    again after MISSING_RETRY seconds.
+    """
+    global _ip_table, _ip_table_missing_since
+    if _ip_table is None:
+        if _ip_table_missing_since is not None and time.monotonic() - _ip_table_missing_since < MISSING_RETRY:
+            return None
+        with _ip_table_lock:
+            if _ip_table is None:
+                path = settings.IP_RANGES_PATH
+                try:
+                    _ip_table = IPRangeTable.open(path)
+                    _ip_table_missing_since = None
+                except (OSError, ValueError) as e:
+                    logger.warning(f"IP range table unavailable at {path}: {e}")
+                    _ip_table_missing_since = time.monotonic()
+    return _ip_table
+
+async def aget_ip_table():
+    """Async version of get_ip_table; the file is only opened off the event loop."""
+    if _ip_table is not None:
+        return _ip_table
+    return await sync_to_async(get_ip_table)()
+
+def reset_ip_table():
+    """Drop the per-process table so the next call reopens the file."""
+    global _ip_table, _ip_table_missing_since
+    _ip_table = None
+    _ip_table_missing_since = None
@@ -0,0 +1,115 @@
+"""
+Locations weather is fetched and cached for. Each has a canonical ``key``
+(``city:<id>`` for cities in the city list, ``name:<name>`` otherwise,
+``coord:<lat>,<lon>`` for coordinates) and the queries the upstream APIs are
+asked with.
+
+Coordinates are snapped to the centre of a COORDINATE_GRID degree grid cell
+before they are keyed, so users a few metres apart, or one user whose browser
+reports a slightly different position on every call, share a cached
+observation. The cell size trades hit rate for accuracy: a 0.01 degree cell
+is about 1.1 km north to south (less east to west away from the equator), so
+the weather served may be for a point up to ~0.8 km away, which is well
+within the spacing of the stations OpenWeatherMap interpolates from. Coarser
+cells give more hits and less local weather; 0 keys on the exact position.
+Benchmarks/coordinate_cache_bench.py measures both sides for a few sizes.
+"""
+import logging
+import math
+import os
+from collections import namedtuple
+
+from .city_snapshot import get_city_snapshot
+from .nearest_city import get_nearest_city_index
+
+logger = logging.getLogger(__name__)
+
+COORDINATE_GRID = float(os.getenv('COORDINATE_GRID', '0.01')) # Degrees
+
+WeatherLocation = namedtuple('WeatherLocation', ['key', 'name', 'owm_query', 'weatherapi_query'])
+
+# Served by the user-location view when the client cannot be located. Spelled
+# out rather than resolved so it is usable before the city list is loaded.
+FALLBACK_LOCATION = WeatherLocation('city:6167865', 'Toronto', 'id=6167865', '43.7001,-79.4163')
+
+def resolve_weather_location(city_name):
+    """
+    Map a requested city name to the identity its weather is cached under.
+    Case and extra whitespace are ignored, and a name that matches exactly one
+    city in the city list resolves to its OpenWeatherMap id, which is also
+    what the upstream APIs are asked for. Unknown or ambiguous names stay
+    keyed by the normalized name and are passed upstream as given.
+    """
+    name = ' '.join(city_name.split())
+    try:
+        snapshot = get_city_snapshot()
+        position = snapshot.resolve(name)
+    except Exception as e:
+        logger.warning(f"City snapshot unavailable, keying weather by name: {e}")
+        position = None
+
+    if position is not None:
+        return snapshot_location(snapshot, position)
+    return WeatherLocation(f'name:{name.casefold()}', name, f'q={name}', name)
+
+def snapshot_location(snapshot, position):
+    city_id = snapshot.ids[position]
+    return WeatherLocation(
+        f'city:{city_id}',
+        snapshot.name(position),
+        f'id={city_id}',
+        f'{snapshot.lats[position]:.4f},{snapshot.lons[position]:.4f}',
+    )
+
+def weather_location_for_id(city_id):
+    """
+    Location of an OpenWeatherMap city id. Ids missing from the city list get
+    their name and forecast coordinates from the OpenWeatherMap response.
+    """
+    try:
+        snapshot = get_city_snapshot()
+        position = snapshot.find(city_id)
+    except Exception as e:
+        logger.warning(f"City snapshot unavailable, looking up id {city_id} upstream: {e}")
+        position = None
+
+    if position is not None:
+        return snapshot_location(snapshot, position)
+    return WeatherLocation(f'city:{city_id}', None, f'id={city_id}', None)
+
+def snap_coordinates(lat, lon, grid=None):
+    """Centre of the ``grid`` degree cell (COORDINATE_GRID by default) holding a point."""
+    grid = COORDINATE_GRID if grid is None else grid
+    lon = (lon + 180) % 360 - 180
+    if grid <= 0:
+        return lat, lon
+
+    def centre(value):
+        return round((math.floor(value / grid) + 0.5) * grid, 6)
+    return min(max(centre(lat), -90.0), 90.0), centre(lon)
+
+def coordinate_location(lat, lon, grid=None):
+    """Location of a point given by its coordinates, snapped to its grid cell."""
+    lat, lon = snap_coordinates(lat, lon, grid)
+    return WeatherLocation(
+        f'coord:{lat:.4f},{lon:.4f}',
+        None,
+        f'lat={lat:.4f}&lon={lon:.4f}',
+        f'{lat:.4f},{lon:.4f}',
+    )
+
+def nearest_city_location(lat, lon):
+    """
+    Location of the city in the city list closest to a point, found offline.
+    Without a city list the point's own grid cell is used.
+    """
+    try:
+        index = get_nearest_city_index()
+        found = index.nearest(lat, lon)
+    except Exception as e:
+        logger.warning(f"Nearest-city index unavailable, keying weather by coordinates: {e}")
+        found = None
+
+    if found is None:
+        return coordinate_location(lat, lon)
+    return snapshot_location(index.snapshot, found[0])
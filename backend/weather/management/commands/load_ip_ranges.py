@@ -0,0 +1,29 @@
+import gzip
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from weather.ip_ranges import read_dbip_csv, write_ip_ranges
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = ('Builds the IP range table used to locate clients from a DB-IP "IP to City Lite" CSV '
+            '(https://db-ip.com/db/download/ip-to-city-lite), plain or gzipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_path', help='Path of the dbip-city-lite CSV (.csv or .csv.gz).')
+
+    def handle(self, *args, **options):
+        csv_path = options['csv_path']
+        opener = gzip.open if csv_path.endswith('.gz') else open
+        path = settings.IP_RANGES_PATH
+        try:
+            with opener(csv_path, 'rt', encoding='utf-8', newline='') as f:
+                size = write_ip_ranges(read_dbip_csv(f), path)
+        except (OSError, UnicodeDecodeError, gzip.BadGzipFile) as e:
+            logger.error(f"Failed to build the IP range table: {e}")
+            self.stderr.write(self.style.ERROR('Failed to build the IP range table.'))
+            return
+        self.stdout.write(self.style.SUCCESS(f'Wrote IP range table ({size} bytes) to {path}.'))
@@ -2,19 +2,22 @@ import gzip
 import json
 import logging
 import requests
+from django.conf import settings
 from django.core.cache import cache
 from django.core.management.base import BaseCommand
+from weather.city_snapshot import write_city_snapshot
+from weather.utils import CITY_LIST_RETRY_POLICY
 
 logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
-    help = 'Fetches the city list from OpenWeatherMap and caches it in Redis.'
+    help = 'Fetches the city list from OpenWeatherMap, caches it in Redis and writes the mmap-able city snapshot.'
 
     def handle(self, *args, **options):
         self.stdout.write('Fetching and caching city list...')
         url = "https://bulk.openweathermap.org/sample/city.list.json.gz"
         try:
-            response = requests.get(url)
+            response = CITY_LIST_RETRY_POLICY.get(url)
             response.raise_for_status()
             
             decompressed_content = gzip.decompress(response.content)
@@ -26,3 +29,12 @@ class Command(BaseCommand):
         except (requests.RequestException, json.JSONDecodeError, gzip.BadGzipFile) as e:
             logger.error(f"Failed to fetch or process new city list: {e}")
             self.stderr.write(self.style.ERROR('Failed to fetch and cache the city list.'))
+            return
+
+        path = settings.CITY_SNAPSHOT_PATH
+        try:
+            size = write_city_snapshot(cities, path)
+            self.stdout.write(self.style.SUCCESS(f'Wrote city snapshot ({size} bytes) to {path}.'))
+        except (OSError, KeyError, ValueError) as e:
+            logger.error(f"Failed to write city snapshot: {e}")
+            self.stderr.write(self.style.ERROR('Failed to write the city snapshot.'))
@@ -0,0 +1,157 @@
+import logging
+import os
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from weather import popularity
+from weather.custom_exceptions import APIException, NotFound
+from weather.locations import FALLBACK_LOCATION, WeatherLocation
+from weather.payloads import payload_cache_key, store_payload
+from weather.services import (
+    API_KEY,
+    WEATHER_API_KEY_2,
+    OWM_GROUP_MAX,
+    WEATHER_PAYLOAD_TIMEOUT,
+    WEATHER_FALLBACK_TIMEOUT,
+    fetch_weather_batch,
+    store_location_payload,
+    upstream_calls,
+)
+
+logger = logging.getLogger(__name__)
+
+WARM_TOP_K = int(os.getenv('WARM_TOP_K', '50'))
+WARM_CALLS_PER_MINUTE = int(os.getenv('WARM_CALLS_PER_MINUTE', '60'))
+WARM_AHEAD = 120 # Seconds before expiry at which a payload is refreshed
+WARM_INTERVAL = 60 # Seconds between passes with --loop
+
+
+class CallBudget:
+    """
+    Token bucket allowing ``per_minute`` upstream calls a minute, in bursts of
+    at most that many. Spending more than a full bucket waits for a full one
+    and leaves the balance negative, so the overdraft delays the next spend.
+    """
+
+    def __init__(self, per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def spend(self, calls):
+        """Wait until ``calls`` upstream calls fit in the budget, then take them."""
+        self._refill()
+        needed = min(calls, self.capacity)
+        while self.tokens < needed:
+            self.sleep((needed - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= calls
+
+
+def budget_chunks(locations, capacity):
+    """
+    Split ``locations`` into chunks that each cost at most ``capacity``
+    upstream calls and at most one group query. A location that alone costs
+    more than ``capacity`` gets a chunk of its own.
+    """
+    chunk = []
+    for location in locations:
+        candidate = chunk + [location]
+        by_id = sum(item.key.startswith('city:') for item in candidate)
+        if chunk and (upstream_calls(candidate) > capacity or by_id > OWM_GROUP_MAX):
+            yield chunk
+            candidate = [location]
+        chunk = candidate
+    if chunk:
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = ('Refreshes the weather payloads of the most requested cities, and the user-location '
+            'payload of the fallback city, shortly before they expire, within a budget of upstream '
+            'calls per minute.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=WARM_TOP_K,
+                            help='Number of most requested cities to keep warm.')
+        parser.add_argument('--calls-per-minute', type=int, default=WARM_CALLS_PER_MINUTE,
+                            help='Upper bound on upstream calls made per minute.')
+        parser.add_argument('--ahead', type=int, default=WARM_AHEAD,
+                            help='Refresh payloads expiring within this many seconds.')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, warming every --interval seconds.')
+        parser.add_argument('--interval', type=int, default=WARM_INTERVAL)
+
+    def handle(self, *args, **options):
+        if not API_KEY or not WEATHER_API_KEY_2:
+            self.stderr.write(self.style.ERROR('API keys for weather data not configured.'))
+            return
+
+        budget = CallBudget(max(1, options['calls_per_minute']))
+        while True:
+            try:
+                refreshed = self.warm_fallback(options['ahead'], budget)
+                refreshed += self.warm(options['top'], options['ahead'], budget)
+                self.stdout.write(f'Refreshed {refreshed} weather payloads.')
+            except Exception as e:
+                # A worker running with --loop outlives Redis or upstream outages
+                logger.error(f"Cache warming pass failed: {e}")
+                if not options['loop']:
+                    raise
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
+
+    def warm_fallback(self, ahead, budget):
+        """
+        Refresh the user-location payload of FALLBACK_LOCATION, which that
+        view serves without an upstream call whenever one of its stages fails.
+        """
+        payload = cache.get(payload_cache_key('user_location', FALLBACK_LOCATION.key))
+        if payload is not None and payload.expires_at - time.time() >= ahead:
+            return 0
+        budget.spend(1)
+        try:
+            store_location_payload(FALLBACK_LOCATION, refresh=True)
+        except APIException as e:
+            logger.warning(f"Failed to warm the fallback location {FALLBACK_LOCATION.key}: {e}")
+            return 0
+        return 1
+
+    def warm(self, top, ahead, budget):
+        locations = [WeatherLocation(*fields) for fields in popularity.top(top)]
+        keys = [payload_cache_key('weather_data', location.key) for location in locations]
+        cached = cache.get_many(keys)
+
+        now = time.time()
+        due = [
+            location for location, key in zip(locations, keys)
+            if key not in cached or cached[key].expires_at - now < ahead
+        ]
+
+        refreshed = 0
+        for chunk in budget_chunks(due, budget.capacity):
+            budget.spend(upstream_calls(chunk))
+            # Observations as old as the expiring payloads are refetched too
+            results = fetch_weather_batch(chunk, refresh=True)
+            for location in chunk:
+                result = results[location.key]
+                if isinstance(result, NotFound):
+                    logger.info(f"Not warming {location.key}: city not found.")
+                elif isinstance(result, APIException):
+                    logger.warning(f"Failed to warm {location.key}: {result}")
+                else:
+                    store_payload('weather_data', (location.key,), result, WEATHER_PAYLOAD_TIMEOUT,
+                                  fallback_timeout=WEATHER_FALLBACK_TIMEOUT)
+                    refreshed += 1
+        return refreshed
@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = 'weather:metrics'
+FLUSH_INTERVAL = 5 # Seconds between flushes of the local counters to Redis
+
+_counts = Counter()
+_counts_lock = threading.Lock()
+_last_flush = time.monotonic()
+_flusher = None
+
+def incr(name, amount=1):
+    """
+    Count an event. Counts are kept in-process and added to a Redis hash at
+    most every FLUSH_INTERVAL seconds, by a background thread, so the hot path
+    (an async view's event loop included) never waits on Redis while the
+    totals still cover every worker.
+    """
+    global _last_flush, _flusher
+    with _counts_lock:
+        _counts[name] += amount
+        if time.monotonic() - _last_flush < FLUSH_INTERVAL:
+            return
+        pending = dict(_counts)
+        _counts.clear()
+        _last_flush = time.monotonic()
+        _flusher = threading.Thread(target=_flush, args=(pending,), name='metrics-flush', daemon=True)
+    _flusher.start()
+
+def _flush(pending):
+    try:
+        pipeline = get_redis_connection('default').pipeline(transaction=False)
+        for name, amount in pending.items():
+            pipeline.hincrby(METRICS_KEY, name, amount)
+        pipeline.execute()
+    except Exception as e:
+        logger.warning(f"Failed to flush metrics: {e}")
+        with _counts_lock:
+            _counts.update(pending)
+
+def flush():
+    """Push this process's pending counts to Redis, after any background flush in flight."""
+    flusher = _flusher
+    if flusher is not None and flusher.is_alive():
+        flusher.join()
+    with _counts_lock:
+        pending = dict(_counts)
+        _counts.clear()
+    if pending:
+        _flush(pending)
+
+def snapshot():
+    """Return the counters of all workers, including this process's unflushed counts."""
+    flush()
+    totals = get_redis_connection('default').hgetall(METRICS_KEY)
+    return {name.decode('utf-8'): int(value) for name, value in sorted(totals.items())}
+
+def reset():
+    """Drop all counters, local and shared."""
+    with _counts_lock:
+        _counts.clear()
+    get_redis_connection('default').delete(METRICS_KEY)
@@ -1,3 +1,4 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.http import JsonResponse
 from .custom_exceptions import APIException, ServiceUnavailable, BadRequest, NotFound
 import logging
@@ -6,13 +7,24 @@ from rest_framework.exceptions import ValidationError
 logger = logging.getLogger(__name__)
 
 class ExceptionHandlingMiddleware:
+    # Async-capable, so under climate/asgi.py the async views are not wrapped in a thread each
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
         response = self.get_response(request)
         return response
 
+    async def __acall__(self, request):
+        return await self.get_response(request)
+
     def process_exception(self, request, exception):
         if isinstance(exception, APIException):
             if isinstance(exception, ServiceUnavailable):
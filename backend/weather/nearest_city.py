@@ -0,0 +1,135 @@
+import logging
+import math
+import threading
+from array import array
+
+from .city_snapshot import get_city_snapshot
+
+logger = logging.getLogger(__name__)
+
+CELL_DEGREES = 1.0
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle (haversine) distance between two points."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+class NearestCityIndex:
+    """
+    Spatial index over the coordinates of a CitySnapshot, answering "which
+    city is closest to this point" without a reverse-geocoding call.
+
+    Cities are bucketed into CELL_DEGREES cells of latitude and longitude.
+    A query scans the cell of the point and then rings of cells around it,
+    stopping once the closest city found is nearer than anything outside the
+    rings scanned so far can be, and skips cells that cannot hold a closer
+    city. In populated areas that is the 3x3 cells around the point, a few
+    hundred distance checks at most.
+    """
+
+    def __init__(self, snapshot, cell=CELL_DEGREES):
+        self.snapshot = snapshot
+        self.cell = cell
+        self.columns = round(360 / cell)
+
+        cells = {}
+        for position, (lat, lon) in enumerate(zip(snapshot.lats, snapshot.lons)):
+            # The city list has no city at (0, 0), only entries without coordinates
+            if lat == 0 and lon == 0:
+                continue
+            cells.setdefault(self._cell(lat, lon), []).append(position)
+        self.cells = {key: array('I', positions) for key, positions in cells.items()}
+
+    def __len__(self):
+        return sum(len(positions) for positions in self.cells.values())
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell), math.floor((lon + 180) / self.cell) % self.columns
+
+    def _ring(self, row, column, radius):
+        """Cells at Chebyshev distance ``radius`` from (row, column), wrapping around in longitude."""
+        if radius == 0:
+            yield row, column
+            return
+        for d in range(-radius, radius + 1):
+            yield row - radius, (column + d) % self.columns
+            yield row + radius, (column + d) % self.columns
+        for d in range(-radius + 1, radius):
+            yield row + d, (column - radius) % self.columns
+            yield row + d, (column + radius) % self.columns
+
+    @staticmethod
+    def _across(lat, degrees):
+        """Distance from a point to the meridian ``degrees`` of longitude away (the closest a city that far east or west can be)."""
+        if degrees >= 90:
+            return (90 - abs(lat)) * KM_PER_DEGREE
+        return EARTH_RADIUS_KM * math.asin(math.cos(math.radians(lat)) * math.sin(math.radians(degrees)))
+
+    def _bound(self, lat, radius):
+        """Distance below which no city outside ``radius`` rings of cells can lie."""
+        # Such a city is at least radius cells of latitude or of longitude away, and the latter is closer
+        return self._across(lat, radius * self.cell)
+
+    def _cell_bound(self, lat, lon, key):
+        """Distance below which no city in cell ``key`` can lie."""
+        row, column = key
+        south = row * self.cell
+        lat_degrees = max(0.0, south - lat, lat - south - self.cell)
+        offset = (lon + 180 - column * self.cell) % 360
+        lon_degrees = 0.0 if offset <= self.cell else min(offset - self.cell, 360 - offset)
+        return max(lat_degrees * KM_PER_DEGREE, self._across(lat, lon_degrees))
+
+    def nearest(self, lat, lon):
+        """(position, distance in km) of the city closest to a point, or None if the index is empty."""
+        if not self.cells:
+            return None
+        row, column = self._cell(lat, lon)
+        lats, lons = self.snapshot.lats, self.snapshot.lons
+        max_radius = max(self.columns // 2, math.ceil(180 / self.cell))
+        best = None
+        best_distance = math.inf
+        for radius in range(max_radius + 1):
+            seen = set()
+            for key in self._ring(row, column, radius):
+                if key in seen:
+                    continue
+                seen.add(key)
+                positions = self.cells.get(key)
+                if positions is None or self._cell_bound(lat, lon, key) >= best_distance:
+                    continue
+                for position in positions:
+                    distance = distance_km(lat, lon, lats[position], lons[position])
+                    if distance < best_distance:
+                        best, best_distance = position, distance
+            if best is not None and best_distance <= self._bound(lat, radius):
+                break
+        return best, best_distance
+
+
+_nearest_city_index = None
+_nearest_city_index_lock = threading.Lock()
+
+def get_nearest_city_index():
+    """
+    Get or build the per-process nearest-city index from the city snapshot. An
+    empty city list is not kept, so the next call tries again.
+    """
+    global _nearest_city_index
+    if _nearest_city_index is None:
+        with _nearest_city_index_lock:
+            if _nearest_city_index is None:
+                index = NearestCityIndex(get_city_snapshot())
+                if not index.cells:
+                    return index
+                logger.info(f"Nearest-city index built with {len(index)} cities.")
+                _nearest_city_index = index
+    return _nearest_city_index
+
+def reset_nearest_city_index():
+    """Drop the per-process index so it is rebuilt from the current city snapshot."""
+    global _nearest_city_index
+    _nearest_city_index = None
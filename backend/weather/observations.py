@@ -0,0 +1,363 @@
+"""
+Normalized cache of upstream weather data, keyed by location.
+
+Current conditions (the OpenWeatherMap /weather response) and forecasts (the
+WeatherAPI forecast response) are cached as the upstream sent them, under the
+key of the location they were asked for. Current conditions are also cached
+under the ``city:<id>`` key of the city OpenWeatherMap answered with, so a
+lookup by name, id or coordinates fills the entry the others read. Each
+endpoint builds its own projection from these entries (the weather payload,
+the user-location summary), and one upstream call serves all of them.
+
+Entries are fresh for CURRENT_TIMEOUT and FORECAST_TIMEOUT seconds and kept
+for the longer *_STALE_TIMEOUT: a stale entry is still served, while one
+background refresh, claimed through a Redis lock, fetches it again. A miss is
+fetched by one caller at a time, under the same lock; the others wait for its
+result. Unknown locations are remembered for NEGATIVE_CACHE_TIMEOUT seconds.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+import requests
+from django.core.cache import cache
+
+from . import metrics
+from .custom_exceptions import NotFound, ServiceUnavailable
+from .http_client import get_async_client
+from .retry import DEFAULT_RETRY_POLICY
+from .utils import (
+    CacheEntry,
+    LOCK_POLL_INTERVAL,
+    LOCK_TIMEOUT,
+    LOCK_WAIT,
+    NEGATIVE_CACHE_TIMEOUT,
+    get_executor,
+    release_lock,
+)
+
+logger = logging.getLogger(__name__)
+
+API_KEY = os.getenv('API_KEY')
+WEATHER_API_KEY_2 = os.getenv('WEATHER_API_KEY_2')
+
+CURRENT_TIMEOUT = 600
+CURRENT_STALE_TIMEOUT = 3 * 60 * 60 # Served while a refresh is in flight or the upstream is down
+FORECAST_TIMEOUT = 900
+FORECAST_STALE_TIMEOUT = 6 * 60 * 60
+
+# Keeps background refresh tasks referenced until they finish
+_background_tasks = set()
+
+def owm_weather_url(location):
+    return f'http://api.openweathermap.org/data/2.5/weather?{location.owm_query}&appid={API_KEY}'
+
+def weatherapi_forecast_url(location):
+    return f'https://api.weatherapi.com/v1/forecast.json?key={WEATHER_API_KEY_2}&q={location.weatherapi_query}&days=3'
+
+def current_key(location_key):
+    return f'observation:current:{location_key}'
+
+def forecast_key(location_key):
+    return f'observation:forecast:{location_key}'
+
+def _check(response, url):
+    if response.status_code == 404:
+        raise NotFound('City Not Found')
+    if response.status_code == 401:
+        api = 'OpenWeather' if 'openweathermap' in url else 'WeatherAPI'
+        logger.warning(f"Invalid API Key for {api} API.")
+
+def fetch_upstream(url, deadline=None):
+    """GET ``url`` under the shared retry policy; 404 becomes NotFound, any other failure ServiceUnavailable."""
+    try:
+        response = DEFAULT_RETRY_POLICY.get(url, deadline=deadline)
+        _check(response, url)
+        response.raise_for_status()
+        return response
+    except requests.RequestException as e:
+        raise ServiceUnavailable(f'Error fetching data from {url}') from e
+
+async def afetch_upstream(url, deadline=None):
+    """Async version of fetch_upstream, on the pooled httpx client."""
+    try:
+        response = await DEFAULT_RETRY_POLICY.aget(get_async_client(), url, deadline=deadline)
+        _check(response, url)
+        response.raise_for_status()
+        return response
+    except httpx.HTTPError as e:
+        raise ServiceUnavailable(f'Error fetching data from {url}') from e
+
+def _current_data(response):
+    data = response.json()
+    # OpenWeatherMap reports some errors with a 200 and their own code in the body
+    if data.get('cod', 200) != 200:
+        raise NotFound('City Not Found')
+    return data
+
+def _fetch_current(location, deadline=None):
+    return _current_data(fetch_upstream(owm_weather_url(location), deadline))
+
+async def _afetch_current(location, deadline=None):
+    return _current_data(await afetch_upstream(owm_weather_url(location), deadline))
+
+def _fetch_forecast(location, deadline=None):
+    return fetch_upstream(weatherapi_forecast_url(location), deadline).json()
+
+async def _afetch_forecast(location, deadline=None):
+    return (await afetch_upstream(weatherapi_forecast_url(location), deadline)).json()
+
+def _unwrap(entry):
+    """The value of a cached entry and whether it is still fresh."""
+    if not isinstance(entry, CacheEntry):
+        # Plain entries are fresh until they expire
+        return entry, entry is not None
+    return entry.value, time.time() < entry.fresh_until
+
+def _read(key):
+    """
+    The cached value under ``key`` (None on a miss) and whether it is still
+    fresh, raising NotFound if it is known to be missing.
+    """
+    entries = cache.get_many([key, f'{key}:missing'])
+    return _count(key, entries)
+
+async def _aread(key):
+    entries = await cache.aget_many([key, f'{key}:missing'])
+    return _count(key, entries)
+
+def _count(key, entries):
+    kind = key.split(':')[1]
+    if f'{key}:missing' in entries:
+        metrics.incr(f'observation.{kind}.negative_hit')
+        raise NotFound('City Not Found')
+    data, fresh = _unwrap(entries.get(key))
+    if data is None:
+        metrics.incr(f'observation.{kind}.miss')
+    else:
+        metrics.incr(f"observation.{kind}.{'hit' if fresh else 'stale_hit'}")
+    return data, fresh
+
+def _current_entries(location_key, data):
+    entries = {current_key(location_key): data}
+    if data.get('id'):
+        entries[current_key(f"city:{data['id']}")] = data
+    return entries
+
+def _stored(entries, timeout):
+    fresh_until = time.time() + timeout
+    return {key: CacheEntry(data, fresh_until) for key, data in entries.items()}
+
+def store_current(location_key, data):
+    """Cache current conditions for ``location_key`` and the city they turned out to be for."""
+    cache.set_many(_stored(_current_entries(location_key, data), CURRENT_TIMEOUT), CURRENT_STALE_TIMEOUT)
+
+def store_forecast(location_key, data):
+    cache.set(forecast_key(location_key), CacheEntry(data, time.time() + FORECAST_TIMEOUT), FORECAST_STALE_TIMEOUT)
+
+async def astore_current(location_key, data):
+    await cache.aset_many(_stored(_current_entries(location_key, data), CURRENT_TIMEOUT), CURRENT_STALE_TIMEOUT)
+
+async def astore_forecast(location_key, data):
+    await cache.aset(forecast_key(location_key), CacheEntry(data, time.time() + FORECAST_TIMEOUT),
+                     FORECAST_STALE_TIMEOUT)
+
+# How each kind of observation is keyed, fetched and stored
+_KINDS = {
+    'current': (current_key, _fetch_current, store_current, _afetch_current, astore_current),
+    'forecast': (forecast_key, _fetch_forecast, store_forecast, _afetch_forecast, astore_forecast),
+}
+
+def _fetch(kind, location, deadline=None):
+    """Fetch and store an observation, remembering a NotFound."""
+    make_key, fetch, store, _, _ = _KINDS[kind]
+    key = make_key(location.key)
+    try:
+        data = fetch(location, deadline)
+    except NotFound:
+        cache.set(f'{key}:missing', True, NEGATIVE_CACHE_TIMEOUT)
+        raise
+    store(location.key, data)
+    return data
+
+async def _afetch(kind, location, deadline=None):
+    make_key, _, _, afetch, astore = _KINDS[kind]
+    key = make_key(location.key)
+    try:
+        data = await afetch(location, deadline)
+    except NotFound:
+        await cache.aset(f'{key}:missing', True, NEGATIVE_CACHE_TIMEOUT)
+        raise
+    await astore(location.key, data)
+    return data
+
+def _after_wait(kind, key, entries):
+    """What a caller that waited for another's fetch gets: its value, its NotFound, or its failure."""
+    if f'{key}:missing' in entries:
+        raise NotFound('City Not Found')
+    data, _ = _unwrap(entries.get(key))
+    if data is None:
+        # Shared rather than have every waiter call the failing upstream again
+        metrics.incr(f'observation.{kind}.failed_wait')
+        raise ServiceUnavailable(f'Fetching {key} failed')
+    return data
+
+def _wait_until(deadline):
+    wait_until = time.monotonic() + LOCK_WAIT
+    return wait_until if deadline is None else min(wait_until, deadline)
+
+def _fetch_single_flight(kind, location, deadline=None):
+    """
+    Fetch a missing observation, one caller at a time: the caller holding
+    the Redis lock fetches it, the others wait up to LOCK_WAIT seconds (but
+    not past ``deadline``) and share its result.
+    """
+    key = _KINDS[kind][0](location.key)
+    lock = cache.lock(f'{key}:lock', timeout=LOCK_TIMEOUT, blocking=False)
+    if lock.acquire():
+        try:
+            return _fetch(kind, location, deadline)
+        finally:
+            release_lock(lock, key)
+
+    wait_until = _wait_until(deadline)
+    while lock.locked():
+        if time.monotonic() >= wait_until:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise ServiceUnavailable(f'Timed out waiting for {key}')
+            logger.warning(f"Timed out waiting for {key} to be fetched.")
+            return _fetch(kind, location, deadline)
+        time.sleep(LOCK_POLL_INTERVAL)
+    return _after_wait(kind, key, cache.get_many([key, f'{key}:missing']))
+
+async def _afetch_single_flight(kind, location, deadline=None):
+    """Async version of _fetch_single_flight, locking with an added key as async_redis_cache does."""
+    key = _KINDS[kind][0](location.key)
+    lock_key = f'{key}:lock'
+    if await cache.aadd(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            return await _afetch(kind, location, deadline)
+        finally:
+            await cache.adelete(lock_key)
+
+    wait_until = _wait_until(deadline)
+    while await cache.ahas_key(lock_key):
+        if time.monotonic() >= wait_until:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise ServiceUnavailable(f'Timed out waiting for {key}')
+            logger.warning(f"Timed out waiting for {key} to be fetched.")
+            return await _afetch(kind, location, deadline)
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+    return _after_wait(kind, key, await cache.aget_many([key, f'{key}:missing']))
+
+def _refresh(kind, location, lock):
+    key = _KINDS[kind][0](location.key)
+    try:
+        _fetch(kind, location)
+    except Exception as e:
+        # Keep serving the stale entry; holding the lock until it expires
+        # stops every caller from retrying the failed upstream
+        logger.warning(f"Background refresh of {key} failed: {e}")
+        return
+    release_lock(lock, key)
+
+def _schedule_refresh(kind, location):
+    """Refresh a stale observation in the background, unless a refresh or fetch of it is running."""
+    key = _KINDS[kind][0](location.key)
+    # The lock is released by the worker thread, so it cannot be thread-local
+    lock = cache.lock(f'{key}:lock', timeout=LOCK_TIMEOUT, blocking=False, thread_local=False)
+    if lock.acquire():
+        get_executor().submit(_refresh, kind, location, lock)
+
+async def _arefresh(kind, location, lock_key):
+    try:
+        await _afetch(kind, location)
+    except Exception as e:
+        logger.warning(f"Background refresh of {lock_key.removesuffix(':lock')} failed: {e}")
+        return
+    await cache.adelete(lock_key)
+
+async def _aschedule_refresh(kind, location):
+    lock_key = f'{_KINDS[kind][0](location.key)}:lock'
+    if await cache.aadd(lock_key, 1, LOCK_TIMEOUT):
+        task = asyncio.create_task(_arefresh(kind, location, lock_key))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+def get_cached(location):
+    """
+    Cached current conditions and forecast of ``location`` (None when not
+    cached), in one round-trip. Raises NotFound if it is known not to exist.
+    Stale entries are returned and refreshed in the background.
+    """
+    keys = [current_key(location.key), forecast_key(location.key)]
+    entries = cache.get_many(keys + [f'{key}:missing' for key in keys])
+    cached = []
+    for kind, key in zip(('current', 'forecast'), keys):
+        data, fresh = _count(key, entries)
+        if data is not None and not fresh:
+            _schedule_refresh(kind, location)
+        cached.append(data)
+    return tuple(cached)
+
+def _get_cached_many(kind, locations):
+    make_key = _KINDS[kind][0]
+    found = cache.get_many([make_key(location.key) for location in locations])
+    cached = {}
+    for location in locations:
+        data, fresh = _unwrap(found.get(make_key(location.key)))
+        if data is None:
+            continue
+        if not fresh:
+            _schedule_refresh(kind, location)
+        cached[location.key] = data
+    return cached
+
+def get_cached_current(locations):
+    """
+    Cached current conditions of each of ``locations`` that has them, by
+    location key, in one round-trip. Stale ones are refreshed in the background.
+    """
+    return _get_cached_many('current', locations)
+
+def get_cached_forecasts(locations):
+    return _get_cached_many('forecast', locations)
+
+def _get(kind, location, deadline, refresh):
+    if not refresh:
+        data, fresh = _read(_KINDS[kind][0](location.key))
+        if data is not None:
+            if not fresh:
+                _schedule_refresh(kind, location)
+            return data
+    return _fetch_single_flight(kind, location, deadline)
+
+async def _aget(kind, location, deadline):
+    data, fresh = await _aread(_KINDS[kind][0](location.key))
+    if data is not None:
+        if not fresh:
+            await _aschedule_refresh(kind, location)
+        return data
+    return await _afetch_single_flight(kind, location, deadline)
+
+def get_current(location, deadline=None, refresh=False):
+    """
+    Current conditions at ``location`` (the OpenWeatherMap /weather response),
+    from the cache or fetched. Raises NotFound or ServiceUnavailable. With
+    ``refresh`` the cache is not read, only updated.
+    """
+    return _get('current', location, deadline, refresh)
+
+def get_forecast(location, deadline=None, refresh=False):
+    """Forecast for ``location`` (the WeatherAPI forecast response), from the cache or fetched."""
+    return _get('forecast', location, deadline, refresh)
+
+async def aget_current(location, deadline=None):
+    """Async version of get_current."""
+    return await _aget('current', location, deadline)
+
+async def aget_forecast(location, deadline=None):
+    """Async version of get_forecast."""
+    return await _aget('forecast', location, deadline)
@@ -0,0 +1,164 @@
+"""
+JSON payloads cached in their encoded form, together with a strong ETag over
+the encoded bytes. A poll for a cached payload is answered from those bytes,
+and a revalidation that still matches with a 304, without serializing again.
+
+Payloads are compressed once, when they are stored: the gzip variant and,
+if the optional brotli package is installed, the brotli one are cached next
+to the identity bytes, and Accept-Encoding picks among them on every hit.
+"""
+import gzip
+import hashlib
+import json
+import time
+from collections import namedtuple
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+
+from .utils import make_cache_key
+from . import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_SIZE = 200 # Smaller bodies gain nothing from compression, as in GZipMiddleware
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Entries cached before compressed variants were added unpickle with None for them
+EncodedPayload = namedtuple('EncodedPayload', ['body', 'etag', 'expires_at', 'gzip', 'br'], defaults=(None, None))
+
+def _compressed(body, compress):
+    if len(body) < MIN_COMPRESS_SIZE:
+        return None
+    compressed = compress(body)
+    return compressed if len(compressed) < len(body) else None
+
+def encode_payload(data, timeout):
+    body = json.dumps(data, cls=DjangoJSONEncoder).encode('utf-8')
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    return EncodedPayload(
+        body,
+        etag,
+        time.time() + timeout,
+        _compressed(body, lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)),
+        _compressed(body, lambda body: brotli.compress(body, quality=BROTLI_QUALITY)) if brotli else None,
+    )
+
+def accepted_encodings(header):
+    """The content codings an Accept-Encoding header allows, ``*`` included; q=0 excludes a coding."""
+    accepted = set()
+    refused = set()
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if coding:
+            (accepted if quality > 0 else refused).add(coding)
+    if '*' in accepted:
+        accepted |= {coding for coding in ('br', 'gzip') if coding not in refused}
+    return accepted
+
+def select_encoding(request, payload):
+    """The stored variant to send: brotli, then gzip, then the identity bytes."""
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    for coding in ('br', 'gzip'):
+        body = getattr(payload, coding)
+        if body is not None and coding in accepted:
+            return coding, body
+    return None, payload.body
+
+def variant_etag(etag, coding):
+    """Each encoding gets its own strong ETag, derived from the identity one."""
+    return etag if coding is None else f'{etag[:-1]}-{coding}"'
+
+def payload_cache_key(name, *parts):
+    return f'payload:{name}:{make_cache_key(name, parts, {})}'
+
+def _count(name, payload):
+    metrics.incr(f"payload.{name}.{'miss' if payload is None else 'hit'}")
+    return payload
+
+def get_payload(name, *parts):
+    return _count(name, cache.get(payload_cache_key(name, *parts)))
+
+def get_payloads(name, parts_list):
+    """get_payload for each of ``parts_list``, in one cache round-trip."""
+    keys = [payload_cache_key(name, *parts) for parts in parts_list]
+    found = cache.get_many(keys)
+    return [_count(name, found.get(key)) for key in keys]
+
+def get_fallback_payload(name, *parts):
+    """The last payload stored with a ``fallback_timeout``, for when it cannot be rebuilt."""
+    payload = cache.get(f'{payload_cache_key(name, *parts)}:fallback')
+    if payload is not None:
+        metrics.incr(f'payload.{name}.fallback')
+    return payload
+
+def store_payload(name, parts, data, timeout, fallback_timeout=None):
+    """
+    Encode ``data`` and cache it under ``name`` and ``parts`` for ``timeout``
+    seconds. With ``fallback_timeout`` a copy is also kept that long for
+    get_fallback_payload.
+    """
+    payload = encode_payload(data, timeout)
+    key = payload_cache_key(name, *parts)
+    cache.set(key, payload, timeout)
+    if fallback_timeout is not None:
+        cache.set(f'{key}:fallback', payload, fallback_timeout)
+    return payload
+
+async def aget_payload(name, *parts):
+    return _count(name, await cache.aget(payload_cache_key(name, *parts)))
+
+async def aget_fallback_payload(name, *parts):
+    payload = await cache.aget(f'{payload_cache_key(name, *parts)}:fallback')
+    if payload is not None:
+        metrics.incr(f'payload.{name}.fallback')
+    return payload
+
+async def astore_payload(name, parts, data, timeout, fallback_timeout=None):
+    payload = encode_payload(data, timeout)
+    key = payload_cache_key(name, *parts)
+    await cache.aset(key, payload, timeout)
+    if fallback_timeout is not None:
+        await cache.aset(f'{key}:fallback', payload, fallback_timeout)
+    return payload
+
+def payload_response(request, payload, private=False, max_age=None):
+    """
+    Serve an encoded payload, or a 304 if the client's If-None-Match still
+    matches. Cache-Control lets shared caches keep public payloads for as long
+    as we do (or ``max_age``); private ones (which depend on who is asking)
+    stay in the browser.
+    """
+    if max_age is None:
+        max_age = max(0, int(payload.expires_at - time.time()))
+    coding, body = select_encoding(request, payload)
+    # Any variant's ETag revalidates, since they all carry the same JSON
+    variants = {variant_etag(payload.etag, variant) for variant in (None, 'gzip', 'br')}
+    if variants.intersection(parse_etags(request.headers.get('If-None-Match', ''))):
+        metrics.incr('payload.not_modified')
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
+        if coding is not None:
+            metrics.incr(f'payload.{coding}')
+            response['Content-Encoding'] = coding
+    response['ETag'] = variant_etag(payload.etag, coding)
+    response['Cache-Control'] = f"{'private' if private else 'public'}, max-age={max_age}"
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
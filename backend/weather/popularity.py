@@ -0,0 +1,128 @@
+"""
+How often each city's weather is asked for, kept in a Redis sorted set with
+exponential time decay.
+
+A request adds 2 ** ((now - epoch) / HALF_LIFE) to its city's score, so it
+weighs twice as much as one made HALF_LIFE seconds earlier and the set ranks
+cities by recent demand without old scores ever being rewritten. Once the
+weights grow large, every score is scaled down and the epoch moved forward.
+Like weather.metrics, requests are counted in-process and flushed to Redis at
+most every FLUSH_INTERVAL seconds, by a background thread.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+POPULARITY_KEY = 'weather:popularity'
+LOCATIONS_KEY = 'weather:popularity:locations' # Location fields of every tracked key
+EPOCH_KEY = 'weather:popularity:epoch'
+HALF_LIFE = int(os.getenv('POPULARITY_HALF_LIFE', '3600'))
+MAX_TRACKED = 1000
+RESCALE_AFTER = 32 # Half-lives after which scores are scaled back down
+FLUSH_INTERVAL = 5
+
+_counts = Counter()
+_locations = {}
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+_flusher = None
+
+def record(location):
+    """Count a request for the weather of ``location`` (a WeatherLocation). Never waits on Redis."""
+    global _last_flush, _flusher
+    with _lock:
+        _counts[location.key] += 1
+        _locations[location.key] = json.dumps(list(location))
+        if time.monotonic() - _last_flush < FLUSH_INTERVAL:
+            return
+        pending, locations = _take()
+        _last_flush = time.monotonic()
+        _flusher = threading.Thread(target=_flush, args=(pending, locations), name='popularity-flush', daemon=True)
+    _flusher.start()
+
+def _take():
+    pending, locations = dict(_counts), dict(_locations)
+    _counts.clear()
+    _locations.clear()
+    return pending, locations
+
+def _flush(pending, locations):
+    now = time.time()
+
+    def add(pipeline):
+        # The epoch is watched, so a concurrent rescale makes this retry with the new one
+        epoch = pipeline.get(EPOCH_KEY)
+        epoch = now if epoch is None else float(epoch)
+        age = (now - epoch) / HALF_LIFE
+        pipeline.multi()
+        if age > RESCALE_AFTER:
+            pipeline.zunionstore(POPULARITY_KEY, {POPULARITY_KEY: 2 ** -age})
+            age = 0
+        if age == 0:
+            pipeline.set(EPOCH_KEY, now)
+        weight = 2 ** age
+        for key, count in pending.items():
+            pipeline.zincrby(POPULARITY_KEY, count * weight, key)
+        pipeline.hset(LOCATIONS_KEY, mapping=locations)
+        pipeline.zremrangebyrank(POPULARITY_KEY, 0, -MAX_TRACKED - 1)
+
+    try:
+        get_redis_connection('default').transaction(add, EPOCH_KEY)
+    except Exception as e:
+        logger.warning(f"Failed to flush city popularity: {e}")
+        with _lock:
+            _counts.update(pending)
+            for key, fields in locations.items():
+                _locations.setdefault(key, fields)
+
+def flush():
+    """Push this process's pending counts to Redis, after any background flush in flight."""
+    flusher = _flusher
+    if flusher is not None and flusher.is_alive():
+        flusher.join()
+    with _lock:
+        pending, locations = _take()
+    if pending:
+        _flush(pending, locations)
+
+def top(k):
+    """
+    Location fields of the ``k`` most requested cities, most requested first.
+    Keys no longer tracked in the sorted set are dropped from the location hash.
+    """
+    flush()
+    connection = get_redis_connection('default')
+    keys = connection.zrevrange(POPULARITY_KEY, 0, k - 1) if k > 0 else []
+    stale = set(connection.hkeys(LOCATIONS_KEY)) - set(connection.zrange(POPULARITY_KEY, 0, -1))
+    if stale:
+        connection.hdel(LOCATIONS_KEY, *stale)
+    if not keys:
+        return []
+    fields = connection.hmget(LOCATIONS_KEY, keys)
+    return [json.loads(value) for value in fields if value is not None]
+
+def scores():
+    """Current, decayed, score of every tracked key."""
+    flush()
+    connection = get_redis_connection('default')
+    epoch = connection.get(EPOCH_KEY)
+    if epoch is None:
+        return {}
+    decay = 2 ** -((time.time() - float(epoch)) / HALF_LIFE)
+    return {
+        key.decode('utf-8'): score * decay
+        for key, score in connection.zrevrange(POPULARITY_KEY, 0, -1, withscores=True)
+    }
+
+def reset():
+    """Forget all counts, local and shared."""
+    with _lock:
+        _take()
+    get_redis_connection('default').delete(POPULARITY_KEY, LOCATIONS_KEY, EPOCH_KEY)
@@ -0,0 +1,201 @@
+"""
+Retry policy shared by every upstream call.
+
+Each call gets an overall deadline. Attempts are given the smaller of their
+own timeout and the time left, and between attempts the policy sleeps for a
+jittered, exponentially growing backoff that never runs past the deadline.
+Only idempotent requests are retried, and only on errors that a retry can
+fix (connection failures, timeouts and 5xx gateway errors), so a degraded
+upstream holds a worker for at most the deadline.
+
+Every attempt also goes through the circuit breaker of its host: while the
+breaker is open, CircuitOpen is raised without calling the host or retrying.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+
+from . import metrics
+from .circuit_breaker import CircuitOpen, get_breaker
+from .http_client import get_http_session
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_DEADLINE = float(os.getenv('UPSTREAM_DEADLINE', '15'))
+UPSTREAM_ATTEMPTS = int(os.getenv('UPSTREAM_ATTEMPTS', '3'))
+
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+RETRYABLE_STATUSES = frozenset({500, 502, 503, 504})
+RETRYABLE_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+ARETRYABLE_ERRORS = (
+    httpx.TimeoutException,
+    httpx.NetworkError,
+    httpx.RemoteProtocolError,
+)
+# Responses that count against the host's circuit breaker
+FAILURE_STATUSES = RETRYABLE_STATUSES | {429}
+MIN_ATTEMPT_TIME = 0.1 # Seconds an attempt needs to be worth starting
+
+
+class DeadlineExceeded(requests.Timeout):
+    """The deadline of an upstream call ran out before it could succeed."""
+
+
+class RetryPolicy:
+    """
+    How upstream calls are retried.
+
+    Args:
+        attempts: Maximum number of attempts, the first one included.
+        deadline: Seconds the whole call may take, backoff included.
+        attempt_timeout: Timeout of a single attempt.
+        backoff: Base of the exponential backoff, in seconds.
+        max_backoff: Upper bound of a single backoff.
+    """
+
+    def __init__(self, attempts=UPSTREAM_ATTEMPTS, deadline=UPSTREAM_DEADLINE,
+                 attempt_timeout=10, backoff=0.5, max_backoff=4):
+        self.attempts = attempts
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def start(self, deadline=None):
+        """Absolute (monotonic) deadline for a call, capped by the caller's ``deadline``."""
+        own = time.monotonic() + self.deadline
+        return own if deadline is None else min(own, deadline)
+
+    def attempt_timeout_for(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining < MIN_ATTEMPT_TIME:
+            return None
+        return min(self.attempt_timeout, remaining)
+
+    def delay(self, attempt, deadline):
+        """
+        Full-jitter backoff before retry number ``attempt``, or None when the
+        deadline leaves no room for another attempt.
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if time.monotonic() + delay + MIN_ATTEMPT_TIME > deadline:
+            return None
+        return delay
+
+    def should_retry(self, method, attempt):
+        return method.upper() in IDEMPOTENT_METHODS and attempt < self.attempts - 1
+
+    @staticmethod
+    def check_breaker(breaker):
+        if not breaker.allow():
+            raise CircuitOpen(f'Circuit breaker for {breaker.host} is open')
+
+    @staticmethod
+    def record(breaker, status_code):
+        if status_code in FAILURE_STATUSES:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    def request(self, method, url, session=None, deadline=None, **kwargs):
+        """
+        Send a request with ``session`` (the pooled upstream session by default) and
+        return the last response. Connection errors and timeouts are raised
+        once retries are exhausted; DeadlineExceeded is a requests.Timeout.
+        """
+        send = getattr(session or get_http_session(), method.lower())
+        breaker = get_breaker(url)
+        deadline = self.start(deadline)
+        attempt = 0
+        while True:
+            timeout = self.attempt_timeout_for(deadline)
+            if timeout is None:
+                metrics.incr('upstream.deadline_exceeded')
+                raise DeadlineExceeded(f'Deadline exceeded before requesting {url}')
+            self.check_breaker(breaker)
+            try:
+                response = send(url, timeout=timeout, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                if not self.should_retry(method, attempt):
+                    raise
+                error = e
+            else:
+                self.record(breaker, response.status_code)
+                if response.status_code not in RETRYABLE_STATUSES or not self.should_retry(method, attempt):
+                    return response
+                error = None
+
+            delay = self.delay(attempt, deadline)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+            if error is None:
+                response.close()
+            metrics.incr('upstream.retry')
+            logger.info(f"Retrying {method.upper()} {url.split('?')[0]} in {delay:.2f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, session=None, deadline=None, **kwargs):
+        return self.request('GET', url, session=session, deadline=deadline, **kwargs)
+
+    async def arequest(self, client, method, url, deadline=None, stream=False, **kwargs):
+        """
+        Async version of request for an httpx.AsyncClient; raises httpx errors.
+        With ``stream=True`` the body is left unread, as with client.send.
+        """
+        breaker = get_breaker(url)
+        deadline = self.start(deadline)
+        attempt = 0
+        while True:
+            timeout = self.attempt_timeout_for(deadline)
+            if timeout is None:
+                metrics.incr('upstream.deadline_exceeded')
+                raise httpx.TimeoutException(f'Deadline exceeded before requesting {url}')
+            # Breaker state is a Redis round-trip, kept off the event loop. It touches no
+            # thread-bound state, so it runs in the executor rather than queueing on Django's sync thread.
+            await sync_to_async(self.check_breaker, thread_sensitive=False)(breaker)
+            try:
+                request = client.build_request(method, url, timeout=timeout, **kwargs)
+                response = await client.send(request, stream=stream)
+            except ARETRYABLE_ERRORS as e:
+                await sync_to_async(breaker.record_failure, thread_sensitive=False)()
+                if not self.should_retry(method, attempt):
+                    raise
+                error = e
+            else:
+                await sync_to_async(self.record, thread_sensitive=False)(breaker, response.status_code)
+                if response.status_code not in RETRYABLE_STATUSES or not self.should_retry(method, attempt):
+                    return response
+                error = None
+
+            delay = self.delay(attempt, deadline)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+            if error is None:
+                await response.aclose()
+            metrics.incr('upstream.retry')
+            logger.info(f"Retrying {method.upper()} {url.split('?')[0]} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aget(self, client, url, deadline=None, stream=False, **kwargs):
+        return await self.arequest(client, 'GET', url, deadline=deadline, stream=stream, **kwargs)
+
+
+# Used for every upstream call unless a caller needs different bounds
+DEFAULT_RETRY_POLICY = RetryPolicy()
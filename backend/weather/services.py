@@ -0,0 +1,256 @@
+"""
+Weather payloads built from upstream observations, shared by the views and
+the warm_weather_cache command.
+"""
+import math
+import os
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime
+
+import pytz
+
+from .custom_exceptions import APIException, NotFound, ServiceUnavailable
+from .locations import FALLBACK_LOCATION
+from .observations import (
+    fetch_upstream,
+    get_cached,
+    get_cached_current,
+    get_cached_forecasts,
+    get_current,
+    get_forecast,
+    store_current,
+)
+from .payloads import store_payload
+from .utils import format_weather_data, get_executor, kelvin_to_celsius
+
+API_KEY = os.getenv('API_KEY')
+WEATHER_API_KEY_2 = os.getenv('WEATHER_API_KEY_2')
+
+FETCH_DEADLINE = 15 # Seconds the upstream calls may take, retries included
+WEATHER_PAYLOAD_TIMEOUT = 900
+WEATHER_FALLBACK_TIMEOUT = 6 * 60 * 60 # Last good payload, served while upstreams are down
+LOCATION_PAYLOAD_TIMEOUT = 600
+FALLBACK_LOCATION_TIMEOUT = 30 * 24 * 60 * 60 # Kept fresh by warm_weather_cache, long-lived in case it stops
+OWM_GROUP_MAX = 20 # Ids per OpenWeatherMap group query, the API's own limit
+
+def build_weather_payload(city_name, weather_data, weatherapi_data):
+    """
+    Combine the OpenWeatherMap current conditions and the WeatherAPI forecast
+    into the payload served by get_weather_data.
+    """
+    temperature = kelvin_to_celsius(weather_data.get('main', {}).get('temp', 0))
+    description = weather_data.get('weather', [{}])[0].get('description', '')
+    icon = weather_data.get('weather', [{}])[0].get('icon', '')
+    wind_speed = weather_data.get('wind', {}).get('speed', 0)
+    humidity = weather_data.get('main', {}).get('humidity', 0)
+    pressure = weather_data.get('main', {}).get('pressure', 0)
+
+    city_timezone_offset = weather_data.get('timezone')
+    city_tz = pytz.FixedOffset(city_timezone_offset / 60)
+    city_time = datetime.now(city_tz).strftime('%Y-%m-%d %H:%M:%S')
+
+    sunrise_ts = weather_data.get('sys', {}).get('sunrise')
+    sunset_ts = weather_data.get('sys', {}).get('sunset')
+
+    sunrise = 'N/A'
+    sunset = 'N/A'
+    if sunrise_ts:
+        sunrise = datetime.fromtimestamp(sunrise_ts, city_tz).strftime('%H:%M')
+    if sunset_ts:
+        sunset = datetime.fromtimestamp(sunset_ts, city_tz).strftime('%H:%M')
+
+    hourly_forecast = []
+    if 'forecast' in weatherapi_data and 'forecastday' in weatherapi_data['forecast'] and weatherapi_data['forecast']['forecastday']:
+        for hour in weatherapi_data['forecast']['forecastday'][0]['hour']:
+            hour_data = {
+                'time': hour['time'].split(' ')[1],
+                'temperature': hour['temp_c'],
+                'description': hour['condition']['text'],
+                'icon': hour['condition']['icon'],
+            }
+            hourly_forecast.append(hour_data)
+
+    daily_forecast = []
+    if 'forecast' in weatherapi_data and 'forecastday' in weatherapi_data['forecast']:
+        for day in weatherapi_data['forecast']['forecastday']:
+            day_data = {
+                'date': day['date'],
+                'maxtemp': day['day']['maxtemp_c'],
+                'mintemp': day['day']['mintemp_c'],
+                'condition': day['day']['condition']['text'],
+                'icon': day['day']['condition']['icon'],
+            }
+            daily_forecast.append(day_data)
+
+    response_data = {
+        'city_name': city_name or weather_data.get('name'),
+        'temperature': temperature,
+        'description': description,
+        'icon': icon,
+        'city_time': city_time,
+        'wind_speed': wind_speed,
+        'humidity': humidity,
+        'timezone': city_timezone_offset,
+        'hourly_forecast': hourly_forecast,
+        'daily_forecast': daily_forecast,
+        'pressure': pressure,
+        'sunrise': sunrise,
+        'sunset': sunset,
+    }
+    return response_data
+
+def wait_for(future, what, deadline):
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except FutureTimeoutError as e:
+        future.cancel()
+        raise ServiceUnavailable(f'Timed out fetching {what}') from e
+
+def fetch_weather_data(location):
+    """
+    Build the payload for a resolved location from its current conditions and
+    forecast, read from the observation cache or fetched from upstream.
+    """
+    # Read in this thread, so hits are served from the process's L1 without an executor hand-off
+    weather_data, weatherapi_data = get_cached(location)
+    if weather_data is not None and weatherapi_data is not None:
+        return build_weather_payload(location.name, weather_data, weatherapi_data)
+
+    # Misses are fetched in parallel, so a cold miss costs the slower of the two upstream calls
+    executor = get_executor()
+    deadline = time.monotonic() + FETCH_DEADLINE
+    current_future = forecast_future = None
+    if weather_data is None:
+        current_future = executor.submit(get_current, location, deadline, True)
+    if weatherapi_data is None:
+        forecast_future = executor.submit(get_forecast, location, deadline, True)
+
+    if current_future is not None:
+        try:
+            weather_data = wait_for(current_future, f'current conditions for {location.key}', deadline)
+        except APIException:
+            if forecast_future is not None:
+                forecast_future.cancel()
+            raise
+    if forecast_future is not None:
+        weatherapi_data = wait_for(forecast_future, f'forecast for {location.key}', deadline)
+
+    return build_weather_payload(location.name, weather_data, weatherapi_data)
+
+def fetch_weather_batch(locations, refresh=False):
+    """
+    Build the payloads of several locations at once, sharing one deadline.
+    Current conditions missing from the observation cache are fetched in
+    OpenWeatherMap group queries of up to OWM_GROUP_MAX ids for locations
+    keyed by city id, one by one for the others; all of those and the
+    forecasts run in parallel. With ``refresh`` everything is fetched anew.
+    Returns a dict mapping each location key to its payload, or to the
+    APIException it failed with.
+    """
+    executor = get_executor()
+    deadline = time.monotonic() + FETCH_DEADLINE
+    # Read in this thread, so hits are served from the process's L1 without an executor hand-off
+    cached = {} if refresh else get_cached_current(locations)
+    cached_forecasts = {} if refresh else get_cached_forecasts(locations)
+    by_id = [location for location in locations
+             if location.key.startswith('city:') and location.key not in cached]
+    by_name = [location for location in locations
+               if not location.key.startswith('city:') and location.key not in cached]
+
+    groups = []
+    for start in range(0, len(by_id), OWM_GROUP_MAX):
+        chunk = by_id[start:start + OWM_GROUP_MAX]
+        ids = ','.join(location.key.removeprefix('city:') for location in chunk)
+        url = f'http://api.openweathermap.org/data/2.5/group?id={ids}&appid={API_KEY}'
+        groups.append((chunk, url, executor.submit(fetch_upstream, url, deadline)))
+    # Only the worker reads the cache here, for names known not to exist
+    current = {location.key: executor.submit(get_current, location, deadline, refresh) for location in by_name}
+    forecasts = {}
+
+    def with_coordinates(location, weather_data):
+        """Ids missing from the city list get their name and forecast coordinates from OpenWeatherMap."""
+        if location.weatherapi_query is not None:
+            return location
+        coord = weather_data.get('coord', {})
+        return location._replace(
+            name=weather_data.get('name', ''),
+            weatherapi_query=f"{coord.get('lat', 0):.4f},{coord.get('lon', 0):.4f}",
+        )
+
+    def forecast(location):
+        if location.key in cached_forecasts:
+            forecasts[location.key] = None
+        else:
+            forecasts[location.key] = executor.submit(get_forecast, location, deadline, True)
+
+    results = {}
+    observations = []
+    for location in locations:
+        if location.key in cached:
+            location = with_coordinates(location, cached[location.key])
+            forecast(location)
+            observations.append((location, cached[location.key]))
+        elif location.weatherapi_query is not None:
+            forecast(location)
+
+    for chunk, url, future in groups:
+        try:
+            items = wait_for(future, url.split('&appid=')[0], deadline).json().get('list', [])
+        except APIException as e:
+            results.update((location.key, e) for location in chunk)
+            continue
+        found = {str(item.get('id')): item for item in items}
+        for location in chunk:
+            item = found.get(location.key.removeprefix('city:'))
+            if item is None:
+                results[location.key] = NotFound('City Not Found')
+                continue
+            # Group items carry the UTC offset under sys rather than at the top level
+            item.setdefault('timezone', item.get('sys', {}).get('timezone', 0))
+            store_current(location.key, item)
+            if location.weatherapi_query is None:
+                location = with_coordinates(location, item)
+                forecast(location)
+            observations.append((location, item))
+
+    for location in by_name:
+        try:
+            observations.append((location, wait_for(
+                current[location.key], f'current conditions for {location.key}', deadline)))
+        except APIException as e:
+            results[location.key] = e
+
+    for key in results:
+        if forecasts.get(key) is not None:
+            forecasts[key].cancel()
+
+    for location, weather_data in observations:
+        try:
+            if location.key in cached_forecasts:
+                weatherapi_data = cached_forecasts[location.key]
+            else:
+                weatherapi_data = wait_for(forecasts[location.key], f'forecast for {location.key}', deadline)
+        except APIException as e:
+            results[location.key] = e
+            continue
+        results[location.key] = build_weather_payload(location.name, weather_data, weatherapi_data)
+    return results
+
+def upstream_calls(locations):
+    """Upstream calls ``fetch_weather_batch(locations, refresh=True)`` makes: group queries, single queries and forecasts."""
+    by_id = sum(location.key.startswith('city:') for location in locations)
+    return math.ceil(by_id / OWM_GROUP_MAX) + (len(locations) - by_id) + len(locations)
+
+def store_location_payload(location, deadline=None, refresh=False):
+    """
+    Fetch the current conditions at ``location`` and store their summary as
+    its user-location payload. The payload of FALLBACK_LOCATION is also kept
+    as a fallback copy for FALLBACK_LOCATION_TIMEOUT seconds.
+    """
+    weather_data = format_weather_data(get_current(location, deadline, refresh))
+    if 'error' in weather_data:
+        raise ServiceUnavailable(weather_data['error'])
+    fallback_timeout = FALLBACK_LOCATION_TIMEOUT if location.key == FALLBACK_LOCATION.key else None
+    return store_payload('user_location', (location.key,), weather_data, LOCATION_PAYLOAD_TIMEOUT,
+                         fallback_timeout=fallback_timeout)
@@ -0,0 +1,200 @@
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TOUCH_INTERVAL = 60 # Seconds between access time updates for a hot tile
+EVICT_TO = 0.9 # Fraction of the byte budget to shrink to when it is exceeded
+RESCAN_INTERVAL = 60 # Seconds a process trusts its running total, which misses other workers' writes
+LAYER_NAME = re.compile(r'[a-z0-9_]+')
+
+def tile_etag(layer, z, x, y, modified_ns):
+    """
+    ETag of the tile stored with modification time ``modified_ns``. Files are
+    only ever replaced, never rewritten in place, and each write sets its own
+    mtime, so a tile streamed while it is stored can be sent with this ETag
+    before its content is known.
+    """
+    return f'"{layer}-{int(z)}-{int(x)}-{int(y)}-{modified_ns:x}"'
+
+
+class StoredTile:
+    """A tile on disk, described by its stat result only."""
+
+    def __init__(self, path, stat, etag):
+        self.path = path
+        self.size = stat.st_size
+        self.modified = stat.st_mtime
+        self.etag = etag
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+class TileStore:
+    """
+    Map tiles on local disk under ``<root>/<layer>/<z>/<x>/<y>.png``.
+
+    Writes go to a temporary file that is renamed into place, so readers
+    never see a partial tile. The total size is kept near ``max_bytes``:
+    once it is exceeded, the least recently used tiles are removed. Each
+    process keeps a running total of its own writes and only re-reads the
+    size of the whole tree every RESCAN_INTERVAL seconds, so between scans
+    several workers together can overshoot the budget by what they wrote in
+    that time. Layer names are checked against LAYER_NAME before they are
+    used in a path. Recency is kept in each file's access time, which is set
+    explicitly (at most every TOUCH_INTERVAL seconds) so it works on noatime
+    mounts and is shared by all worker processes. Tiles older than
+    ``timeout`` are misses.
+    """
+
+    def __init__(self, root, max_bytes, timeout):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._bytes = None
+        self._scanned_at = None
+        self._lock = threading.Lock()
+
+    def path(self, layer, z, x, y):
+        if not isinstance(layer, str) or not LAYER_NAME.fullmatch(layer):
+            raise ValueError(f'Invalid tile layer {layer!r}')
+        return os.path.join(self.root, layer, str(int(z)), str(int(x)), f'{int(y)}.png')
+
+    def get(self, layer, z, x, y):
+        """Return the StoredTile for a fresh tile, or None."""
+        path = self.path(layer, z, x, y)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        now = time.time()
+        if now - stat.st_mtime > self.timeout:
+            return None
+        if now - stat.st_atime > TOUCH_INTERVAL:
+            try:
+                os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+            except OSError:
+                pass
+        return StoredTile(path, stat, tile_etag(layer, z, x, y, stat.st_mtime_ns))
+
+    def put(self, layer, z, x, y, content, modified_ns=None):
+        """
+        Atomically store a tile, modified at ``modified_ns`` (by default now)
+        as far as get() and tile_etag() are concerned, and evict old tiles if
+        over budget.
+        """
+        path = self.path(layer, z, x, y)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        try:
+            previous_size = os.stat(path).st_size
+        except OSError:
+            previous_size = 0
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tile-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            now_ns = time.time_ns()
+            os.utime(tmp_path, ns=(now_ns, modified_ns if modified_ns is not None else now_ns))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            if self._bytes is None or time.monotonic() - self._scanned_at > RESCAN_INTERVAL:
+                self._set_size(self._scan_size())
+            else:
+                self._bytes += len(content) - previous_size
+            over_budget = self._bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def _entries(self):
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    continue
+
+    def _scan_size(self):
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def _set_size(self, size):
+        self._bytes = size
+        self._scanned_at = time.monotonic()
+
+    def evict(self):
+        """Remove expired tiles, then the least recently used ones until under budget."""
+        now = time.time()
+        entries = []
+        total = 0
+        for path, stat in self._entries():
+            # Leftovers of interrupted writes are dropped once they are old enough
+            is_leftover = os.path.basename(path).startswith('.tile-')
+            if now - stat.st_mtime > self.timeout or (is_leftover and now - stat.st_mtime > TOUCH_INTERVAL):
+                self._remove(path)
+                continue
+            if not is_leftover:
+                entries.append((stat.st_atime, stat.st_size, path))
+            total += stat.st_size
+
+        target = self.max_bytes * EVICT_TO
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            if self._remove(path):
+                total -= size
+                removed += 1
+
+        with self._lock:
+            self._set_size(total)
+        if removed:
+            logger.info(f"Evicted {removed} tiles from {self.root}, {total} bytes left")
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+            return True
+        except OSError:
+            return False
+
+    def clear(self):
+        for path, _ in list(self._entries()):
+            self._remove(path)
+        with self._lock:
+            self._set_size(0)
+
+
+_tile_store = None
+_tile_store_lock = threading.Lock()
+
+def get_tile_store():
+    """Get the per-process tile store configured in settings."""
+    global _tile_store
+    if _tile_store is None:
+        with _tile_store_lock:
+            if _tile_store is None:
+                _tile_store = TileStore(
+                    settings.TILE_STORE_PATH,
+                    max_bytes=settings.TILE_STORE_MAX_BYTES,
+                    timeout=settings.TILE_STORE_TIMEOUT,
+                )
+    return _tile_store
+
+def reset_tile_store():
+    """Drop the per-process store so the next call reads the settings again."""
+    global _tile_store
+    _tile_store = None
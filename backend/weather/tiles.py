@@ -0,0 +1,113 @@
+"""
+Helpers shared by the sync and async map tile proxies: serving tiles from the
+disk tile store and the streaming pass-through that tees upstream chunks into it.
+"""
+import logging
+import time
+
+import requests
+import httpx
+from asgiref.sync import sync_to_async
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_etags
+
+from .tile_store import get_tile_store, tile_etag
+
+logger = logging.getLogger(__name__)
+
+TILE_CHUNK_SIZE = 16 * 1024
+
+def tile_url(layer, z, x, y, api_key):
+    return f"https://tile.openweathermap.org/map/{layer}/{z}/{x}/{y}.png?appid={api_key}"
+
+def get_stored_tile(layer, z, x, y):
+    return get_tile_store().get(layer, z, x, y)
+
+def etag_matches(request, etag):
+    """Check the request's If-None-Match header against ``etag`` (weak comparison, as for GET)."""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    etags = parse_etags(header)
+    if '*' in etags:
+        return True
+    return etag.removeprefix('W/') in (tag.removeprefix('W/') for tag in etags)
+
+def _validators(django_response, tile):
+    django_response['ETag'] = tile.etag
+    django_response['Expires'] = http_date(tile.modified + get_tile_store().timeout)
+    return django_response
+
+def stored_tile_response(request, tile):
+    """
+    Answer from the tile store: 304 when the client already has this tile,
+    which only needs the stat done by the store, otherwise the file itself.
+    """
+    if etag_matches(request, tile.etag):
+        return _validators(HttpResponseNotModified(), tile)
+    return _validators(FileResponse(open(tile.path, 'rb'), content_type='image/png'), tile)
+
+async def astored_tile_response(request, tile):
+    """Async version of stored_tile_response; tiles are small, so the file is read in one go."""
+    if etag_matches(request, tile.etag):
+        return _validators(HttpResponseNotModified(), tile)
+    content = await sync_to_async(tile.read)()
+    return _validators(HttpResponse(content, content_type='image/png'), tile)
+
+def store_tile(layer, z, x, y, content, modified_ns=None):
+    try:
+        get_tile_store().put(layer, z, x, y, content, modified_ns)
+    except OSError as e:
+        logger.warning(f"Failed to store tile {layer}/{z}/{x}/{y}: {e}")
+
+def stream_tile(response, layer, z, x, y, modified_ns=None):
+    """
+    Pass the upstream body through chunk by chunk and, once it has been read
+    completely, store it in the tile store as modified at ``modified_ns``. A
+    tile cut short upstream is not stored.
+    """
+    chunks = []
+    try:
+        for chunk in response.iter_content(TILE_CHUNK_SIZE):
+            chunks.append(chunk)
+            yield chunk
+    except requests.RequestException as e:
+        logger.warning(f"Tile {layer}/{z}/{x}/{y} was cut short: {e}")
+        return
+    finally:
+        response.close()
+    store_tile(layer, z, x, y, b''.join(chunks), modified_ns)
+
+async def astream_tile(response, layer, z, x, y, modified_ns=None):
+    """Async version of stream_tile for an httpx response opened with stream=True."""
+    chunks = []
+    try:
+        async for chunk in response.aiter_bytes(TILE_CHUNK_SIZE):
+            chunks.append(chunk)
+            yield chunk
+    except httpx.HTTPError as e:
+        logger.warning(f"Tile {layer}/{z}/{x}/{y} was cut short: {e}")
+        return
+    finally:
+        await response.aclose()
+    await sync_to_async(store_tile)(layer, z, x, y, b''.join(chunks), modified_ns)
+
+def streaming_tile_response(stream, response, layer, z, x, y):
+    """
+    Stream a tile from upstream with ``stream`` (stream_tile or astream_tile),
+    forwarding Content-Length so clients can spot a truncated body. The
+    chunks are decoded, so the length of an encoded upstream body would not
+    match them and is not forwarded. The tile is stored with the
+    modification time its ETag is made from, so a revalidation with that
+    ETag is answered by stored_tile_response.
+    """
+    modified_ns = time.time_ns()
+    django_response = StreamingHttpResponse(
+        stream(response, layer, z, x, y, modified_ns),
+        content_type=response.headers.get('Content-Type', 'image/png')
+    )
+    django_response['ETag'] = tile_etag(layer, z, x, y, modified_ns)
+    encoding = response.headers.get('Content-Encoding', 'identity').strip().lower()
+    if response.headers.get('Content-Length') and encoding == 'identity':
+        django_response['Content-Length'] = response.headers['Content-Length']
+    return django_response
@@ -0,0 +1,117 @@
+"""
+Offline time zone lookup for the time zone endpoint.
+
+The IANA zone of a city is taken from the zone.tab table shipped with pytz,
+which lists every zone with its country and the coordinates of its principal
+city. A city resolved through the city list gets the zone of its country
+when the country has only one, which covers most countries. Otherwise it
+gets the zone whose principal city is nearest, but only when that city is
+within NEAREST_ZONE_MAX_KM and every zone almost as near keeps the same UTC
+offsets through the year (January and July, so daylight saving time
+counts). Far from a principal city (Seattle is nearer to Boise than to Los
+Angeles) or near a border between zones (Calgary, between America/Edmonton
+and America/Creston), that nearest-city guess could be wrong. So the lookup
+gives up there and leaves the city to the upstream time zone API, as it does
+for names the city list cannot resolve.
+"""
+import logging
+import re
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+import pytz
+
+from .city_snapshot import get_city_snapshot
+from .nearest_city import distance_km
+
+logger = logging.getLogger(__name__)
+
+Zone = namedtuple('Zone', ['name', 'country', 'lat', 'lon', 'offsets'])
+
+COORDINATES = re.compile(r'^([+-]\d{4,6})([+-]\d{5,7})$')
+NEAREST_ZONE_MAX_KM = 400
+# Zones at most this much farther than the nearest one make the answer ambiguous
+AMBIGUITY_RATIO = 1.5
+AMBIGUITY_MARGIN_KM = 25
+
+def parse_iso6709(value):
+    """Degrees of an ISO 6709 coordinate as used in zone.tab, e.g. ``+4843`` or ``-0790403``."""
+    sign = -1 if value[0] == '-' else 1
+    digits = value[1:]
+    degree_digits = 2 if len(digits) in (4, 6) else 3
+    parts = [int(digits[:degree_digits])] + [int(digits[i:i + 2]) for i in range(degree_digits, len(digits), 2)]
+    return sign * sum(part / 60 ** i for i, part in enumerate(parts))
+
+def zone_offsets(name, year):
+    """UTC offsets of zone ``name`` in January and July of ``year``."""
+    zone = pytz.timezone(name)
+    return tuple(zone.utcoffset(datetime(year, month, 15)) for month in (1, 7))
+
+def load_zone_table(year=None):
+    """Zones of pytz's zone.tab, grouped by country code, with their offsets in ``year`` (this year by default)."""
+    year = year or datetime.now().year
+    zones = {}
+    with pytz.open_resource('zone.tab') as f:
+        for line in f.read().decode('utf-8').splitlines():
+            if not line or line.startswith('#'):
+                continue
+            country, coordinates, name = line.split('\t')[:3]
+            match = COORDINATES.match(coordinates)
+            if match is None:
+                continue
+            lat, lon = parse_iso6709(match.group(1)), parse_iso6709(match.group(2))
+            zones.setdefault(country, []).append(Zone(name, country, lat, lon, zone_offsets(name, year)))
+    return zones
+
+def timezone_at(zones, lat, lon, country=''):
+    """
+    Name of the zone of a point in ``country`` (searching every country if it
+    has no zone listed), or None if the nearby zones disagree.
+    """
+    candidates = zones.get(country)
+    if not candidates:
+        candidates = [zone for country_zones in zones.values() for zone in country_zones]
+    if len(candidates) == 1:
+        return candidates[0].name
+
+    by_distance = sorted((distance_km(lat, lon, zone.lat, zone.lon), zone) for zone in candidates)
+    nearest_distance, nearest = by_distance[0]
+    if nearest_distance > NEAREST_ZONE_MAX_KM:
+        return None
+    limit = nearest_distance * AMBIGUITY_RATIO + AMBIGUITY_MARGIN_KM
+    for distance, zone in by_distance[1:]:
+        if distance > limit:
+            break
+        if zone.offsets != nearest.offsets:
+            return None
+    return nearest.name
+
+
+_zone_table = None
+_zone_table_lock = threading.Lock()
+
+def get_zone_table():
+    """Get the per-process zone table, parsed on first use."""
+    global _zone_table
+    if _zone_table is None:
+        with _zone_table_lock:
+            if _zone_table is None:
+                _zone_table = load_zone_table()
+    return _zone_table
+
+def city_timezone(city_name):
+    """
+    IANA zone of a city in the city list, or None if the name does not
+    resolve to exactly one city or its zone is ambiguous.
+    """
+    try:
+        snapshot = get_city_snapshot()
+        position = snapshot.resolve(' '.join(city_name.split()))
+        if position is None:
+            return None
+        return timezone_at(get_zone_table(), snapshot.lats[position], snapshot.lons[position],
+                           snapshot.country(position))
+    except Exception as e:
+        logger.warning(f"Local time zone lookup failed for {city_name}: {e}")
+        return None
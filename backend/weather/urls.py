@@ -1,15 +1,29 @@
-from django.urls import path
+from django.urls import path, register_converter
 from . import views
+from .converters import FloatConverter, LayerConverter
 from django.conf import settings
 from django.conf.urls.static import static
 from django.views.generic import TemplateView
 
+# Under ASGI the upstream-bound views are served by their async versions;
+# WSGI deployments keep the synchronous ones.
+if settings.ASYNC_VIEWS:
+    from . import async_views as upstream_views
+else:
+    upstream_views = views
+
+register_converter(FloatConverter, 'float')
+register_converter(LayerConverter, 'layer')
+
 urlpatterns = [
-    path('get_weather_data/', views.get_weather_data, name='get_weather_data'),
-    path('get_time_zone/', views.get_time_zone , name='get_time_zone'),
-    path('get_user_location/', views.get_user_location_view, name='get_user_location'),
-    path('get_news/', views.get_news_view, name='get_news'),
+    path('get_weather_data/', upstream_views.get_weather_data, name='get_weather_data'),
+    path('get_weather_batch/', views.get_weather_batch, name='get_weather_batch'),
+    path('get_time_zone/', upstream_views.get_time_zone , name='get_time_zone'),
+    path('get_user_location/', upstream_views.get_user_location_view, name='get_user_location'),
+    path('get_user_location/<float:latitude>/<float:longitude>/', upstream_views.get_user_location, name='get_weather_at_location'),
+    path('get_news/', upstream_views.get_news_view, name='get_news'),
     path('search_suggestions/', views.search_suggestions, name='search_suggestions'),
-    path('map_tile/<str:layer>/<int:z>/<int:x>/<int:y>/', views.map_tile_proxy, name='map_tile_proxy'),
-    path('map_tile_optimized/<str:layer>/<int:z>/<int:x>/<int:y>/', views.map_tile_proxy_optimized, name='map_tile_proxy_optimized'),
+    path('map_tile/<layer:layer>/<int:z>/<int:x>/<int:y>/', upstream_views.map_tile_proxy, name='map_tile_proxy'),
+    path('map_tile_optimized/<layer:layer>/<int:z>/<int:x>/<int:y>/', upstream_views.map_tile_proxy_optimized, name='map_tile_proxy_optimized'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
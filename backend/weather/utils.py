@@ -8,31 +8,178 @@ from django.conf import settings
 from functools import wraps
 from django.core.cache import cache
 import hashlib
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from redis.exceptions import LockError
+from . import metrics
+from .retry import DEFAULT_RETRY_POLICY, RetryPolicy
+from .http_client import get_http_session
 
 logger = logging.getLogger(__name__)
 
 API_KEY = os.getenv('API_KEY')
 NEWS_API_KEY = os.getenv('NEWS_API_KEY')
 TIMEZONE_API_URL = 'https://geocode.xyz/{city_name}?json=1&timezone=1'
-MAX_RETRIES = 3
-TIMEOUT = 10
+UPSTREAM_WORKERS = int(os.getenv('UPSTREAM_WORKERS', '16'))
 
-def redis_cache(timeout):
+# The city list is a large download, fetched by update_city_list and never on the request path
+CITY_LIST_RETRY_POLICY = RetryPolicy(deadline=300, attempt_timeout=60)
+
+# Single-flight settings for redis_cache
+LOCK_TIMEOUT = 30 # Seconds before an abandoned recompute lock expires
+LOCK_WAIT = 5 # Seconds a caller waits for another worker's recompute
+LOCK_POLL_INTERVAL = 0.05
+PREVIOUS_VALUE_FACTOR = 2 # Previous values outlive the entry by this factor
+
+# Seconds a failed or empty lookup is remembered, kept short so recoveries show up quickly
+NEGATIVE_CACHE_TIMEOUT = int(os.getenv('NEGATIVE_CACHE_TIMEOUT', '60'))
+
+def make_cache_key(name, args, kwargs):
+    """Build the cache key shared by the sync and async cache decorators."""
+    key_parts = [name] + list(args) + sorted(kwargs.items())
+    return hashlib.md5(json.dumps(key_parts).encode('utf-8')).hexdigest()
+
+# Entries written by redis_cache in stale-while-revalidate mode
+CacheEntry = namedtuple('CacheEntry', ['value', 'fresh_until'])
+
+def release_lock(lock, name):
+    try:
+        lock.release()
+    except LockError:
+        logger.warning(f"Lock for {name} expired before it was released.")
+
+def redis_cache(timeout, stale_timeout=None, negative_timeout=None, single_flight=False,
+                lock_timeout=LOCK_TIMEOUT, lock_wait=LOCK_WAIT):
+    """
+    Cache the result of ``func`` in Redis for ``timeout`` seconds.
+
+    With ``stale_timeout`` set, ``timeout`` becomes a soft TTL: entries stay
+    in Redis for ``stale_timeout`` seconds, and once ``timeout`` has passed
+    callers still get the cached value straight away while one background
+    refresh, claimed through a Redis lock, recomputes it. Only after
+    ``stale_timeout`` do callers block on ``func``.
+
+    With ``negative_timeout`` set, a ``None`` result is remembered under its
+    own key for that many seconds, so repeated failed or unknown lookups do
+    not reach the upstream again until it expires.
+
+    With ``single_flight`` enabled a miss is recomputed by one caller at a
+    time: the caller that takes the Redis lock calls ``func``, while the
+    others get the previous value if one is still around, or wait up to
+    ``lock_wait`` seconds for the fresh one. If the holder gives up without
+    a value they get None, and only if it is still busy after ``lock_wait``
+    do they compute it themselves.
+    The lock lives in Redis, so this holds across processes and nodes.
+
+    Hits, stale hits, negative hits and misses are counted in weather.metrics
+    under ``cache.<function name>``.
+    """
     def decorator(func):
+        metric = f'cache.{func.__name__}'
+
+        def read(key):
+            """
+            Return the cached value (None on a miss), whether it is still fresh
+            and whether a negative result is cached instead.
+            """
+            if negative_timeout is None:
+                entry, negative = cache.get(key), False
+            else:
+                entries = cache.get_many([key, f'{key}:negative'])
+                entry, negative = entries.get(key), f'{key}:negative' in entries
+            if not isinstance(entry, CacheEntry):
+                # Plain entries (including ones written before stale_timeout was set) are fresh until they expire
+                return entry, entry is not None, negative
+            return entry.value, time.time() < entry.fresh_until, negative
+
+        def compute(key, args, kwargs):
+            result = func(*args, **kwargs)
+            if result is None and negative_timeout is not None:
+                cache.set(f'{key}:negative', True, negative_timeout)
+                metrics.incr(f'{metric}.negative_store')
+                return None
+
+            if stale_timeout is None:
+                cache.set(key, result, timeout)
+            elif result is not None:
+                cache.set(key, CacheEntry(result, time.time() + timeout), stale_timeout)
+
+            if single_flight and stale_timeout is None and result is not None:
+                # Kept past the TTL so callers can be served while a refresh is in flight
+                cache.set(f'{key}:previous', result, timeout * PREVIOUS_VALUE_FACTOR)
+            return result
+
+        def compute_single_flight(key, args, kwargs):
+            lock = cache.lock(f'{key}:lock', timeout=lock_timeout, blocking=False)
+            if lock.acquire():
+                try:
+                    return compute(key, args, kwargs)
+                finally:
+                    release_lock(lock, func.__name__)
+
+            # Someone else is recomputing: serve the previous value, or wait briefly for theirs
+            result = cache.get(f'{key}:previous')
+            if result is not None:
+                return result
+
+            deadline = time.monotonic() + lock_wait
+            while time.monotonic() < deadline:
+                time.sleep(LOCK_POLL_INTERVAL)
+                # Checked before the read, so a value written just before the release is still seen
+                still_computing = lock.locked()
+                result, _, negative = read(key)
+                if result is not None or negative:
+                    return result
+                if not still_computing:
+                    # The holder finished without a value (the upstream failed): share its failure
+                    # rather than have every waiter call the upstream again
+                    metrics.incr(f'{metric}.failed_wait')
+                    return None
+
+            logger.warning(f"Timed out waiting for {func.__name__} to be recomputed.")
+            return compute(key, args, kwargs)
+
+        def refresh(key, args, kwargs, lock):
+            try:
+                if compute(key, args, kwargs) is None:
+                    # Keep serving the stale value; holding the lock until it expires
+                    # stops every caller from retrying the failed upstream
+                    return
+            except Exception as e:
+                logger.error(f"Background refresh of {func.__name__} failed: {e}")
+                return
+            release_lock(lock, func.__name__)
+
+        def schedule_refresh(key, args, kwargs):
+            # The lock is released by the worker thread, so it cannot be thread-local
+            lock = cache.lock(f'{key}:lock', timeout=lock_timeout, blocking=False, thread_local=False)
+            if lock.acquire():
+                get_executor().submit(refresh, key, args, kwargs, lock)
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            key_parts = [func.__name__] + list(args) + sorted(kwargs.items())
-            key = hashlib.md5(json.dumps(key_parts).encode('utf-8')).hexdigest()
+            key = make_cache_key(func.__name__, args, kwargs)
             
             # Check if the result is in the cache
-            result = cache.get(key)
+            result, fresh, negative = read(key)
             if result is not None:
+                if fresh:
+                    metrics.incr(f'{metric}.hit')
+                else:
+                    metrics.incr(f'{metric}.stale_hit')
+                    schedule_refresh(key, args, kwargs)
                 return result
+
+            if negative:
+                metrics.incr(f'{metric}.negative_hit')
+                return None
             
             # If not, call the function and store the result in the cache
-            result = func(*args, **kwargs)
-            cache.set(key, result, timeout)
-            return result
+            metrics.incr(f'{metric}.miss')
+            if single_flight:
+                return compute_single_flight(key, args, kwargs)
+            return compute(key, args, kwargs)
         return wrapper
     return decorator
 
@@ -40,25 +187,26 @@ def kelvin_to_celsius(kelvin):
     """Convert temperature from Kelvin to Celsius."""
     return kelvin - 273.15
 
-@redis_cache(timeout=14400)
+def parse_news(news_data):
+    """Reduce a NewsAPI response to the fields the frontend renders."""
+    articles = news_data.get('articles', [])
+    return [
+        {
+            'title': article.get('title', 'N/A'),
+            'description': article.get('description', 'N/A'),
+            'url': article.get('url', '#')
+        }
+        for article in articles
+    ]
+
+@redis_cache(timeout=14400, stale_timeout=86400, single_flight=True)
 def get_news(query, count=5):
     news_url = f"https://newsapi.org/v2/everything?q={query}&apiKey={NEWS_API_KEY}&pageSize={count}"
     try:
-        response = requests.get(news_url)
+        response = DEFAULT_RETRY_POLICY.get(news_url)
         
         if response.status_code == 200:
-            news_data = response.json()
-            articles = news_data.get('articles', [])
-            
-            news_list = [
-                {
-                    'title': article.get('title', 'N/A'),
-                    'description': article.get('description', 'N/A'),
-                    'url': article.get('url', '#')
-                }
-                for article in articles
-            ]
-            return news_list
+            return parse_news(response.json())
         
         elif response.status_code == 401:
             logger.warning("Invalid API Key for News API.")
@@ -67,27 +215,21 @@ def get_news(query, count=5):
     except Exception as e:
         logger.error(f"Error fetching news: {e}")
     
-    return []
-
-@redis_cache(timeout=86400)
-def fetch_user_ip():
-    try:
-        response = requests.get('https://httpbin.org/ip')
-        if response.status_code == 200:
-            return response.json().get('origin', '')
-    except Exception as e:
-        logger.error(f"Error fetching IP: {e}")
+    # None, not [], so the cache keeps serving the last good news instead of storing the failure
     return None
 
+def format_location(data):
+    """Format an ipapi.co response as "City, Region, Country"."""
+    return f"{data.get('city', 'Unknown City')}, {data.get('region', 'Unknown Region')}, {data.get('country_name', 'Unknown Country')}"
+
 @redis_cache(timeout=86400)
 def get_location_from_ip(user_ip):
     try:
         ip_api_url = f"https://ipapi.co/{user_ip}/json/"
-        response = requests.get(ip_api_url)
+        response = DEFAULT_RETRY_POLICY.get(ip_api_url)
         
         if response.status_code == 200:
-            data = response.json()
-            return f"{data.get('city', 'Unknown City')}, {data.get('region', 'Unknown Region')}, {data.get('country_name', 'Unknown Country')}"
+            return format_location(response.json())
         elif response.status_code == 429:
             logger.warning("Rate limit exceeded. Falling back to default location.")
             return "Toronto, Ontario, Canada"
@@ -97,10 +239,10 @@ def get_location_from_ip(user_ip):
         logger.error(f"Error during IP geolocation: {e}")
     return "Location Unavailable"
 
-@redis_cache(timeout=604800)
+@redis_cache(timeout=604800, stale_timeout=2592000, negative_timeout=NEGATIVE_CACHE_TIMEOUT)
 def get_timezone_data(city_name):
     try:
-        response = requests.get(TIMEZONE_API_URL.format(city_name=city_name))
+        response = DEFAULT_RETRY_POLICY.get(TIMEZONE_API_URL.format(city_name=city_name))
         response_data = response.json()
 
         if response_data.get('timezone'):
@@ -110,22 +252,6 @@ def get_timezone_data(city_name):
     except Exception as e:
         return None
 
-@redis_cache(timeout=600)
-def fetch_weather_by_coordinates(lat, lon):
-    try:
-        url = f"http://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={API_KEY}"
-        response = requests.get(url)
-        
-        if response.status_code == 200:
-            return response.json()
-        elif response.status_code == 401:
-            logger.warning("Invalid API Key for OpenWeather API.")
-        else:
-            logger.error(f"Error fetching weather: {response.status_code} - {response.text}")
-    except Exception as e:
-        logger.error(f"Error fetching weather by coordinates: {e}")
-    return None
-
 def format_weather_data(weather_data):
     try:
         city_name = weather_data['name']
@@ -147,40 +273,27 @@ def format_weather_data(weather_data):
         logger.error(f"Error formatting weather data: {e}")
         return {"error": "Incomplete weather data."}
 
-@redis_cache(timeout=600)
-def get_weather_data_for_city(city_name):
-    if not API_KEY:
-        logger.error("API_KEY for OpenWeather is not set.")
-        return None
-    weather_url = f'http://api.openweathermap.org/data/2.5/weather?q={city_name}&appid={API_KEY}'
-    try:
-        response = requests.get(weather_url)
-        if response.status_code == 200:
-            return format_weather_data(response.json())
-        else:
-            logger.error(f"Error fetching weather data for {city_name}: {response.status_code} - {response.text}")
-            return None
-    except Exception as e:
-        logger.error(f"Error fetching weather data for {city_name}: {e}")
-    return None
+def get_session():
+    """Get the pooled session used for upstream calls (see weather.http_client)."""
+    return get_http_session()
 
 
-_session = None
+_executor = None
 
-def get_session():
-    """Get or create a requests session for connection pooling."""
-    global _session
-    if _session is None:
-        _session = requests.Session()
-        # Configure connection pooling
-        adapter = requests.adapters.HTTPAdapter(
-            pool_connections=10,
-            pool_maxsize=20,
-            max_retries=3
+def get_executor():
+    """Get or create the shared thread pool used to run upstream calls in parallel."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=UPSTREAM_WORKERS,
+            thread_name_prefix='upstream'
         )
-        _session.mount('https://', adapter)
-    return _session
+    return _executor
+
 
+def get_cached_city_list():
+    """The city list cached by update_city_list or get_city_list, or [] if there is none. Never downloads."""
+    return cache.get('city_list') or []
 
 def get_city_list():
     """
@@ -193,7 +306,7 @@ def get_city_list():
     # If not in cache, fetch and cache it
     url = "https://bulk.openweathermap.org/sample/city.list.json.gz"
     try:
-        response = requests.get(url)
+        response = CITY_LIST_RETRY_POLICY.get(url)
         response.raise_for_status()
         
         decompressed_content = gzip.decompress(response.content)
@@ -1,196 +1,331 @@
 from django.core.cache import cache
-from django.views.decorators.cache import cache_page
 from django.views.decorators.http import require_http_methods
-from datetime import datetime, timedelta
 from django.shortcuts import render, redirect
 from django.http import JsonResponse, HttpResponse
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderUnavailable
 from functools import lru_cache
 import json
-import pytz
 import requests
 import time
 import os
 import gzip
 from django.conf import settings
 from .custom_exceptions import APIException, BadRequest, NotFound, ServiceUnavailable
+from .city_index import get_city_index
+from .locations import (
+    FALLBACK_LOCATION,
+    nearest_city_location,
+    resolve_weather_location,
+    weather_location_for_id,
+)
+from .ip_ranges import client_ip, get_ip_table
+from .timezones import city_timezone
+from .tiles import (
+    tile_url,
+    get_stored_tile,
+    stored_tile_response,
+    stream_tile,
+    streaming_tile_response,
+)
+from .retry import RetryPolicy
+from .circuit_breaker import breaker_states
+from .compact import COMPACT_FORMAT, compact_weather_payload
+from .payloads import (
+    encode_payload,
+    get_payload,
+    get_payloads,
+    get_fallback_payload,
+    store_payload,
+    payload_response,
+)
+from . import metrics, popularity
+from .services import (
+    API_KEY,
+    WEATHER_API_KEY_2,
+    FETCH_DEADLINE,
+    WEATHER_PAYLOAD_TIMEOUT,
+    WEATHER_FALLBACK_TIMEOUT,
+    fetch_weather_batch,
+    fetch_weather_data,
+    store_location_payload,
+    wait_for,
+)
 from .utils import (
-    kelvin_to_celsius,
     get_news,
-    fetch_user_ip,
     get_location_from_ip,
     get_timezone_data,
-    fetch_weather_by_coordinates,
-    format_weather_data,
-    get_weather_data_for_city,
     get_session,
-    get_city_list,
+    get_executor,
 )
 
 import logging
 logger = logging.getLogger(__name__)
 
 # Load environment variables
-API_KEY = os.getenv('API_KEY')
 NEWS_API_KEY = os.getenv('NEWS_API_KEY')
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
-WEATHER_API_KEY_2 = os.getenv('WEATHER_API_KEY_2')
 
 # variables
-MAX_RETRIES = 3
-TIMEOUT = 10 
+NEWS_PAYLOAD_TIMEOUT = 900
+LOCATE_BUDGET = 1.5 # Seconds the user-location view may spend locating the client
+LOCATION_WEATHER_BUDGET = 3 # ...and fetching the weather there, before it serves FALLBACK_LOCATION
+WEATHER_BATCH_MAX = int(os.getenv('WEATHER_BATCH_MAX', '20'))
 
-def get_user_location(request, latitude, longitude):
-    return JsonResponse({"status": "success", "message": "Location received successfully."})
+# Map clients give up on slow tiles quickly, so tiles get a tighter budget
+TILE_RETRY_POLICY = RetryPolicy(attempts=2, deadline=8, attempt_timeout=5)
+
+def compact_payload(location, payload):
+    """
+    Compact form of a weather payload. It is cached under the full payload's
+    ETag, so it is built once per payload and never outlives it.
+    """
+    compact = get_payload('weather_data_compact', location.key, payload.etag)
+    if compact is None:
+        data = compact_weather_payload(json.loads(payload.body))
+        timeout = max(1, int(payload.expires_at - time.time()))
+        compact = store_payload('weather_data_compact', (location.key, payload.etag), data, timeout)
+    return compact
+
+def serve_weather_payload(request, location, payload, max_age=None):
+    """Serve a weather payload, in the compact format if the client asked for it with ``format=compact``."""
+    popularity.record(location)
+    if request.GET.get('format') == COMPACT_FORMAT:
+        payload = compact_payload(location, payload)
+    return payload_response(request, payload, max_age=max_age)
+
+def weather_response(request, location):
+    """Serve the weather payload of a resolved location, from the payload cache or built on a miss."""
+    payload = get_payload('weather_data', location.key)
+    if payload is not None:
+        return serve_weather_payload(request, location, payload)
+
+    if not API_KEY or not WEATHER_API_KEY_2:
+        raise ServiceUnavailable("API keys for weather data not configured.")
+
+    try:
+        response_data = fetch_weather_data(location)
+    except ServiceUnavailable:
+        # An upstream is down (or its circuit breaker is open): serve the last good payload
+        payload = get_fallback_payload('weather_data', location.key)
+        if payload is None:
+            raise
+        return serve_weather_payload(request, location, payload, max_age=0)
+
+    payload = store_payload('weather_data', (location.key,), response_data, WEATHER_PAYLOAD_TIMEOUT,
+                            fallback_timeout=WEATHER_FALLBACK_TIMEOUT)
+    return serve_weather_payload(request, location, payload)
 
-@cache_page(900, key_prefix="weather_data") # Cache for 15 minutes
 def get_weather_data(request):
     city_name = request.GET.get('city_name', '').strip()
 
     if not city_name:
         raise BadRequest('City name is required')
 
-    if not API_KEY or not WEATHER_API_KEY_2:
-        raise ServiceUnavailable("API keys for weather data not configured.")
+    # Equivalent spellings share one cached payload
+    return weather_response(request, resolve_weather_location(city_name))
+
+def get_user_location(request, latitude, longitude):
+    """Weather of the city closest to a point, resolved offline from the city list."""
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise BadRequest('Coordinates out of range')
+    return weather_response(request, nearest_city_location(latitude, longitude))
+
+def parse_weather_batch(request):
+    """
+    The (query, location) pairs asked for by a batch request, in order and
+    without repeats: spellings of the same city, or a name and its id, share
+    one entry under the first query that named it.
+    """
+    cities = [city.strip() for city in request.GET.get('cities', '').split(',') if city.strip()]
+    ids = [city_id.strip() for city_id in request.GET.get('ids', '').split(',') if city_id.strip()]
+
+    if not cities and not ids:
+        raise BadRequest('cities or ids are required')
+    if len(cities) + len(ids) > WEATHER_BATCH_MAX:
+        raise BadRequest(f'At most {WEATHER_BATCH_MAX} cities per request')
+    if not all(city_id.isdigit() for city_id in ids):
+        raise BadRequest('ids must be OpenWeatherMap city ids')
+
+    requested = {}
+    for city in cities:
+        location = resolve_weather_location(city)
+        requested.setdefault(location.key, (city, location))
+    for city_id in ids:
+        location = weather_location_for_id(int(city_id))
+        requested.setdefault(location.key, (city_id, location))
+    return list(requested.values())
+
+def batch_entry(query, status, payload=None):
+    """One result of a batch response, embedding the payload's cached bytes as they are."""
+    entry = json.dumps({'query': query, 'status': status}).encode('utf-8')
+    if payload is None:
+        return entry
+    return entry[:-1] + b', "data": ' + payload.body + b'}'
+
+def get_weather_batch(request):
+    """
+    Weather for up to WEATHER_BATCH_MAX cities, given as comma-separated
+    names (``cities``) and/or OpenWeatherMap ids (``ids``). Cached payloads
+    are read with one multi-get and the rest fetched together. Each city
+    gets a status: ok, stale (its last good payload, served while an
+    upstream is down), not_found or unavailable.
+    """
+    requested = parse_weather_batch(request)
+    cached = get_payloads('weather_data', [(location.key,) for _, location in requested])
+
+    payloads = {}
+    statuses = {}
+    misses = []
+    for (_, location), payload in zip(requested, cached):
+        if payload is None:
+            misses.append(location)
+        else:
+            payloads[location.key] = payload
+            statuses[location.key] = 'ok'
+
+    if misses:
+        if not API_KEY or not WEATHER_API_KEY_2:
+            raise ServiceUnavailable("API keys for weather data not configured.")
+
+        fetched = fetch_weather_batch(misses)
+        for location in misses:
+            result = fetched[location.key]
+            if isinstance(result, NotFound):
+                statuses[location.key] = 'not_found'
+            elif isinstance(result, APIException):
+                payload = get_fallback_payload('weather_data', location.key)
+                statuses[location.key] = 'unavailable' if payload is None else 'stale'
+                if payload is not None:
+                    payloads[location.key] = payload
+            else:
+                payloads[location.key] = store_payload('weather_data', (location.key,), result, WEATHER_PAYLOAD_TIMEOUT,
+                                                       fallback_timeout=WEATHER_FALLBACK_TIMEOUT)
+                statuses[location.key] = 'ok'
+
+    for _, location in requested:
+        if location.key in payloads:
+            popularity.record(location)
+
+    entries = [
+        batch_entry(query, statuses[location.key], payloads.get(location.key))
+        for query, location in requested
+    ]
+    return HttpResponse(b'{"results": [' + b', '.join(entries) + b']}', content_type='application/json')
 
-    weather_url = f'http://api.openweathermap.org/data/2.5/weather?q={city_name}&appid={API_KEY}'
-    weatherapi_url = f'https://api.weatherapi.com/v1/forecast.json?key={WEATHER_API_KEY_2}&q={city_name}&days=3'
-
-    def fetch_with_retry(url, retries=MAX_RETRIES):
-        for attempt in range(retries):
-            try:
-                response = requests.get(url, timeout=TIMEOUT)
-                response.raise_for_status()
-                return response
-            except requests.RequestException as e:
-                if attempt < retries - 1:
-                    time.sleep(2 ** attempt)
-                else:
-                    raise ServiceUnavailable(f'Error fetching data from {url}') from e
-
-    weather_response = fetch_with_retry(weather_url)
-    weather_data = weather_response.json()
-
-    if weather_data.get('cod') != 200:
-        raise NotFound('City Not Found')
-
-    temperature = kelvin_to_celsius(weather_data.get('main', {}).get('temp', 0))
-    description = weather_data.get('weather', [{}])[0].get('description', '')
-    icon = weather_data.get('weather', [{}])[0].get('icon', '')
-    wind_speed = weather_data.get('wind', {}).get('speed', 0)
-    humidity = weather_data.get('main', {}).get('humidity', 0)
-    pressure = weather_data.get('main', {}).get('pressure', 0)
-
-    city_timezone_offset = weather_data.get('timezone')
-    city_tz = pytz.FixedOffset(city_timezone_offset / 60)
-    city_time = datetime.now(city_tz).strftime('%Y-%m-%d %H:%M:%S')
-
-    sunrise_ts = weather_data.get('sys', {}).get('sunrise')
-    sunset_ts = weather_data.get('sys', {}).get('sunset')
-
-    sunrise = 'N/A'
-    sunset = 'N/A'
-    if sunrise_ts:
-        sunrise = datetime.fromtimestamp(sunrise_ts, city_tz).strftime('%H:%M')
-    if sunset_ts:
-        sunset = datetime.fromtimestamp(sunset_ts, city_tz).strftime('%H:%M')
-
-    weatherapi_response = fetch_with_retry(weatherapi_url)
-    weatherapi_data = weatherapi_response.json()
-
-    hourly_forecast = []
-    if 'forecast' in weatherapi_data and 'forecastday' in weatherapi_data['forecast'] and weatherapi_data['forecast']['forecastday']:
-        for hour in weatherapi_data['forecast']['forecastday'][0]['hour']:
-            hour_data = {
-                'time': hour['time'].split(' ')[1],
-                'temperature': hour['temp_c'],
-                'description': hour['condition']['text'],
-                'icon': hour['condition']['icon'],
-            }
-            hourly_forecast.append(hour_data)
-
-    daily_forecast = []
-    if 'forecast' in weatherapi_data and 'forecastday' in weatherapi_data['forecast']:
-        for day in weatherapi_data['forecast']['forecastday']:
-            day_data = {
-                'date': day['date'],
-                'maxtemp': day['day']['maxtemp_c'],
-                'mintemp': day['day']['mintemp_c'],
-                'condition': day['day']['condition']['text'],
-                'icon': day['day']['condition']['icon'],
-            }
-            daily_forecast.append(day_data)
-
-    response_data = {
-        'city_name': city_name,
-        'temperature': temperature,
-        'description': description,
-        'icon': icon,
-        'city_time': city_time,
-        'wind_speed': wind_speed,
-        'humidity': humidity,
-        'timezone': city_timezone_offset,
-        'hourly_forecast': hourly_forecast,
-        'daily_forecast': daily_forecast,
-        'pressure': pressure,
-        'sunrise': sunrise,
-        'sunset': sunset,
-    }
-    return JsonResponse(response_data)
 def get_time_zone(request):
     city_name = request.GET.get('city_name', '').strip()
 
     if not city_name:
         raise BadRequest('City name is required')
 
-    timezone = get_timezone_data(city_name)
+    # Resolved offline when the city list knows the city; geocode.xyz is the fallback
+    timezone = city_timezone(city_name)
+    if timezone:
+        metrics.incr('timezone.local')
+    else:
+        metrics.incr('timezone.upstream')
+        timezone = get_timezone_data(city_name)
 
     if timezone:
         return JsonResponse({'city_name': city_name, 'timezone': timezone})
     else:
         raise NotFound('Could not fetch timezone data')
 
+def build_news_query(query):
+    """Narrow the disaster topics down to weather-related coverage."""
+    if query.lower() in ['tornado', 'storm', 'flood']:
+        return f'{query} AND (weather OR disaster OR warning OR damage OR alert)'
+    return query
+
 def get_news_view(request):
     query = request.GET.get('query', '')
     if not query:
         raise BadRequest('Query is required')
 
+    payload = get_payload('news', query)
+    if payload is not None:
+        return payload_response(request, payload)
+
     if not NEWS_API_KEY:
         raise ServiceUnavailable("API key for news data not configured.")
 
-    if query.lower() in ['tornado', 'storm', 'flood']:
-        query = f'{query} AND (weather OR disaster OR warning OR damage OR alert)'
-    
-    news = get_news(query, count=6)
-    return JsonResponse({'news': news})
+    news = get_news(build_news_query(query), count=6)
+    if news is None:
+        # NewsAPI failed and nothing was cached: answer with no articles, without keeping that answer
+        return payload_response(request, encode_payload({'news': []}, 0), max_age=0)
+    payload = store_payload('news', (query,), {'news': news}, NEWS_PAYLOAD_TIMEOUT)
+    return payload_response(request, payload)
+
+def city_from_location(location_string):
+    """Extract the city from a "City, Region, Country" lookup, or None if it is unusable."""
+    if location_string and location_string != "Location Unavailable" and "Unknown" not in location_string:
+        return location_string.split(',')[0]
+    return None
+
+def fallback_location_response(request, stage):
+    """
+    Serve the weather of FALLBACK_LOCATION after ``stage`` failed. The warmer
+    keeps its payload stored, so this normally makes no upstream call.
+    """
+    metrics.incr(f'user_location.fallback.{stage}')
+    payload = get_fallback_payload('user_location', FALLBACK_LOCATION.key)
+    if payload is None:
+        try:
+            payload = store_location_payload(FALLBACK_LOCATION, time.monotonic() + FETCH_DEADLINE)
+        except APIException as e:
+            raise ServiceUnavailable('Failed to determine your location and fallback location.') from e
+    return payload_response(request, payload, private=True, max_age=0)
+
+def locate_client(request, deadline=None):
+    """
+    City of the client's address, looked up in the local IP range table. The
+    ipapi.co lookup is only used while no table has been loaded; past
+    ``deadline`` it is not waited for, but still finishes and caches its
+    answer for the client's next request.
+    """
+    user_ip = client_ip(request)
+    if user_ip is None:
+        return None
+    table = get_ip_table()
+    if table is not None:
+        place = table.lookup(user_ip)
+        return place.city if place is not None else None
+    if deadline is None:
+        return city_from_location(get_location_from_ip(user_ip))
+    future = get_executor().submit(get_location_from_ip, user_ip)
+    try:
+        return city_from_location(wait_for(future, f'the location of {user_ip}', deadline))
+    except ServiceUnavailable as e:
+        logger.warning(str(e))
+        return None
 
 def get_user_location_view(request):
-    user_ip = fetch_user_ip()
-    if user_ip:
-        location_string = get_location_from_ip(user_ip)
-        if location_string and location_string != "Location Unavailable" and "Unknown" not in location_string:
-            try:
-                city_name = location_string.split(',')[0]
-                weather_data = get_weather_data_for_city(city_name)
-                if weather_data and "error" not in weather_data:
-                    return JsonResponse(weather_data)
-            except Exception as e:
-                logger.error(f"Error processing location: {e}")
-
-    # If we are here, it means we failed to get user's location or weather.
-    # Let's return weather for Toronto as a fallback.
-    weather_data = get_weather_data_for_city("Toronto")
-    if weather_data and "error" not in weather_data:
-        return JsonResponse(weather_data)
-
-    raise ServiceUnavailable('Failed to determine your location and fallback location.')
-
-@cache_page(60 * 60)
+    """
+    Weather where the client is, as a pipeline of stages: locate the client,
+    resolve the city, then serve its cached payload or fetch its weather.
+    Locating and fetching each get a time budget. A stage that fails or runs
+    out of time serves the stored payload of FALLBACK_LOCATION at once.
+    """
+    city_name = locate_client(request, time.monotonic() + LOCATE_BUDGET)
+    if not city_name:
+        return fallback_location_response(request, 'locate')
+
+    location = resolve_weather_location(city_name)
+    payload = get_payload('user_location', location.key)
+    if payload is None:
+        try:
+            payload = store_location_payload(location, time.monotonic() + LOCATION_WEATHER_BUDGET)
+        except APIException as e:
+            logger.warning(f"No weather for the location of the client, {city_name}: {e}")
+            return fallback_location_response(request, 'weather')
+    return payload_response(request, payload, private=True)
+
 @require_http_methods(["GET"])
 def map_tile_proxy(request, layer, z, x, y):
     """
     Proxy for OpenWeatherMap tiles with caching and error handling.
+    Tiles are streamed to the client as they arrive and cached once complete.
     
     Args:
         layer: Weather layer type (temp_new, precipitation_new, wind_new, clouds_new)
@@ -202,79 +337,70 @@ def map_tile_proxy(request, layer, z, x, y):
     
     if not api_key:
         raise ServiceUnavailable("API key not configured")
-    
-    # Construct the OpenWeatherMap tile URL
-    url = f"https://tile.openweathermap.org/map/{layer}/{z}/{x}/{y}.png?appid={api_key}"
-    
-    try:
-        response = requests.get(
-            url,
-            stream=True,
-            timeout=5,  # 5 second timeout
-            headers={
-                'User-Agent': 'WeatherApp/1.0',
-            }
-        )
-        response.raise_for_status()
-        
-        # Create response with proper caching headers
-        django_response = HttpResponse(
-            response.content,
-            content_type=response.headers.get('Content-Type', 'image/png')
-        )
-        
-        # Add cache headers for browser caching
-        django_response['Cache-Control'] = 'public, max-age=3600'  # Cache for 1 hour
+
+    stored_tile = get_stored_tile(layer, z, x, y)
+    if stored_tile is not None:
+        django_response = stored_tile_response(request, stored_tile)
+    else:
+        try:
+            response = TILE_RETRY_POLICY.get(
+                tile_url(layer, z, x, y, api_key),
+                stream=True,
+                headers={
+                    'User-Agent': 'WeatherApp/1.0',
+                }
+            )
+            response.raise_for_status()
+
+        except requests.exceptions.Timeout:
+            raise ServiceUnavailable("Request timeout")
+
+        except requests.exceptions.RequestException as e:
+            raise ServiceUnavailable("Error fetching tile")
+
+        django_response = streaming_tile_response(stream_tile, response, layer, z, x, y)
         django_response['Expires'] = response.headers.get('Expires', '')
-        
-        return django_response
-        
-    except requests.exceptions.Timeout:
-        raise ServiceUnavailable("Request timeout")
-        
-    except requests.exceptions.RequestException as e:
-        raise ServiceUnavailable("Error fetching tile")
+
+    # Add cache headers for browser caching
+    django_response['Cache-Control'] = 'public, max-age=3600'  # Cache for 1 hour
+    return django_response
 
 
-@cache_page(60 * 60)
 @require_http_methods(["GET"])
 def map_tile_proxy_optimized(request, layer, z, x, y):
     """
-    Optimized proxy using connection pooling.
+    Optimized proxy using connection pooling and streaming pass-through.
     """
     api_key = os.getenv('API_KEY')
     
     if not api_key:
         raise ServiceUnavailable("API key not configured")
-    
-    url = f"https://tile.openweathermap.org/map/{layer}/{z}/{x}/{y}.png?appid={api_key}"
-    
-    try:
-        session = get_session()
-        response = session.get(
-            url,
-            stream=True,
-            timeout=5,
-            headers={'User-Agent': 'WeatherApp/1.0'}
-        )
-        response.raise_for_status()
-        
-        django_response = HttpResponse(
-            response.content,
-            content_type=response.headers.get('Content-Type', 'image/png')
-        )
-        
-        # Aggressive caching
-        django_response['Cache-Control'] = 'public, max-age=3600'
-        django_response['ETag'] = f'"{layer}-{z}-{x}-{y}"'
-        
-        return django_response
-        
-    except requests.exceptions.Timeout:
-        raise ServiceUnavailable("Request timeout")
-        
-    except requests.exceptions.RequestException as e:
-        raise ServiceUnavailable("Error fetching tile")
+
+    stored_tile = get_stored_tile(layer, z, x, y)
+    if stored_tile is not None:
+        # Revalidation with the stored tile's ETag is answered with a 304
+        django_response = stored_tile_response(request, stored_tile)
+    else:
+        try:
+            response = TILE_RETRY_POLICY.get(
+                tile_url(layer, z, x, y, api_key),
+                session=get_session(),
+                stream=True,
+                headers={'User-Agent': 'WeatherApp/1.0'}
+            )
+            response.raise_for_status()
+
+        except requests.exceptions.Timeout:
+            raise ServiceUnavailable("Request timeout")
+
+        except requests.exceptions.RequestException as e:
+            raise ServiceUnavailable("Error fetching tile")
+
+        django_response = streaming_tile_response(stream_tile, response, layer, z, x, y)
+
+    # Aggressive caching
+    django_response['Cache-Control'] = 'public, max-age=3600'
+    return django_response
 
 def search_suggestions(request):
     city_name = request.GET.get('city_name', '').lower()
@@ -283,11 +409,23 @@ def search_suggestions(request):
         return JsonResponse({'success': True, 'suggestions': []})
 
     try:
-        cities = get_city_list()
-        
-        # Filter cities and limit the number of suggestions
-        suggestions = [city['name'] for city in cities if city_name in city['name'].lower()]
-        return JsonResponse({'success': True, 'suggestions': suggestions[:10]}) # Limit to 10
+        # Indexed substring search over the city list, limited to 10 suggestions.
+        # The index is built in the background at startup; until then there are none.
+        index = get_city_index()
+        suggestions = index.search(city_name, limit=10) if index is not None else []
+        return JsonResponse({'success': True, 'suggestions': suggestions})
 
     except Exception as e:
-        raise ServiceUnavailable(f"Error in search_suggestions: {e}")
\ No newline at end of file
+        raise ServiceUnavailable(f"Error in search_suggestions: {e}")
+
+def metrics_view(request):
+    """
+    Counters from weather.metrics, summed across workers and grouped by
+    prefix, plus the current state of each upstream circuit breaker.
+    """
+    grouped = {}
+    for name, value in metrics.snapshot().items():
+        group, _, counter = name.partition('.')
+        grouped.setdefault(group, {})[counter] = value
+    grouped['breaker_states'] = breaker_states()
+    return JsonResponse(grouped)